@@ -9,6 +9,7 @@ from cliff import helpers, atomic_properties, components
 from .driver import *
 from .train import *
 from .fit import *
+from .aio import apredict, AsyncPredictor
 
 # Handle versioneer
 from ._version import get_versions
@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+
+"""
+Asyncio front end of CLIFF. Dimers requested concurrently, e.g. by the
+handlers of an asyncio service, are collected for a short time window and
+evaluated together: one property prediction, which shares the KRR kernel
+evaluations among all monomers, and one energy evaluation per group.
+
+    energies = await cliff.apredict(dimer)
+
+"""
+
+from cliff.helpers.options import Options
+from cliff.driver import load_krr_models, _chunk_energies
+
+# asyncio and concurrent.futures are imported where they're used, they would
+# otherwise take a good fraction of the time to import cliff
+
+
+class AsyncPredictor:
+    '''
+    Groups concurrent requests into batches evaluated in a background
+    thread. A batch is evaluated once it holds max_batch dimers, or
+    max_delay seconds after its first request came in. Batches run one at a
+    time, the ML models are loaded with the first one.
+
+    Parameters
+    ----------
+    options : :class: `~cliff.helpers.Options`
+        Options, defaults to those of infile or the defaults
+    infile : :class: `str`
+        Configuration file
+    ml_type, load_path, nproc, batch_size :
+        As in `cliff.predict_from_dimers`, for every batch
+    max_batch : :class: `int`
+        Largest number of dimers evaluated together
+    max_delay : :class: `float`
+        Longest time in seconds a request waits for others to join its batch
+    '''
+
+    def __init__(self, options=None, infile=None, ml_type='KRR', load_path=None, nproc=1, batch_size=None,
+                 max_batch=64, max_delay=0.01):
+        import concurrent.futures
+
+        if options is None:
+            if infile is None:
+                options = Options()
+            else:
+                options = Options(config_file=infile)
+
+        self.options = options
+        self.ml_type = ml_type
+        self.load_path = load_path
+        self.nproc = nproc
+        self.batch_size = batch_size
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self.models = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # requests waiting for their batch, on the event loop of loop
+        self.loop = None
+        self.pending = []
+        self.timer = None
+
+    async def predict(self, dimer, return_pairs=False, units='angstrom'):
+        '''
+        Energies of a dimer, evaluated in a batch with concurrent requests
+
+        Parameters
+        ----------
+        dimer : qcel Molecule or :class: `str`
+            Dimer, or the name of a dimer xyz file
+        return_pairs : :class: `bool`
+            Return the atom-pairwise decomposition
+        units : :class: `str`
+            Units of a dimer xyz file
+
+        Returns
+        -------
+        energies : :class: `~numpy.ndarray`
+            As returned by `cliff.predict_from_dimers` for this dimer, None
+            if it could not be read or evaluated
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # requests and timer of a loop that ended before their batch
+            # was started can't be answered anymore
+            self.loop = loop
+            self.pending = []
+            self.timer = None
+        future = loop.create_future()
+        self.pending.append((dimer, return_pairs, units, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        '''
+        Starts the evaluation of the pending requests that weren't cancelled
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = [req for req in self.pending if not req[3].cancelled()]
+        self.pending = []
+        if len(batch) > 0:
+            self.loop.create_task(self._run(self.loop, batch))
+
+    async def _run(self, loop, batch):
+        try:
+            energies = await loop.run_in_executor(self.executor, self.evaluate, [req[:3] for req in batch])
+        except Exception as e:
+            energies = None
+            error = e
+        for n, (_, _, _, future) in enumerate(batch):
+            # requests may have been cancelled while waiting
+            if future.done():
+                continue
+            if energies is None:
+                future.set_exception(error)
+            else:
+                future.set_result(energies[n])
+
+    def evaluate(self, requests):
+        '''
+        Energies of a list of (dimer, return_pairs, units) requests,
+        evaluated together
+        '''
+        if self.models is None and self.ml_type.upper() == "KRR" and self.load_path is None:
+            self.models = load_krr_models(self.options)
+
+        energies = [None]*len(requests)
+        groups = {}
+        for n, (_, return_pairs, units) in enumerate(requests):
+            groups.setdefault((bool(return_pairs), units), []).append(n)
+        for (return_pairs, units), group in groups.items():
+            ens = _chunk_energies([requests[n][0] for n in group], self.options, self.models, self.ml_type,
+                                  self.load_path, return_pairs, self.nproc, self.batch_size, units)
+            for n, (_, en) in zip(group, ens):
+                energies[n] = en
+        return energies
+
+    def close(self):
+        self.executor.shutdown()
+
+
+# AsyncPredictor used by `apredict` when none is given
+_default_predictor = None
+
+async def apredict(dimer, return_pairs=False, predictor=None, units='angstrom'):
+    '''
+    Energies of a dimer, evaluated together with concurrent calls. See
+    `AsyncPredictor.predict`, the default predictor uses the default options
+    and is created on first use.
+
+    Parameters
+    ----------
+    dimer : qcel Molecule or :class: `str`
+        Dimer, or the name of a dimer xyz file
+    return_pairs : :class: `bool`
+        Return the atom-pairwise decomposition
+    predictor : :class: `AsyncPredictor`
+        Predictor to use, e.g. one with other options or batch limits
+
+    Returns
+    -------
+    energies : :class: `~numpy.ndarray`
+        [total, elst, exch, indu, disp] in kcal/mol, or the atom-pairwise
+        energies if return_pairs. None if the dimer failed.
+    '''
+    global _default_predictor
+    if predictor is None:
+        if _default_predictor is None:
+            _default_predictor = AsyncPredictor()
+        predictor = _default_predictor
+    return await predictor.predict(dimer, return_pairs, units)
@@ -3,17 +3,12 @@
 from cliff.helpers.system import System
 import cliff.helpers.utils
 import cliff.helpers.constants as constants
-import scipy
-from scipy import stats
-from scipy.spatial.distance import pdist, cdist, squareform
 import logging
 import pickle
 import numpy as np
 import os
 import time
 import glob
-import qml
-from qml.representations import get_slatm_mbtypes
 
 import cliff.tests as t
 testpath = os.path.abspath(t.__file__).split('__init__')[0]
@@ -82,6 +77,7 @@ class Hirshfeld:
 
     def train_ml(self):
         '''Train machine learning model.'''
+        from scipy.spatial.distance import pdist, squareform
 
         if len(self.descr_train) == 0:
             print("No molecule in the training set.")
@@ -104,26 +100,26 @@ class Hirshfeld:
 
     def predict_mol(self, _system, force_predict = False):
         '''Predict coefficients given  descriptors.'''
-        t1 = time.time()
+        self.predict_mols([_system])
+        return None
 
-        _system.hirshfeld_ratios = np.zeros(_system.num_atoms)
-        _system.build_slatm(self.mbtypes, self.cutoff) # pass xyz here?
+    def predict_mols(self, systems):
+        '''Predict the Hirshfeld ratios of several systems, with one kernel evaluation per element.'''
+        for _system in systems:
+            _system.hirshfeld_ratios = np.zeros(_system.num_atoms)
+            _system.build_slatm(self.mbtypes, self.cutoff) # pass xyz here?
 
         prefactor = constants.ml_prefactor[self.kernel]
         power = constants.ml_power[self.kernel]
-        for ele in self.alpha_train.keys():
-            if self.alpha_train[ele] is not None:
-                pairwise_dists = cdist(_system.slatm, self.descr_train[ele], constants.ml_metric[self.kernel])
-                kmat = np.exp(- pairwise_dists / (prefactor*self.krr_sigma**power) )
-                pred = np.dot(kmat,self.alpha_train[ele])
-                for i in range(_system.num_atoms):
-                    if _system.elements[i] == ele:
-                        _system.hirshfeld_ratios[i] = pred[i]
-
+        kernel = lambda pairwise_dists: np.exp(- pairwise_dists / (prefactor*self.krr_sigma**power))
+        cliff.helpers.utils.krr_predict_atoms([s.slatm for s in systems], [s.elements for s in systems],
+                                              self.descr_train, self.alpha_train, constants.ml_metric[self.kernel],
+                                              kernel, [s.hirshfeld_ratios for s in systems])
         return None
 
     def add_mol_to_training(self, new_system, ref_ratios,atom = None):
         'Add molecule to training set'
+        import qml
 
         if self.mbtypes is None:
             raise ValueError("Missing MBTypes")
@@ -2,9 +2,6 @@
 #
 
 from cliff.helpers.system import System
-import scipy
-from scipy import stats
-from scipy.spatial.distance import pdist, cdist, squareform
 import numpy as np
 import logging
 import pickle
@@ -18,9 +15,6 @@ import glob
 
 import cliff.tests as t
 testpath = os.path.abspath(t.__file__).split('__init__')[0]
-# qml
-import qml
-from qml.representations import get_slatm_mbtypes
 
 class Multipole:
     '''
@@ -116,6 +110,7 @@ class Multipole:
     def train_mol(self):
         '''Train machine learning model of multipole rank mtp_rank and
         basis set expansion coefficient coeff.'''
+        from scipy.spatial.distance import pdist, squareform
         # SLATM: First compute mbtypes and the representation
         # Reinitialize descriptor
         for key in self.descr_train.keys():
@@ -163,47 +158,54 @@ class Multipole:
 
     def predict_mol(self, _system, charge=0, xyz=None, force_predict = False):
         '''Predict multipoles in local reference frame given descriptors.'''
+        self.predict_mols([_system], [charge])
+        return None
+
+    def predict_mols(self, systems, charges=None):
+        '''
+        Predict the multipoles of several systems, with one kernel evaluation
+        per element. charges are the total charges of the systems, default 0.
+        '''
         tp = time.time()
-        _system.initialize_multipoles()
-        _system.compute_basis()
+        if charges is None:
+            charges = [0]*len(systems)
+        for _system in systems:
+            _system.initialize_multipoles()
+            _system.compute_basis()
+            _system.build_slatm(self.mbtypes,self.cutoff)
 
-        _system.build_slatm(self.mbtypes,self.cutoff)
         power  = constants.ml_power[self.kernel]
         prefac = constants.ml_prefactor[self.kernel]
-        for e in self.alpha_train.keys():
-            if self.alpha_train[e] is not None:
-                # slowest part of the whole project
-                pairwise_dists = cdist(_system.slatm, \
-                    self.descr_train[e], constants.ml_metric[self.kernel])
-                kmat = np.exp(- pairwise_dists**power / (prefac*self.krr_sigma**power))
-                pred = np.dot(kmat,self.alpha_train[e])
-                for i in range(_system.num_atoms):
-                    if _system.elements[i] == e:
-                        _system.mtp_expansion[i] = pred[i]
-        # Revert normalization
-        # self.rev_normalize(_system)
-        # Correct to get integer charge
-        if self.correct_charge:
-            # Weigh by ML error
-            mol_mu = sum([constants.ml_chg_correct_error[ele]
-                            for ele in _system.elements])
-            totalcharge = sum([mtp[0] for mtp in _system.mtp_expansion])
-            excess_chg = totalcharge - float(charge)
-            if mol_mu > 0.:
-                for i,mtp_i in enumerate(_system.mtp_expansion):
-                    w_i = constants.ml_chg_correct_error[_system.elements[i]]
-                    mtp_i[0] += -1.*excess_chg * (w_i/mol_mu)
-        # Compute multipoles from basis set expansion
-        _system.expand_multipoles()
-
-
-        self.logger.debug("Predicted multipole expansion for %s" % ( _system.xyz[0]))
+        # slowest part of the whole project
+        kernel = lambda pairwise_dists: np.exp(- pairwise_dists**power / (prefac*self.krr_sigma**power))
+        utils.krr_predict_atoms([s.slatm for s in systems], [s.elements for s in systems],
+                                self.descr_train, self.alpha_train, constants.ml_metric[self.kernel],
+                                kernel, [s.mtp_expansion for s in systems])
+        for _system, charge in zip(systems, charges):
+            # Revert normalization
+            # self.rev_normalize(_system)
+            # Correct to get integer charge
+            if self.correct_charge:
+                # Weigh by ML error
+                mol_mu = sum([constants.ml_chg_correct_error[ele]
+                                for ele in _system.elements])
+                totalcharge = sum([mtp[0] for mtp in _system.mtp_expansion])
+                excess_chg = totalcharge - float(charge)
+                if mol_mu > 0.:
+                    for i,mtp_i in enumerate(_system.mtp_expansion):
+                        w_i = constants.ml_chg_correct_error[_system.elements[i]]
+                        mtp_i[0] += -1.*excess_chg * (w_i/mol_mu)
+            # Compute multipoles from basis set expansion
+            _system.expand_multipoles()
+
+            self.logger.debug("Predicted multipole expansion for %s" % ( _system.xyz[0]))
 
        # print("    Time spent predicting multipoles:                     %8.3f s" % (time.time() - tp))
         return None
 
     def add_mol_to_training(self, new_system, pun, atom=None, xyz=None):
         'Add molecule to training set'
+        import qml
         new_system.initialize_multipoles()
 
         # Don't build SLATM yet, only add information to mbtypes
@@ -40,21 +40,14 @@ class Polarizability:
         hirshfeld_ratios = self.system.hirshfeld_ratios
         if hirshfeld_ratios is None:
             self.logger.error("Assign Hirshfeld ratios first")
-        self.freq_free_atom = np.zeros(self.num_atoms)
-        self.freq_scaled = np.zeros(self.num_atoms)
-        self.freq_scaled_vec = np.empty((self.num_atoms,3))
-        self.pol_scaled = np.zeros(self.num_atoms)
+        csix_free = self.system.element_params(constants.csix_free)
+        pol_free = self.system.element_params(constants.pol_free)
         # Free atom frequencies
-        for i,ele in enumerate(self.elements):
-            self.freq_free_atom[i] = 4/3. * constants.csix_free[ele] \
-                / constants.pol_free[ele]**2
-            # exponent 4/3 according to AT
-            self.pol_scaled[i] = hirshfeld_ratios[i]  **(4/3.) \
-                * constants.pol_free[ele]
-            self.freq_scaled[i] = 4/3. * constants.csix_free[ele] \
-                / self.pol_scaled[i]**2
-            self.freq_scaled_vec[i] = np.array([self.freq_scaled[i],
-                self.freq_scaled[i], self.freq_scaled[i]])
+        self.freq_free_atom = 4/3. * csix_free / pol_free**2
+        # exponent 4/3 according to AT
+        self.pol_scaled = np.asarray(hirshfeld_ratios, dtype=float)**(4/3.) * pol_free
+        self.freq_scaled = 4/3. * csix_free / self.pol_scaled**2
+        self.freq_scaled_vec = np.repeat(self.freq_scaled[:,None], 3, axis=1)
 
         self.logger.debug("Scaled isotropic polarizability:   %s" % self.pol_scaled)
         self.logger.debug("Characteristic frequencies free:   %s" % self.freq_free_atom)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#
+# Timings of the stages of CLIFF on the bundled dimers and on scaling series
+# of generated water clusters and alkane chains, compared to a baseline
+#
+#     python -m cliff.benchmark -o benchmark.json
+#     python -m cliff.benchmark --baseline benchmark.json
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import fnmatch
+import argparse
+import platform
+import numpy as np
+
+import cliff
+import cliff.tests as t
+import cliff.helpers.budget as budget
+import cliff.helpers.metrics as metrics
+from cliff.helpers.options import Options
+from cliff.helpers.cell import Cell
+from cliff.helpers.system import System
+from cliff.components.prepared import PreparedMonomer, batch_pair_energies
+
+
+testpath = os.path.abspath(t.__file__).split('__init__')[0]
+
+# monomer sizes of the scaling series: water molecules and alkane carbons
+default_sizes = [2, 4, 8, 16, 32]
+quick_sizes = [2, 4, 8]
+
+
+def water_cluster(nmol, seed=0, spacing=3.0):
+    '''
+    Elements and coordinates (Angstrom) of nmol randomly oriented water
+    molecules on the points of a cubic grid closest to the origin
+    '''
+    rng = np.random.default_rng(seed)
+    theta = np.radians(104.52)
+    water = 0.9572 * np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [np.cos(theta), np.sin(theta), 0.0]])
+
+    side = int(np.ceil(nmol ** (1/3))) + 1
+    grid = np.array([[i, j, k] for i in range(-side, side+1) for j in range(-side, side+1)
+                     for k in range(-side, side+1)], dtype=float) * spacing
+    grid = grid[np.argsort(np.linalg.norm(grid, axis=1), kind='stable')][:nmol]
+
+    elements, coords = [], []
+    for center in grid:
+        rot, _ = np.linalg.qr(rng.normal(size=(3,3)))
+        elements += ['O', 'H', 'H']
+        coords.append(water @ rot.T + center)
+    return elements, np.concatenate(coords)
+
+def alkane_chain(ncarbon):
+    '''
+    Elements and coordinates (Angstrom) of the all-trans alkane with
+    ncarbon carbons, along the x axis
+    '''
+    elements, coords = [], []
+    for i in range(ncarbon):
+        side = 1.0 if i % 2 else -1.0
+        carbon = np.array([1.26*i, 0.43*side, 0.0])
+        elements.append('C')
+        coords.append(carbon)
+        hydrogens = [[0.0, 0.55*side, 0.835], [0.0, 0.55*side, -0.835]]
+        if i == 0:
+            hydrogens.append([-0.94, 0.34*side, 0.0])
+        if i == ncarbon - 1:
+            hydrogens.append([0.94, 0.34*side, 0.0])
+        for h in hydrogens:
+            elements.append('H')
+            coords.append(carbon + 1.09*np.array(h))
+    return elements, np.array(coords)
+
+def scaling_dimers(options, kind, size):
+    '''
+    Monomer Systems of a generated dimer: two water clusters of size
+    molecules 3 Angstrom apart, or two parallel alkanes of size carbons
+    stacked 4.5 Angstrom apart
+
+    Returns
+    -------
+    dimers : list of [:class: `~cliff.helpers.System`, :class: `~cliff.helpers.System`]
+        The single dimer
+    '''
+    if kind == 'water':
+        ele_a, crd_a = water_cluster(size, seed=2*size)
+        ele_b, crd_b = water_cluster(size, seed=2*size+1)
+        crd_b = crd_b + [np.max(crd_a[:,0]) - np.min(crd_b[:,0]) + 3.0, 0.0, 0.0]
+    elif kind == 'alkane':
+        ele_a, crd_a = alkane_chain(size)
+        ele_b, crd_b = alkane_chain(size)
+        crd_b = crd_b + [0.0, 0.0, 4.5]
+    else:
+        raise Exception("Unknown scaling series %s, use water or alkane" % kind)
+
+    name = "%s-%d" % (kind, size)
+    mons = []
+    for n, (elements, coords) in enumerate([(ele_a, crd_a), (ele_b, crd_b)]):
+        mon = System(options)
+        mon.load_atoms(elements, coords, name + "-" + str(n))
+        mons.append(mon)
+    return [mons]
+
+def synthetic_properties(mon, seed=0):
+    '''
+    Sets random but physically sized atomic properties of a System, for
+    timing the energy components without the property models
+    '''
+    rng = np.random.default_rng(seed)
+    mon.hirshfeld_ratios = rng.uniform(0.7, 1.0, mon.num_atoms)
+    mon.valence_widths = rng.uniform(0.35, 0.6, mon.num_atoms)
+    mon.multipoles = rng.normal(0.0, 0.2, (mon.num_atoms, 9))
+    return mon
+
+def models_available(models):
+    '''
+    Whether the KRR models of `cliff.load_krr_models` found their training
+    '''
+    return all(any(a is not None for a in model.alpha_train.values()) for model in models)
+
+
+def _stage_seconds(drained):
+    # summed cliff_stage_seconds of a `metrics.Registry.drain`
+    _, histograms = drained
+    return {dict(labels)['stage'] : hist['sum'] for (name, labels), hist in histograms.items()
+            if name == 'cliff_stage_seconds'}
+
+def _time(func, repeat):
+    '''
+    Runs func repeat times. Returns its last result, the wall times of the
+    runs and the times of the stages (see `metrics.timer`) of every run.
+    '''
+    runs, stages = [], {}
+    for _ in range(repeat):
+        metrics.registry.drain()
+        start = time.perf_counter()
+        ret = func()
+        runs.append(time.perf_counter() - start)
+        for stage, seconds in _stage_seconds(metrics.registry.drain()).items():
+            stages.setdefault(stage, []).append(seconds)
+    return ret, runs, stages
+
+def _entry(runs):
+    return {'seconds' : min(runs), 'mean' : float(np.mean(runs)), 'runs' : runs}
+
+def benchmark_set(dimers, options, models=None, load_path=None, repeat=3):
+    '''
+    Times the atomic properties and energy components of a set of dimers.
+    Properties are predicted with models if given, else loaded from
+    load_path, else synthetic (and not timed).
+
+    Returns
+    -------
+    timings : :class: `dict`
+        {stage : {'seconds' : best, 'mean' : mean, 'runs' : [seconds]}}
+    energies : :class: `list`
+        Summed [total, elst, exch, indu, disp] of the dimers (kcal/mol)
+    source : :class: `str`
+        Origin of the properties, 'models', 'load_path' or 'synthetic'
+    '''
+    timings = {}
+    mons = [mon for dimer in dimers for mon in dimer]
+    if models is not None:
+        source = 'models'
+        _, runs, stages = _time(lambda: cliff.predict_atomic_properties_batch(mons, models), repeat)
+    elif load_path is not None:
+        source = 'load_path'
+        _, runs, stages = _time(lambda: [cliff.load_atomic_properties(mon, load_path) for mon in mons], repeat)
+    else:
+        source = 'synthetic'
+        for n, mon in enumerate(mons):
+            synthetic_properties(mon, seed=n)
+    if source != 'synthetic':
+        timings['properties'] = _entry(runs)
+        for stage in ['slatm', 'krr_kernel']:
+            if stage in stages:
+                timings[stage] = _entry(stages[stage])
+
+    # energy components of the Systems, one dimer at a time
+    energies, runs, stages = _time(lambda: [cliff.energy_kernel(mon_a, mon_b, options) for mon_a, mon_b in dimers], repeat)
+    timings['energy'] = _entry(runs)
+    for stage in ['elst', 'exch', 'indu', 'disp']:
+        timings[stage] = _entry(stages[stage])
+
+    # the same on prepared monomers, all dimers at once
+    cell = Cell.lattice_parameters(100., 100., 100.)
+    prepared, runs, _ = _time(lambda: [(PreparedMonomer(options, mon_a, cell), PreparedMonomer(options, mon_b, cell))
+                                       for mon_a, mon_b in dimers], repeat)
+    timings['prepare'] = _entry(runs)
+    _, runs, _ = _time(lambda: batch_pair_energies([p[0] for p in prepared], [p[1] for p in prepared], options), repeat)
+    timings['batch'] = _entry(runs)
+
+    return timings, np.sum(energies, axis=0).tolist(), source
+
+def run_benchmarks(options, dimer_files=None, sizes=default_sizes, repeat=3, models=None, load_path=None):
+    '''
+    Times model loading (if models are given), and the properties and
+    energy components of the dimers in dimer_files and of the water and
+    alkane scaling series. The metrics of the process are kept.
+
+    Parameters
+    ----------
+    options : :class: `~cliff.helpers.Options`
+        Options
+    dimer_files : list of :class: `str`
+        Dimer xyz files, default the bundled dimer_data
+    sizes : list of :class: `int`
+        Monomer sizes of the scaling series
+    repeat : :class: `int`
+        Number of runs of every stage; the best one counts
+    models : list of :class:`~cliff.atomic_properties.Hirshfeld` ,`~cliff.atomic_properties.AtomicDensity`, and `~cliff.atomic_properties.Multipole`
+        KRR models, None for synthetic properties
+    load_path : :class: `str`
+        Directory of the properties of the dimer_files, used without models
+
+    Returns
+    -------
+    results : :class: `dict`
+        {'meta' : {...}, 'benchmarks' : {'set/stage' : {'seconds' : ...}},
+        'energies' : {set : [...]}, 'properties' : {set : source}}
+    '''
+    if dimer_files is None:
+        dimer_files = sorted(glob.glob(testpath + "/dimer_data/*.xyz"))
+
+    saved = metrics.registry.drain()
+    results = {'meta' : {'cliff' : cliff.__version__, 'python' : platform.python_version(),
+                         'numpy' : np.__version__, 'machine' : platform.machine(), 'cpus' : budget.cpu_count(),
+                         'threads' : budget.get_thread_budget(), 'component_threads' : options.component_threads,
+                         'repeat' : repeat, 'sizes' : list(sizes), 'date' : time.strftime('%Y-%m-%d %H:%M:%S')},
+               'benchmarks' : {}, 'energies' : {}, 'properties' : {}}
+    try:
+        if models is not None:
+            _, runs, _ = _time(lambda: cliff.load_krr_models(options), repeat)
+            results['benchmarks']['models/model_load'] = _entry(runs)
+
+        sets = []
+        dimers, runs, _ = _time(lambda: [cliff.read_dimer_xyz(f, options) for f in dimer_files], repeat)
+        results['benchmarks']['dimer_data/io_read'] = _entry(runs)
+        sets.append(('dimer_data', dimers, load_path))
+        for kind in ['water', 'alkane']:
+            for size in sizes:
+                sets.append(("%s-%d" % (kind, size), scaling_dimers(options, kind, size), None))
+
+        for name, dimers, path in sets:
+            timings, energies, source = benchmark_set(dimers, options, models, path, repeat)
+            for stage, entry in timings.items():
+                results['benchmarks'][name + '/' + stage] = entry
+            results['energies'][name] = energies
+            results['properties'][name] = source
+    finally:
+        metrics.registry.merge(saved)
+    return results
+
+def compare(results, baseline, tolerance=0.25, min_seconds=5e-3):
+    '''
+    Compares the best times of results to those of baseline (an earlier
+    result of `run_benchmarks`). A benchmark regresses when it's slower
+    than the baseline by more than the relative tolerance and by more than
+    min_seconds, which keeps very short stages from flagging on noise.
+    The baseline may have a 'tolerances' entry of {pattern : tolerance},
+    e.g. {'water-32/*' : 0.5}, matched against the benchmark names.
+    Energies from properties of the same source must agree to 1e-6.
+
+    Returns
+    -------
+    rows : list of :class: `dict`
+        One per benchmark in both, with name, baseline, seconds, ratio and
+        regression
+    failures : list of :class: `str`
+        Regressed benchmarks and changed energies
+    '''
+    rows, failures = [], []
+    tolerances = baseline.get('tolerances', {})
+    for name, entry in sorted(results['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            continue
+        tol = tolerance
+        for pattern, pattern_tol in tolerances.items():
+            if fnmatch.fnmatch(name, pattern):
+                tol = pattern_tol
+        base = baseline['benchmarks'][name]['seconds']
+        seconds = entry['seconds']
+        regression = seconds > base*(1 + tol) and seconds - base > min_seconds
+        rows.append({'name' : name, 'baseline' : base, 'seconds' : seconds,
+                     'ratio' : seconds/base if base > 0 else float('inf'), 'regression' : regression})
+        if regression:
+            failures.append("%s: %.4f s, baseline %.4f s" % (name, seconds, base))
+
+    for name, energies in sorted(results['energies'].items()):
+        if name not in baseline.get('energies', {}):
+            continue
+        if results['properties'][name] != baseline['properties'][name]:
+            continue
+        if not np.allclose(energies, baseline['energies'][name], rtol=0.0, atol=1e-6):
+            failures.append("%s: energies %s, baseline %s" % (name, energies, baseline['energies'][name]))
+    return rows, failures
+
+def print_results(results, rows=None, out=sys.stdout):
+    if rows is None:
+        for name, entry in sorted(results['benchmarks'].items()):
+            out.write("%-28s %10.4f s\n" % (name, entry['seconds']))
+        return
+    out.write("%-28s %12s %12s %8s\n" % ("benchmark", "baseline (s)", "current (s)", "ratio"))
+    for row in rows:
+        flag = "  REGRESSION" if row['regression'] else ""
+        out.write("%-28s %12.4f %12.4f %8.2f%s\n" % (row['name'], row['baseline'], row['seconds'], row['ratio'], flag))
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description="Benchmarks of CLIFF on the bundled dimers and on scaling series")
+    parser.add_argument('-i','--input', type=str, help='Location of input configuration file')
+    parser.add_argument('-d','--dimer', type=str, help='Directory of dimer xyz files (default: the bundled dimer_data)')
+    parser.add_argument('-o','--output', type=str, help='Write the results to this JSON file, e.g. to use as a baseline')
+    parser.add_argument('--baseline', type=str, help='Compare the results to this JSON file of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Relative slowdown tolerated against the baseline')
+    parser.add_argument('--min-seconds', type=float, default=5e-3, help='Absolute slowdown tolerated against the baseline')
+    parser.add_argument('-r','--repeat', type=int, default=3, help='Number of runs of every benchmark, the best one counts')
+    parser.add_argument('--sizes', type=int, nargs='+', help='Monomer sizes of the scaling series')
+    parser.add_argument('--quick', action='store_true', help='Only the small sizes of the scaling series')
+    parser.add_argument('--load-path', type=str, help='Load the properties of the dimers from this directory if there are no models')
+    parser.add_argument('-t','--threads', type=int, help='Total number of threads (default: all CPUs)')
+
+    return parser.parse_args()
+
+def main(inpt=None, dimer=None, output=None, baseline=None, tolerance=0.25, min_seconds=5e-3, repeat=3, sizes=None,
+         quick=False, load_path=None, nthread=None):
+    '''
+    Runs the benchmarks, writes and compares them. Returns 1 if a
+    benchmark regressed against the baseline, else 0.
+    '''
+    if inpt is None:
+        options = Options()
+    else:
+        options = Options(inpt)
+    if sizes is None:
+        sizes = quick_sizes if quick else default_sizes
+    dimer_files = None
+    if dimer is not None:
+        dimer_files = sorted(glob.glob(dimer + "/*.xyz"))
+        if len(dimer_files) == 0:
+            raise Exception("No dimer xyz files in %s" % dimer)
+
+    with cliff.set_nthread(nthread):
+        models = cliff.load_krr_models(options)
+        if not models_available(models):
+            sys.stdout.write("No KRR models in %s, using %s atomic properties\n"
+                             % (options.hirsh_training, "loaded" if load_path else "synthetic"))
+            models = None
+        results = run_benchmarks(options, dimer_files, sizes, repeat, models, load_path)
+
+    if output is not None:
+        with open(output, 'w') as ofile:
+            json.dump(results, ofile, indent=2)
+
+    if baseline is None:
+        print_results(results)
+        return 0
+    with open(baseline) as bfile:
+        base = json.load(bfile)
+    rows, failures = compare(results, base, tolerance, min_seconds)
+    print_results(results, rows)
+    for failure in failures:
+        sys.stdout.write("FAILED %s\n" % failure)
+    return 1 if len(failures) > 0 else 0
+
+if __name__ == "__main__":
+    args = init_args()
+    sys.exit(main(args.input, args.dimer, args.output, args.baseline, args.tolerance, args.min_seconds, args.repeat,
+                  args.sizes, args.quick, args.load_path, args.threads))
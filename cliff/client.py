@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+"""
+Command line client of the CLIFF evaluation server, see `cliff.server`.
+Sends dimer or monomer xyz files to a running server and writes the
+results like run_cliff.py does, without loading any models itself.
+
+    python -m cliff.client --socket /tmp/cliff.sock -d path/to/dimer/xyzs/ -n job
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+
+from cliff.server import Client, get_address
+from cliff.run_cliff import open_csv, write_row, write_frag_output
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description="Client of the CLIFF evaluation server")
+    parser.add_argument('-s','--socket', type=str, help='Path of the Unix socket of the server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host of the server with --port')
+    parser.add_argument('--port', type=int, help='TCP port of the server')
+    parser.add_argument('-d','--dimer', type=str, help='Directory of dimer xyz files, or an individual dimer xyz file')
+    parser.add_argument('-a','--monA', type=str, help='Monomer A xyz file')
+    parser.add_argument('-b','--monB', type=str, help='Monomer B xyz file')
+    parser.add_argument('-n','--name', type=str, default='output', help='Output job name')
+    parser.add_argument('-fr','--frag', action='store_true', help='Do fragmentation analysis')
+    parser.add_argument('--chunk-size', type=int, default=256, help='Number of dimers sent per request')
+    parser.add_argument('--ping', action='store_true', help='Only check that the server is up')
+    parser.add_argument('--shutdown', action='store_true', help='Stop the server')
+
+    return parser.parse_args()
+
+def main(address, dimer=None, monA=None, monB=None, name='output', frag=False, chunk_size=256):
+    '''
+    Evaluates the dimer xyz files in dimer, or the monomer lists monA and
+    monB, on the server at address and appends the results to name.csv.
+
+    Returns
+    -------
+    (labels, energies) as returned by run_cliff.py
+    '''
+    labels = []
+    energies = []
+    with Client(address) as client, open_csv(name) as cout:
+        if dimer is not None:
+            if os.path.isdir(dimer):
+                files = sorted(glob.glob(dimer + '/*.xyz'))
+            else:
+                files = [dimer]
+            for n in range(0, len(files), chunk_size):
+                chunk = files[n:n+chunk_size]
+                labs, ens = client.dimers(chunk, return_pairs=frag)
+                for f, lab, en in zip(chunk, labs, ens):
+                    if en is None:
+                        print(f"Cannot compute {lab[0][:-2]}")
+                        continue
+                    if frag:
+                        fa = f.split('.xyz')[0] + '-A-frag.dat'
+                        fb = f.split('.xyz')[0] + '-B-frag.dat'
+                        if os.path.isfile(fa) and os.path.isfile(fb):
+                            write_frag_output(fa, fb, name, en[1:], append=True)
+                        en = np.sum(en, axis=(1,2))
+                    labels.append(lab)
+                    energies.append(en)
+                    write_row(cout, lab, en)
+                cout.flush()
+        elif monA is not None and monB is not None:
+            labs, ens = client.monomers(monA, monB, return_pairs=frag)
+            if frag:
+                fa = monA.split('.xyz')[0] + '-frag.dat'
+                fb = monB.split('.xyz')[0] + '-frag.dat'
+                written = False
+                for pairs in ens:
+                    if pairs is not None:
+                        write_frag_output(fa, fb, name, pairs[1:], append=written)
+                        written = True
+                ens = [None if pairs is None else np.sum(pairs, axis=(1,2)) for pairs in ens]
+            for lab, en in zip(labs, ens):
+                if en is not None:
+                    write_row(cout, lab, en)
+            labels = labs
+            energies = ens
+        else:
+            raise Exception("Specify a dimer, or monomers A and B")
+
+    return labels, energies
+
+if __name__ == "__main__":
+    args = init_args()
+    address = get_address(args.socket, args.host, args.port)
+    if args.ping or args.shutdown:
+        with Client(address) as client:
+            print(client.shutdown() if args.shutdown else client.ping())
+    else:
+        main(address, args.dimer, args.monA, args.monB, args.name, args.frag, args.chunk_size)
@@ -34,6 +34,8 @@ class Electrostatics:
         self.sys_comb = sys
         self.exp = options.elst_damping_exponents
 
+        # atom-pairwise energies in at_elst; set to False when only the total
+        # is needed, see `cliff.energy_kernel`
         self.decompose = True
         self.at_elst = np.zeros((0,0))
 
@@ -52,20 +54,18 @@ class Electrostatics:
     def get_mtp_coefficients(self, stone_convention):
         'Convert spherical MTPs to cartesian'
         num_atoms = [sys.num_atoms for sys in self.systems]
-        atom_ele = []
 
         # q={0,1,2} => 1+3+9 = 13 parameters
         for sys in range(len(self.systems)):
             self.mtps_cart.append(np.zeros((num_atoms[sys],13)))
        #     self.mtps_cart_elec.append(np.zeros((num_atoms[sys],13))
-            atom_ele.append([ele for ele in self.systems[sys].elements])
         for s1,sys in enumerate(self.systems):
             if len(sys.multipoles) == 0:
                 print("Multipoles not initialized for system!")
                 exit(1)
 
             for i in range(sys.num_atoms):
-                self.mtps_cart[s1][i][0] = sys.multipoles[i][0] - constants.atomic_number[atom_ele[s1][i]] 
+                self.mtps_cart[s1][i][0] = sys.multipoles[i][0] - sys.Z[i]
 
                 # temporary fix to work with both cart (from NN) and sphere (from KRR)
                 if len(sys.multipoles[i]) == 13:   
@@ -88,81 +88,55 @@ class Electrostatics:
 
         nsys = len(self.systems)
         self.get_mtp_coefficients(stone_convention)
-        # Setup list of atoms to sum over
-        atom_coord = []
-        atom_ele = []
-        atom_nums = []
-        alphas = []
-
-        for sys in self.systems:
-            atom_coord.append([crd for crd in sys.coords])
-            atom_ele.append([ele for ele in sys.elements])
-            atom_nums.append([constants.atomic_number[ele] for ele in sys.elements])
-            alphas.append([self.exp[ele]*constants.b2a for ele in sys.atom_types])
+        atom_nums = [sys.Z.astype(float) for sys in self.systems]
+        alphas = [sys.type_params(self.exp)*constants.b2a for sys in self.systems]
 
         elst = 0.0
-        elst1 = 0.0
-        elst2 = 0.0
-        elst3 = 0.0
         # Loop over unique interactions
         for s1 in range(nsys):
-            # this is a matrix, natom x 13
-            # contains ALL multipoles for sys 1
-            mi = self.mtps_cart[ s1]
             for s2 in range(s1+1, nsys):
-                mj = self.mtps_cart[s2]
-
-                # 1. nuclear-nuclear int
-                r = constants.a2b * utils.build_r(atom_coord[s1],atom_coord[s2],self.cell)
-                r = 1.0 / r
+                vec = constants.a2b * self.cell.pbc_distances(self.systems[s1].coords, self.systems[s2].coords)
+                # the pair energies are only kept when asked for, otherwise
+                # they're summed as they're computed
+                en = damped_mtp_pair_energies(vec, atom_nums[s1], atom_nums[s2], self.mtps_cart[s1],
+                                              self.mtps_cart[s2], alphas[s1], alphas[s2], pairs=self.decompose)
                 if self.decompose:
-                    self.at_elst = np.zeros((len(atom_nums[s1]),len(atom_nums[s2])))
-                    for i,a in enumerate(atom_nums[s1]):
-                        for j,b in enumerate(atom_nums[s2]): 
-                            self.at_elst[i,j] = r[i,j]*a*b
-
-                elst0 =  np.dot(atom_nums[s1], np.matmul(r,atom_nums[s2]))
-
-                # 2. nuclear-MTP interaction
-                ## TODO: avoid this loop over atoms in sys
-                for ele, Z in enumerate(atom_nums[s1]):
-                    zm_int = charge_mtp_damped_interaction(atom_coord[s1][ele], atom_coord[s2], alphas[s2], self.cell)
-                    i1 = Z*np.einsum('ij,ij->i', zm_int,mj)
-                    elst1 += np.sum(i1)
-                    if self.decompose:
-                        for n, value in enumerate(i1):
-                            self.at_elst[ele,n] += value
-
-                for ele, Z in enumerate(atom_nums[s2]):
-                    zm_int = charge_mtp_damped_interaction(atom_coord[s2][ele], atom_coord[s1], alphas[s1], self.cell)
-                    i1 = Z*np.einsum('ij,ij->i', zm_int,mi)
-                    elst2 += np.sum(i1)
-                    if self.decompose:
-                        for n, value in enumerate(i1):
-                            self.at_elst[n,ele] += value
-
-                # 3. MTP-MTP
-                for atom1 in range(len(atom_nums[s1])):
-                    crdi = atom_coord[s1][atom1]        
-                    alpha1 = alphas[s1][atom1]
-                    mi1 = mi[atom1,:] 
-                    for atom2 in range(len(atom_nums[s2])):
-                        crdj = atom_coord[s2][atom2]        
-                        alpha2 = alphas[s2][atom2]
-                        mj1 = mj[atom2,:] 
-                        d_int = full_damped_interaction(crdi, crdj, alpha1, alpha2, self.cell)
-                        value = np.dot(mi1.T, np.dot(d_int, mj1)) 
-                        elst3 += value
-                        if self.decompose:
-                            self.at_elst[atom1,atom2] += value
-
-        elst += (elst0 + elst1 + elst2 + elst3)
-                    
+                    self.at_elst = en * constants.au2kcalmol
+                elst += np.sum(en)
 
         self.energy_elst = elst * constants.au2kcalmol
-        self.at_elst *= constants.au2kcalmol
         return self.energy_elst
 
+    def mtp_energy_gradient(self, stone_convention=False):
+        '''
+        Electrostatic energy and its derivative with respect to the
+        damping exponent of each atom type (kcal/mol), with the types
+        ordered as in System.master_atom_types.
+        '''
+        nsys = len(self.systems)
+        self.mtps_cart = []
+        self.get_mtp_coefficients(stone_convention)
+
+        ntypes = len(self.systems[0].master_atom_types)
+        atom_nums = [sys.Z.astype(float) for sys in self.systems]
+        alphas = [sys.type_params(self.exp)*constants.b2a for sys in self.systems]
+        types = [sys.type_index.astype(int) for sys in self.systems]
+
+        elst = 0.0
+        grad = np.zeros(ntypes)
+        for s1 in range(nsys):
+            for s2 in range(s1+1, nsys):
+                vec = constants.a2b * self.cell.pbc_distances(self.systems[s1].coords, self.systems[s2].coords)
+                en, d1, d2 = damped_mtp_pair_energies(vec, atom_nums[s1], atom_nums[s2],
+                                self.mtps_cart[s1], self.mtps_cart[s2], alphas[s1], alphas[s2], deriv=True)
+                elst += np.sum(en)
+                grad += np.bincount(types[s1], weights=d1, minlength=ntypes)
+                grad += np.bincount(types[s2], weights=d2, minlength=ntypes)
+
+        # alpha = exp * b2a
+        grad *= constants.b2a * constants.au2kcalmol
+        return elst * constants.au2kcalmol, grad
+
 def nuclear_rep(at_elst, coord1, coord2, ele1, ele2, cell):
 
     r = constants.a2b * utils.build_r(coord1,coord2,cell)
@@ -475,3 +449,315 @@ def interaction_tensor(coord1, coord2, cell):
             it[i,j] *= -1.
     return it
  
+
+
+# Polynomial prefactors, in x = alpha*r, of the exponentials in the damping
+# factors lam1, lam3, ..., lam9 of `full_damped_interaction`, for different
+# and for equal exponents on the two sites
+damping_polys = [[1.0],
+                 [1.0, 1.0],
+                 [1.0, 1.0, 1.0/3.0],
+                 [1.0, 1.0, 2.0/5.0, 1.0/15.0],
+                 [1.0, 1.0, 3.0/7.0, 2.0/21.0, 1.0/105.0]]
+damping_polys_equal = [[1.0, 0.5],
+                       [1.0, 1.0, 0.5],
+                       [1.0, 1.0, 0.5, 1.0/6.0],
+                       [1.0, 1.0, 0.5, 1.0/6.0, 1.0/30.0],
+                       [1.0, 1.0, 0.5, 1.0/6.0, 4.0/105.0, 1.0/210.0]]
+# charge-multipole damping factors lam_1, lam_3, lam_5
+charge_damping_polys = [[1.0],
+                        [1.0, 1.0],
+                        [1.0, 1.0, 1.0/3.0]]
+
+def _poly(coeffs, x):
+    return sum(c * x**k for k, c in enumerate(coeffs))
+
+def _dpoly(coeffs, x):
+    return sum(k * c * x**(k-1) for k, c in enumerate(coeffs) if k > 0)
+
+def _row_blocks(n1, n2, max_pairs=10000):
+    """Slices over the first system that bound the number of pairs held at once"""
+    step = max(1, max_pairs // max(n2, 1))
+    for start in range(0, n1, step):
+        yield slice(start, min(start + step, n1))
+
+def damping_lambdas(r, alpha1, alpha2, deriv=False):
+    """
+    Damping factors [lam1, lam3, lam5, lam7, lam9] of `full_damped_interaction`,
+    elementwise over broadcastable arrays of distances and exponents.
+    With deriv=True, also returns their derivatives with respect to alpha1
+    and to alpha2. For (nearly) equal exponents, where only the symmetric
+    limit is defined, the total derivative is split evenly.
+    """
+    r, alpha1, alpha2 = np.broadcast_arrays(r, alpha1, alpha2)
+    equal = np.abs(alpha1 - alpha2) <= 1e-6
+    x1 = alpha1*r
+    x2 = alpha2*r
+    e1r = np.exp(-x1)
+    e2r = np.exp(-x2)
+    a1_2 = alpha1*alpha1
+    a2_2 = alpha2*alpha2
+
+    den = np.where(equal, 1.0, a2_2 - a1_2)
+    A = a2_2 / den
+    B = -a1_2 / den
+    dA1 = 2.0*alpha1*a2_2 / (den*den)
+    dB2 = 2.0*alpha2*a1_2 / (den*den)
+
+    lams = []
+    dlam1 = []
+    dlam2 = []
+    for c, c_eq in zip(damping_polys, damping_polys_equal):
+        p1 = _poly(c, x1)*e1r
+        p2 = _poly(c, x2)*e2r
+        q = _poly(c_eq, x1)*e1r
+        lams.append(np.where(equal, 1.0 - q, 1.0 - A*p1 - B*p2))
+        if deriv:
+            dq = -0.5 * r * (_dpoly(c_eq, x1)*e1r - q)
+            d1 = -(dA1*(p1 - p2) + A * r * (_dpoly(c, x1)*e1r - p1))
+            d2 = -(dB2*(p2 - p1) + B * r * (_dpoly(c, x2)*e2r - p2))
+            dlam1.append(np.where(equal, dq, d1))
+            dlam2.append(np.where(equal, dq, d2))
+
+    if deriv:
+        return lams, dlam1, dlam2
+    return lams
+
+def charge_mtp_lambdas(r, alpha, deriv=False):
+    """
+    Damping factors [lam_1, lam_3, lam_5] of `charge_mtp_damped_interaction`
+    and, with deriv=True, their derivatives with respect to alpha
+    """
+    r, alpha = np.broadcast_arrays(r, alpha)
+    x = alpha*r
+    exr = np.exp(-x)
+    lams = [1.0 - _poly(c, x)*exr for c in charge_damping_polys]
+    if deriv:
+        dlams = [-r * (_dpoly(c, x) - _poly(c, x))*exr for c in charge_damping_polys]
+        return lams, dlams
+    return lams
+
+def _symmetrize(it):
+    """Fill the lower triangle and flip the signs of odd-rank couplings"""
+    it = it + np.swapaxes(it, -1, -2)
+    diag = np.arange(13)
+    it[..., diag, diag] *= 0.5
+    it[..., 1:4, 0] *= -1.
+    it[..., 4:13, 1:4] *= -1.
+    return it
+
+def damped_interaction_tensors(vec, lam1, lam3, lam5, lam7, lam9):
+    """
+    Vectorized `full_damped_interaction`: (...,13,13) tensors for pair vectors
+    vec (...,3) in bohr. The tensors are linear in the damping factors,
+    so passing derivatives of the factors gives derivative tensors.
+    """
+    r = np.linalg.norm(vec, axis=-1)
+    ri = 1./r
+    ri3 = ri**3
+    ri5 = ri**5
+    ri7 = ri**7
+    ri9 = ri**9
+    x = vec[...,0]
+    y = vec[...,1]
+    z = vec[...,2]
+    x2 = x**2
+    y2 = y**2
+    z2 = z**2
+    x3 = x2*x 
+    y3 = y2*y
+    z3 = z2*z
+    x4 = x2**2
+    y4 = y2**2
+    z4 = z2**2
+
+    it = np.zeros(vec.shape[:-1] + (13,13))
+
+    # charge-charge
+    it[...,0,0] = ri * lam1
+    # charge-dipole
+    for a in [1,2,3]:
+        it[...,0,a] = -1.0 * vec[...,a-1] * ri3 * lam3     
+    # charge-quadrupole
+    it[...,0,4] = lam5*3.0*x2*ri5 - lam3*ri3
+    it[...,0,5] = lam5*3.0*x*y*ri5
+    it[...,0,6] = lam5*3.0*x*z*ri5
+    it[...,0,7] = it[...,0,5]
+    it[...,0,8] = lam5*3.0*y2*ri5 - lam3*ri3
+    it[...,0,9] = lam5*3.0*y*z*ri5
+    it[...,0,10] = it[...,0,6]
+    it[...,0,11] = it[...,0,9]
+    it[...,0,12] = lam5*3.0*z2*ri5 - lam3*ri3
+    # dipole-dipole
+    it[...,1,1] = -it[...,0,4]
+    it[...,1,2] = -it[...,0,5]
+    it[...,1,3] = -it[...,0,6]
+    it[...,2,2] = -it[...,0,8]
+    it[...,2,3] = -it[...,0,9]
+    it[...,3,3] = -it[...,1,1] -it[...,2,2]
+    # dipole-quadrupole
+    it[...,1,4] = 15.0*x3*ri7*lam7 - 9*x*ri5*lam5
+    it[...,1,5] = 15*x2*y*ri7*lam7 - 3*y*ri5*lam5
+    it[...,1,7] = it[...,2,4] = it[...,1,5]
+    it[...,1,6] = 15*x2*z*ri7*lam7 - 3*z*ri5*lam5
+    it[...,1,10] = it[...,3,4] = it[...,1,6]
+    it[...,1,8] = 15*x*y2*ri7*lam7 - 3*x*ri5*lam5
+    it[...,2,5] = it[...,2,7] = it[...,1,8]
+    it[...,1,9] = 15*x*y*z*ri7*lam7
+    it[...,1,11] = it[...,2,6] = it[...,2,10] = it[...,3,5] = it[...,3,7] = it[...,1,9]
+    it[...,1,12] = -it[...,1,4] -it[...,1,8]
+    it[...,3,6] = it[...,3,10] = it[...,1,12]
+    it[...,2,8] = 15*y3*ri7*lam7 - 9*y*ri5*lam5
+    it[...,2,9] = 15*y2*z*ri7*lam7 - 3*z*ri5*lam5
+    it[...,2,11] = it[...,3,8] = it[...,2,9]
+    it[...,2,12] = -it[...,1,5] -it[...,2,8]
+    it[...,3,9] = it[...,3,11] = it[...,2,12]
+    it[...,3,12] = -it[...,1,6] -it[...,2,9]
+    # quadrupole-quadrupole
+    it[...,4,4] = 105*x4*ri9*lam9 - 90*x2*ri7*lam7 + 9*ri5*lam5
+    it[...,4,5] = 105*x3*y*ri9*lam9 - 45*x*y*ri7*lam7
+    it[...,4,7] = it[...,4,5]
+    it[...,4,6] = 105*x3*z*ri9*lam9 - 45*x*z*ri7*lam7
+    it[...,4,10] = it[...,4,6]
+    it[...,4,8] = 105*x2*y2*ri9*lam9 - (15*x2 + 15*y2)*ri7*lam7 + 3*ri5*lam5
+    it[...,5,5] = it[...,5,7] = it[...,7,7] = it[...,4,8]
+    it[...,4,9] = 105*x2*y*z*ri9*lam9 - 15*z*y*ri7*lam7
+    it[...,4,11] = it[...,5,6] = it[...,5,10] = it[...,6,7] = it[...,7,10] = it[...,4,9]
+    it[...,4,12] = -it[...,4,4] -it[...,4,8]
+    it[...,6,6] = it[...,6,10] = it[...,10,10] = it[...,4,12]
+    it[...,5,8] = 105*y3*x*ri9*lam9 - 45*x*y*ri7*lam7
+    it[...,7,8] = it[...,5,8]
+    it[...,5,9] = 105*y2*x*z*ri9*lam9 - 15*x*z*ri7*lam7
+    it[...,5,11] = it[...,6,8] = it[...,7,9] = it[...,7,11] = it[...,8,10] = it[...,5,9]
+    it[...,5,12] = -it[...,4,5] -it[...,5,8]
+    it[...,6,9] = it[...,6,11] = it[...,7,12] = it[...,9,10] = it[...,10,11] = it[...,5,12]
+    it[...,6,12] = -it[...,4,6] -it[...,5,9]
+    it[...,10,12] = it[...,6,12]
+    it[...,8,8] = 105*y4*ri9*lam9 - 90*y2*ri7*lam7 + 9*ri5*lam5
+    it[...,8,9] = 105*y3*z*ri9*lam9 - 45*y*z*ri7*lam7
+    it[...,8,11] = it[...,8,9]
+    it[...,8,12] = -it[...,4,8] -it[...,8,8]
+    it[...,9,9] = it[...,9,11] = it[...,11,11] = it[...,8,12]
+    it[...,9,12] = -it[...,4,9] -it[...,8,9]
+    it[...,11,12] = it[...,9,12]
+    it[...,12,12] = 105*z4*ri9*lam9 - 90*z2*ri7*lam7 + 9*ri5*lam5
+
+    return _symmetrize(it)
+
+def interaction_tensors(vec):
+    """
+    Vectorized `interaction_tensor`: undamped (...,13,13) tensors for
+    pair vectors vec (...,3)
+    """
+    one = np.ones(vec.shape[:-1])
+    return damped_interaction_tensors(vec, one, one, one, one, one)
+
+def charge_mtp_damped_tensors(vec, lam_1, lam_3, lam_5):
+    """
+    Vectorized `charge_mtp_damped_interaction`: (...,13) charge-multipole
+    vectors for pair vectors vec (...,3) in bohr, pointing from the charge
+    to the multipole site. Linear in the damping factors.
+    """
+    r = np.linalg.norm(vec, axis=-1)
+    ri = 1./r
+    ri3 = ri**3
+    ri5 = ri**5
+    x = vec[...,0]
+    y = vec[...,1]
+    z = vec[...,2]
+
+    it = np.zeros(vec.shape[:-1] + (13,))
+    it[...,0] = ri*lam_1
+    it[...,1] = -x*ri3 * lam_3 
+    it[...,2] = -y*ri3 * lam_3
+    it[...,3] = -z*ri3 * lam_3
+    it[...,4] = 3*x**2*ri5*lam_5 - ri3*lam_3
+    it[...,5] = 3*x*y*ri5*lam_5
+    it[...,6] = 3*x*z*ri5*lam_5
+    it[...,7] = it[...,5]
+    it[...,8] = 3*y**2*ri5*lam_5 - ri3*lam_3
+    it[...,9] = 3*y*z*ri5*lam_5
+    it[...,10] = it[...,6]
+    it[...,11] = it[...,9]
+    it[...,12] = 3*z**2*ri5*lam_5 - ri3*lam_3
+    return it
+
+def damped_mtp_pair_energies(vec, Z1, Z2, m1, m2, alpha1, alpha2, deriv=False, pairs=True):
+    """
+    Charge-penetration corrected multipole energies (au) between every atom
+    pair of two systems, as summed in `Electrostatics.mtp_energy`.
+
+    Parameters
+    ----------
+    vec : :class: `~numpy.ndarray`
+        (n1,n2,3) minimum-image vectors in bohr from atoms of 1 to atoms of 2.
+        All arrays may carry the same leading batch dimensions, e.g.
+        (batch,n1,n2,3) with Z1 (batch,n1), as in `cliff.components.batch`
+    Z1, Z2 : :class: `~numpy.ndarray`
+        Nuclear charges
+    m1, m2 : :class: `~numpy.ndarray`
+        (n,13) cartesian multipoles of the electrons
+    alpha1, alpha2 : :class: `~numpy.ndarray`
+        Damping exponents in bohr^-1
+    deriv : :class: `bool`
+        Also return dE/dalpha1 (n1,) and dE/dalpha2 (n2,), summed over all pairs
+    pairs : :class: `bool`
+        If False, the pair energies are summed inside the contractions and
+        only their total is returned, without the (n1,n2) intermediates
+
+    Returns
+    -------
+    en : :class: `~numpy.ndarray`
+        (n1,n2) pair energies, or their sum (leading batch dimensions only)
+        if not pairs
+    """
+    n1, n2 = vec.shape[-3:-1]
+    en = np.zeros(vec.shape[:-1] if pairs else vec.shape[:-3])
+    d1 = np.zeros(Z1.shape)
+    d2 = np.zeros(Z2.shape)
+
+    for rows in _row_blocks(n1, n2*int(np.prod(vec.shape[:-3]))):
+        v = vec[...,rows,:,:]
+        r = np.linalg.norm(v, axis=-1)
+
+        def add(subscripts, *operands):
+            # adds the (...,a,b) pair terms, or their sum
+            if pairs:
+                en[...,rows,:] += np.einsum(subscripts + '->...ab', *operands)
+            else:
+                en[...] += np.einsum(subscripts + '->...', *operands)
+
+        # 1. nuclear-nuclear
+        add('...a,...ab,...b', Z1[...,rows], 1.0 / r, Z2)
+
+        # 2. nuclei of 1 with multipoles of 2 and vice versa
+        lams = charge_mtp_lambdas(r, alpha2[...,None,:], deriv)
+        lam = lams[0] if deriv else lams
+        zm = charge_mtp_damped_tensors(v, *lam)
+        add('...a,...abk,...bk', Z1[...,rows], zm, m2)
+        if deriv:
+            zm = charge_mtp_damped_tensors(v, *lams[1])
+            d2 += np.einsum('...a,...abk,...bk->...b', Z1[...,rows], zm, m2)
+
+        lams = charge_mtp_lambdas(r, alpha1[...,rows,None], deriv)
+        lam = lams[0] if deriv else lams
+        zm = charge_mtp_damped_tensors(-v, *lam)
+        add('...b,...abk,...ak', Z2, zm, m1[...,rows,:])
+        if deriv:
+            zm = charge_mtp_damped_tensors(-v, *lams[1])
+            d1[...,rows] += np.einsum('...b,...abk,...ak->...a', Z2, zm, m1[...,rows,:])
+
+        # 3. MTP-MTP
+        lams = damping_lambdas(r, alpha1[...,rows,None], alpha2[...,None,:], deriv)
+        lam = lams[0] if deriv else lams
+        it = damped_interaction_tensors(v, *lam)
+        add('...ak,...abkl,...bl', m1[...,rows,:], it, m2)
+        if deriv:
+            it = damped_interaction_tensors(v, *lams[1])
+            d1[...,rows] += np.einsum('...ak,...abkl,...bl->...a', m1[...,rows,:], it, m2)
+            it = damped_interaction_tensors(v, *lams[2])
+            d2 += np.einsum('...ak,...abkl,...bl->...b', m1[...,rows,:], it, m2)
+
+    if deriv:
+        return en, d1, d2
+    return en
@@ -2,7 +2,7 @@
 
 import numpy as np
 from cliff.helpers.system import System
-from cliff.components.electrostatics import Electrostatics, interaction_tensor
+from cliff.components.electrostatics import Electrostatics, interaction_tensor, interaction_tensors, _row_blocks
 from cliff.atomic_properties.polarizability import Polarizability
 #from cliff.helpers.cell import Cell
 from numpy import exp
@@ -11,6 +11,8 @@ from copy import deepcopy
 import logging
 import cliff.helpers.constants as constants
 import cliff.helpers.utils as utils
+import cliff.helpers.metrics as metrics
+import cliff.helpers.tracing as tracing
 import time
 
 
@@ -37,6 +39,7 @@ class InductionCalc(Electrostatics):
         self.scs_cutoff = options.pol_scs_cutoff
         self.pol_exponent = options.pol_exponent
         
+        # atom-pairwise energies in at_ind, see `Electrostatics`
         self.decompose = True
         self.at_ind = np.zeros((0,0))
 
@@ -67,13 +70,12 @@ class InductionCalc(Electrostatics):
 
             # Atomic polarizabilities
             atom_alpha_iso.append([alpha for alpha in Polarizability(self.name, self.logger,self.scs_cutoff,self.pol_exponent,sys).get_pol_scaled()])
-            ind_params.append([self.ind_sr[i] for i in sys.atom_types]) 
+            ind_params.append(sys.type_params(self.ind_sr))
 
         # Compute the short-range correction
         # This is done with U_aU_b*S(a,b,r),
         # which is the same formalism as exchange
         self.energy_shortranged = 0.0 
-        start_sr = time.time()
         for s1 in range(nsys):
             for s2 in range(s1+1, nsys):
                 r = utils.build_r(atom_coord[s1], atom_coord[s2], self.cell)
@@ -87,18 +89,13 @@ class InductionCalc(Electrostatics):
                 u_2 = self.build_u(r2, atom_alpha_iso[s2], atom_alpha_iso[s2])
 
                 if self.decompose:
-                    self.at_ind = np.zeros((len(atom_coord[s1]), len(atom_coord[s2])))
-                    for i in range(len(atom_coord[s1])): 
-                        for j in range(len(atom_coord[s2])): 
-                            self.at_ind[i,j] = -1.0 * ovp[i,j] * ind_params[s1][i] * ind_params[s2][j] * constants.au2kcalmol
-                    
+                    self.at_ind = -1.0 * ovp * np.outer(ind_params[s1], ind_params[s2]) * constants.au2kcalmol
+
 
         self.energy_shortranged *= constants.au2kcalmol
-        end_sr = time.time()
 
 
         ###  Compute the induction term using Thole's formalism
-        start_pol = time.time()
         if smearing_coeff != None:
             self.smearing_coeff = smearing_coeff 
 
@@ -108,8 +105,7 @@ class InductionCalc(Electrostatics):
 
         # fix the charges
         for s,sys in enumerate(self.systems):
-            for i in range(sys.num_atoms):
-                self.mtps_cart[s][i][0] += constants.atomic_number[atom_ele[s][i]]
+            self.mtps_cart[s][:,0] += sys.Z
 
         # Gather intramonomer dipole interaction tensors  for later too
         T_dd_1_self = [] 
@@ -139,9 +135,7 @@ class InductionCalc(Electrostatics):
 
                     T_dd_2_self.append(self.build_self_dip_int_tensor(atom_coord[s2][i], atom_coord[s2], u_2[i,:], self.smearing_coeff))
 
-        end_init = time.time()
 
-        #logger.info("init: %6.3f" % (end_init - start_pol))
         # Self-consistent polarization
         #mu_next = np.copy(induced_dip)
         mu_next = []
@@ -158,6 +152,7 @@ class InductionCalc(Electrostatics):
             diff_init += np.linalg.norm(mu_next[n]-mu_prev[n])
     
         counter = 0
+        start = time.perf_counter()
 
         # Compute the induced dipoles
         # We already have the interaction tensors
@@ -185,10 +180,16 @@ class InductionCalc(Electrostatics):
                 diff += np.linalg.norm(mu_next[n]-mu_prev[n])
             if diff > diff_init*10 or counter > 2000:
                 self.logger.info("Can't converge self-consistent equations. Exiting.")
+                record_induction(counter, diff, False)
+                tracing.add_span('induction_iterations', start, natom=sum(sys.num_atoms for sys in self.systems),
+                                 iterations=counter, residual=diff, converged=False)
                 #exit(1)
                 return False
             if counter % 50 == 0 and self.omega > 0.2:
                 self.omega *= 0.8
+        record_induction(counter, diff, True)
+        tracing.add_span('induction_iterations', start, natom=sum(sys.num_atoms for sys in self.systems),
+                         iterations=counter, residual=diff, converged=True)
 
         #self.induced_dip = np.zeros(np.shape(self.mtps_cart))
         self.induced_dip = []
@@ -207,32 +208,98 @@ class InductionCalc(Electrostatics):
         self.energy_polarization = 0.0
         for s1 in range(nsys):
             for s2 in range(s1+1,nsys):
-                for atom1 in range(len(atom_ele[s1])):
-                    crdi = atom_coord[s1][atom1]        
-                    mi1 = self.mtps_cart[s1][atom1,:] 
-                    mind_1 = self.induced_dip[s1][atom1,:]
-                    for atom2 in range(len(atom_ele[s2])):
-                        crdj = atom_coord[s2][atom2]        
-                        mj2 = self.mtps_cart[s2][atom2,:] 
-                        mind_2 = self.induced_dip[s2][atom2,:]
-                        T = interaction_tensor(crdi, crdj,self.cell)
-
-                        en = np.dot(mind_1.T,np.dot(T, mj2)) + np.dot(mi1.T,np.dot(T, mind_2))
-                        self.energy_polarization += en 
-                        if self.decompose:
-                            self.at_ind[atom1,atom2] += en*0.5*constants.au2kcalmol
-                        
-
-        self.energy_polarization *= 0.5 * constants.au2kcalmol 
-
-
-        end_pol = time.time()
+                en = induced_pair_energies(self.cell.pbc_distances(atom_coord[s1], atom_coord[s2]), self.mtps_cart[s1],
+                                           self.mtps_cart[s2], mu_next[s1], mu_next[s2], pairs=self.decompose)
+                self.energy_polarization += np.sum(en)
+                if self.decompose:
+                    self.at_ind += en*constants.au2kcalmol
+
+        self.energy_polarization *= constants.au2kcalmol 
+
+
         #logger.debug("Polarization energy: %7.4f kcal/mol" % self.energy_polarization)
         #print("Polarization energy: %7.4f kcal/mol" % self.energy_polarization)
         #print "Short range", self.energy_shortranged
         #print(str(self.sys_comb)[:-1],self.energy_polarization , self.energy_shortranged)
         return self.energy_polarization - self.energy_shortranged
 
+    def polarization_energy_gradient(self, smearing_coeff=None, stone_convention=False):
+        """
+        Thole polarization energy (kcal/mol) of a dimer and its derivative
+        with respect to the smearing coefficient.
+
+        Solves the same self-consistent equations as `polarization_energy`,
+        with the interaction tensors of all atom pairs assembled at once.
+        The derivative follows from the adjoint of the converged equations,
+        so it costs one extra linear solve. The short-range correction is
+        not included; it is bilinear in the SR parameters (see
+        `cliff.fit.load_fit_data`). Returns (0.0, 0.0) if the equations
+        don't converge, in line with the energy left by `polarization_energy`.
+        """
+        if smearing_coeff != None:
+            self.smearing_coeff = smearing_coeff 
+        smear = self.smearing_coeff
+
+        self.mtps_cart = []
+        self.get_mtp_coefficients(stone_convention=False)
+
+        coords = []
+        pols = []
+        mtps = []
+        for s, sys in enumerate(self.systems[:2]):
+            coords.append(np.asarray(sys.coords)*constants.a2b)
+            pols.append(np.asarray(Polarizability(self.name, self.logger,self.scs_cutoff,self.pol_exponent,sys).get_pol_scaled()))
+            mtp = np.copy(self.mtps_cart[s])
+            mtp[:,0] += sys.Z
+            mtps.append(mtp)
+        n1 = len(coords[0])
+        n2 = len(coords[1])
+
+        vec = self.cell.pbc_distances(coords[0], coords[1])
+        vec_1 = self.cell.pbc_distances(coords[0], coords[0])
+        vec_2 = self.cell.pbc_distances(coords[1], coords[1])
+        u = self.build_u(np.linalg.norm(vec, axis=-1), pols[0], pols[1])
+        u_1 = self.build_u(np.linalg.norm(vec_1, axis=-1), pols[0], pols[0])
+        u_2 = self.build_u(np.linalg.norm(vec_2, axis=-1), pols[1], pols[1])
+
+        lams, dlams = thole_lambdas(u, smear, deriv=True)
+        lams_1, dlams_1 = thole_lambdas(u_1, smear, deriv=True)
+        lams_2, dlams_2 = thole_lambdas(u_2, smear, deriv=True)
+
+        alpha = np.repeat(np.concatenate(pols), 3)
+
+        def response(lams, lams_1, lams_2):
+            'Field of the permanent multipoles and dipole coupling matrix'
+            T_1 = thole_int_tensors(vec, *lams)
+            T_2 = thole_int_tensors(-vec, *lams)
+            field = np.concatenate((np.einsum('abjk,bk->aj', T_1, mtps[1]),
+                                    np.einsum('abjk,ak->bj', T_2, mtps[0]))).flatten()
+            K = np.zeros((n1+n2,3,n1+n2,3))
+            K[:n1,:,:n1,:] = thole_self_dip_tensors(vec_1, *lams_1[:2]).transpose(0,2,1,3)
+            K[:n1,:,n1:,:] = T_1[...,1:4].transpose(0,2,1,3)
+            K[n1:,:,:n1,:] = T_2[...,1:4].transpose(1,2,0,3)
+            K[n1:,:,n1:,:] = thole_self_dip_tensors(vec_2, *lams_2[:2]).transpose(0,2,1,3)
+            return alpha * field, K.reshape((3*(n1+n2), 3*(n1+n2)))
+
+        field, K = response(lams, lams_1, lams_2)
+        mu = solve_induced_dipoles(K, alpha, field, 3*n1, self.omega, self.conv)
+        if mu is None:
+            self.logger.info("Can't converge self-consistent equations. Exiting.")
+            return 0.0, 0.0
+
+        # the energy is linear in the induced dipoles
+        T = interaction_tensors(vec)
+        g = np.concatenate((np.einsum('abik,bk->ai', T[...,1:4,:], mtps[1]),
+                            np.einsum('ak,abki->bi', mtps[0], T[...,:,1:4]))).flatten()
+        self.energy_polarization = 0.5 * constants.au2kcalmol * np.dot(g, mu)
+
+        # adjoint: dE/ds = lam^T (alpha dK mu + dF), with (1 - alpha K)^T lam = g
+        dfield, dK = response(dlams, dlams_1, dlams_2)
+        lam = np.linalg.solve(np.eye(len(alpha)) - K.T*alpha[None,:], g)
+        grad = 0.5 * constants.au2kcalmol * np.dot(lam, alpha*np.dot(dK, mu) + dfield)
+
+        return self.energy_polarization, grad
+
     def build_u(self,r, a1, a2): 
 
         u = np.copy(r) 
@@ -366,3 +433,160 @@ class InductionCalc(Electrostatics):
      #   print(T)    
         return T
 
+def thole_lambdas(u, smear, deriv=False):
+    """
+    Thole damping factors [l3, l5, l7] for effective distances u and,
+    with deriv=True, their derivatives with respect to the smearing coefficient
+    """
+    exp = np.power(u,3.0) * -smear
+    e = np.exp(exp)
+    lams = [1.0 - e,
+            1.0 - (1.0 - exp)*e,
+            1.0 - (1.0 - exp + 0.6*exp*exp)*e]
+    if deriv:
+        u3e = np.power(u,3.0) * e
+        dlams = [u3e,
+                 -exp*u3e,
+                 (0.2*exp + 0.6*exp*exp)*u3e]
+        return lams, dlams
+    return lams
+
+def thole_int_tensors(vec, l3, l5, l7):
+    """
+    Vectorized `InductionCalc.build_int_tensor`: (...,3,13) damped
+    dipole-multipole tensors for pair vectors vec (...,3). Linear in the
+    damping factors.
+    """
+    r = np.linalg.norm(vec, axis=-1)
+    r3 = (l3 * np.power(r,-3.0))[...,None]
+    r5 = (l5 * np.power(r,-5.0))[...,None]
+    r7 = (l7 * np.power(r,-7.0))[...,None]
+    eye = np.eye(3)
+
+    T = np.zeros(vec.shape[:-1] + (3,13))
+
+    # dipole-charge
+    T[...,:,0] = -vec * r3
+
+    # dipole-dipole
+    T[...,:,1:4] = 3.0 * vec[...,:,None] * vec[...,None,:] * r5[...,None] - eye * r3[...,None]
+
+    # dipole-quadrupole, [p, m, n] -> [p, 4 + 3*m + n]
+    xyz = vec[...,:,None,None] * vec[...,None,:,None] * vec[...,None,None,:]
+    num = eye[None,:,:] * vec[...,:,None,None] \
+        + eye[:,:,None] * vec[...,None,None,:] \
+        + eye[:,None,:] * vec[...,None,:,None]
+    dq = -15.0 * xyz * r7[...,None,None] + 3.0 * num * r5[...,None,None]
+    T[...,:,4:13] = dq.reshape(vec.shape[:-1] + (3,9))
+
+    return T
+
+def thole_self_dip_tensors(vec, l3, l5):
+    """
+    Vectorized `InductionCalc.build_self_dip_int_tensor`: (n,n,3,3) damped
+    dipole-dipole tensors within one system, zero for each atom with itself
+    """
+    r = np.linalg.norm(vec, axis=-1)
+    self_pair = r < 1e-8
+    r = np.where(self_pair, 1.0, r)
+    r3 = (l3 * np.power(r,-3.0))[...,None,None]
+    r5 = (l5 * np.power(r,-5.0))[...,None,None]
+
+    T = 3.0 * vec[...,:,None] * vec[...,None,:] * r5 - np.eye(3) * r3
+    T[self_pair] = 0.0
+    return T
+
+def induced_pair_energies(vec, m1, m2, mu1, mu2, pairs=True):
+    """
+    Polarization energies (au) of the induced dipoles of each system in
+    the multipoles of the other, per atom pair as in
+    `InductionCalc.polarization_energy`
+
+    Parameters
+    ----------
+    vec : :class: `~numpy.ndarray`
+        (...,n1,n2,3) minimum-image vectors in bohr from atoms of 1 to atoms of 2
+    m1, m2 : :class: `~numpy.ndarray`
+        (...,n,13) cartesian multipoles, nuclei included
+    mu1, mu2 : :class: `~numpy.ndarray`
+        (...,n,3) induced dipoles
+    pairs : :class: `bool`
+        If False, only the total is returned, summed inside the contractions
+
+    Returns
+    -------
+    en : :class: `~numpy.ndarray`
+        (...,n1,n2) pair energies, or their sum
+    """
+    n1, n2 = vec.shape[-3:-1]
+    out = '->...ab' if pairs else '->...'
+    en = np.zeros(vec.shape[:-1] if pairs else vec.shape[:-3])
+    for rows in _row_blocks(n1, n2*int(np.prod(vec.shape[:-3]))):
+        T = interaction_tensors(vec[...,rows,:,:])
+        part = 0.5 * (np.einsum('...ai,...abik,...bk' + out, mu1[...,rows,:], T[...,1:4,:], m2)
+                    + np.einsum('...ak,...abki,...bi' + out, m1[...,rows,:], T[...,:,1:4], mu2))
+        if pairs:
+            en[...,rows,:] = part
+        else:
+            en += part
+    return en
+
+def solve_induced_dipoles(K, alpha, field, nsplit, omega, conv):
+    """
+    Relaxed Jacobi iterations mu = alpha*(K mu) + field as in
+    `InductionCalc.polarization_energy`, over the flattened dipoles of both
+    systems; nsplit is the length of the first system's block. 
+    Returns None if the iterations diverge or exceed 2000 steps.
+    """
+    mu, converged = solve_induced_dipoles_batch(K[None], alpha[None], field[None], nsplit, omega, conv)
+    if not converged[0]:
+        return None
+    return mu[0]
+
+def solve_induced_dipoles_batch(K, alpha, field, nsplit, omega, conv):
+    """
+    `solve_induced_dipoles` for a batch of independent systems, K (batch,n,n)
+    and alpha, field (batch,n). Each system keeps its own relaxation
+    parameter, iteration count and convergence test, and stops updating
+    once converged or failed, so the results match separate solves.
+    Padded entries need zero alpha and field. Returns the dipoles and a
+    boolean array that is False for the systems that failed.
+    """
+    def block_norm(x):
+        return np.linalg.norm(x[:,:nsplit], axis=1) + np.linalg.norm(x[:,nsplit:], axis=1)
+
+    start = time.perf_counter()
+    nbatch = len(field)
+    mu = np.copy(field)
+    omega = np.full(nbatch, omega, dtype=float)
+    diff_init = block_norm(mu)
+    diff = np.copy(diff_init)
+    counter = np.zeros(nbatch, dtype=int)
+    failed = np.zeros(nbatch, dtype=bool)
+    active = diff > conv
+    while np.any(active):
+        mu_prev = mu[active]
+        w = omega[active,None]
+        mu_new = (1.0 - w) * mu_prev + (alpha[active] * np.matmul(K[active], mu_prev[...,None])[...,0] + field[active]) * w
+        mu[active] = mu_new
+        counter[active] += 1
+        diff[active] = block_norm(mu_new - mu_prev)
+        failed |= active & ((diff > diff_init*10) | (counter > 2000))
+        decay = active & ~failed & (counter % 50 == 0) & (omega > 0.2)
+        omega[decay] *= 0.8
+        active = ~failed & (diff > conv)
+    for n in range(nbatch):
+        record_induction(counter[n], diff[n], not failed[n])
+    tracing.add_span('induction_iterations', start, batch=nbatch, size=field.shape[-1],
+                     iterations=counter.tolist(), residual=diff.tolist(), converged=(~failed).tolist())
+    return mu, ~failed
+
+def record_induction(iterations, residual, converged):
+    """
+    Adds the iterations and final residual of a solution of the induction
+    equations to the metrics, see `cliff.helpers.metrics`
+    """
+    metrics.observe('cliff_induction_iterations', int(iterations), metrics.iteration_buckets)
+    metrics.observe('cliff_induction_residual', float(residual), metrics.residual_buckets)
+    if not converged:
+        metrics.inc('cliff_induction_failures_total')
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Per-monomer evaluation state for many-pair energy evaluations
+#
+
+import numpy as np
+import cliff.helpers.constants as constants
+import cliff.helpers.utils as utils
+import cliff.helpers.budget as budget
+import cliff.helpers.metrics as metrics
+import cliff.helpers.tracing as tracing
+from cliff.atomic_properties.polarizability import Polarizability
+from cliff.components.electrostatics import Electrostatics, damped_mtp_pair_energies
+from cliff.components.induction_calc import thole_lambdas, thole_int_tensors, thole_self_dip_tensors, solve_induced_dipoles_batch, induced_pair_energies
+from cliff.components.dispersion import tt_damping
+
+
+class PreparedMonomer:
+    '''
+    Everything the energy components need from a single monomer, computed
+    once so that a monomer can be paired with many others through
+    `pair_energy` without rebuilding the component objects.
+    '''
+
+    def __init__(self, options, sys, cell):
+        self.system = sys
+        self.options = options
+        self.cell = cell
+        self.num_atoms = sys.num_atoms
+        self.mask = np.ones(sys.num_atoms, dtype=bool)
+        self.coords = np.asarray(sys.coords, dtype=float)
+        self.coords_bohr = self.coords * constants.a2b
+        self.Z = sys.Z.astype(float)
+        self.valence_widths = np.asarray(sys.valence_widths, dtype=float)
+
+        # electrostatics: electronic cartesian multipoles and damping exponents
+        elst = Electrostatics(options, sys, cell)
+        elst.get_mtp_coefficients(stone_convention=False)
+        self.mtps_cart = elst.mtps_cart[0]
+        self.elst_alpha = sys.type_params(options.elst_damping_exponents)*constants.b2a
+
+        # exchange
+        self.exch = sys.type_params(options.exch_int_params)
+
+        # induction: full multipoles, polarizabilities and intramonomer Thole coupling
+        self.mtps_full = np.copy(self.mtps_cart)
+        self.mtps_full[:,0] += self.Z
+        self.pol = np.asarray(Polarizability(options.name, options.logger, options.pol_scs_cutoff,
+                                             options.pol_exponent, sys).get_pol_scaled(), dtype=float)
+        self.ind_sr = sys.type_params(options.indu_sr_params)
+        self.smearing_coeff = options.indu_smearing_coeff
+        vec = cell.pbc_distances(self.coords_bohr, self.coords_bohr)
+        u = np.linalg.norm(vec, axis=-1) / np.power(np.outer(self.pol, self.pol), 1/6)
+        self.thole_self = thole_self_dip_tensors(vec, *thole_lambdas(u, self.smearing_coeff)[:2])
+
+        # dispersion: effective C6, polarizabilities and C8 prefactors
+        h = np.asarray(sys.hirshfeld_ratios, dtype=float)
+        self.c6 = sys.element_params(constants.csix_free) * h * h
+        self.disp_alpha = sys.element_params(constants.pol_free) * h
+        self.c8_q = np.sqrt(self.Z) * sys.element_params(constants.atomic_r4) / sys.element_params(constants.atomic_r2)
+        self.disp = sys.type_params(options.disp_coeffs)
+
+
+class MonomerBatch:
+    '''
+    The arrays of several PreparedMonomers, padded to the largest of them
+    along a leading batch dimension. Padding atoms have mask False and
+    parameters that keep every pair term finite; `pair_components` zeroes
+    their contributions.
+    '''
+
+    # attribute: padding value
+    padding = {'coords' : 0.0, 'coords_bohr' : 0.0, 'Z' : 0.0, 'valence_widths' : 1.0, 'mask' : False,
+               'mtps_cart' : 0.0, 'elst_alpha' : 1.0, 'exch' : 0.0, 'mtps_full' : 0.0, 'pol' : 1.0,
+               'ind_sr' : 0.0, 'thole_self' : 0.0, 'c6' : 1.0, 'disp_alpha' : 1.0, 'c8_q' : 1.0, 'disp' : 0.0}
+
+    def __init__(self, monomers):
+        self.cell = monomers[0].cell
+        self.smearing_coeff = monomers[0].smearing_coeff
+        self.num_atoms = max(mon.num_atoms for mon in monomers)
+        self.sizes = [mon.num_atoms for mon in monomers]
+        n = self.num_atoms
+        for attr, fill in self.padding.items():
+            arrays = [getattr(mon, attr) for mon in monomers]
+            atom_axes = 2 if attr == 'thole_self' else 1
+            arr = np.full((len(monomers),) + (n,)*atom_axes + arrays[0].shape[atom_axes:], fill, dtype=arrays[0].dtype)
+            for b, x in enumerate(arrays):
+                arr[(b,) + (slice(0, len(x)),)*atom_axes] = x
+            setattr(self, attr, arr)
+
+
+def _outer(x, y):
+    return x[...,:,None] * y[...,None,:]
+
+def _component(func, name):
+    # energy function of a component, timed and traced
+    return tracing.traced(metrics.timed(func, name), name)
+
+def pair_components(mon_a, mon_b, options):
+    '''
+    Atom-pairwise [elst, exch, indu, disp] energies (au) of prepared
+    monomers, shape (4,...,na,nb). mon_a and mon_b are either single
+    `PreparedMonomer`s or `MonomerBatch`es of the same length, in which
+    case pairs involving padding atoms are zero.
+    '''
+    cell = mon_a.cell
+    pair = _outer(mon_a.mask, mon_b.mask)
+    # padding pairs get a harmless 10 bohr separation
+    far = np.array([0.0, 0.0, 10.0])
+    vec = np.where(pair[...,None], constants.a2b * cell.pbc_distances(mon_a.coords, mon_b.coords), far)
+    vec_bohr = np.where(pair[...,None], cell.pbc_distances(mon_a.coords_bohr, mon_b.coords_bohr), far)
+    r_bohr = np.linalg.norm(vec_bohr, axis=-1)
+    ovp = utils.slater_ovp_mat(r_bohr, mon_a.valence_widths, mon_b.valence_widths)
+
+    # electrostatics, induction and dispersion are independent, see `budget.run_concurrently`
+    (at_elst, (at_ind, converged), at_disp) = budget.run_concurrently(
+        [_component(lambda: damped_mtp_pair_energies(vec, mon_a.Z, mon_b.Z, mon_a.mtps_cart, mon_b.mtps_cart,
+                                                     mon_a.elst_alpha, mon_b.elst_alpha), 'elst'),
+         _component(lambda: induction_pairs(mon_a, mon_b, vec_bohr, r_bohr, pair, options), 'indu'),
+         _component(lambda: dispersion_pairs(mon_a, mon_b, np.linalg.norm(vec, axis=-1)), 'disp')],
+        options.component_threads)
+
+    # exchange
+    at_exch = _component(lambda: ovp * _outer(mon_a.exch, mon_b.exch), 'exch')()
+
+    # induction, counted as zero if unconverged like in InductionCalc.polarization_energy
+    at_ind -= ovp * _outer(mon_a.ind_sr, mon_b.ind_sr)
+    at_ind *= converged[...,None,None]
+
+    return np.array([at_elst, at_exch, at_ind, at_disp]) * pair
+
+def _energy_rows(pairs, return_pairs):
+    pairs = pairs * constants.au2kcalmol
+    if return_pairs:
+        return np.concatenate((np.sum(pairs, axis=0)[None], pairs))
+    en = np.sum(pairs, axis=(1,2))
+    return np.append(np.sum(en), en)
+
+def pair_energy(mon_a, mon_b, options, return_pairs=False):
+    '''
+    Energy components of a pair of prepared monomers, identical to
+    `cliff.energy_kernel` on the underlying Systems.
+
+    Parameters
+    ----------
+    mon_a, mon_b : :class: `PreparedMonomer`
+        Monomers prepared with the same options and cell
+    options : :class: `~cliff.helpers.Options`
+        Options, for the induction convergence settings
+    return_pairs : :class: `bool`
+        Return atom-pairwise energies instead of totals
+
+    Returns
+    -------
+    energies : :class: `~numpy.ndarray`
+        [total, elst, exch, indu, disp] in kcal/mol, each (na,nb) if return_pairs
+    '''
+    return _energy_rows(pair_components(mon_a, mon_b, options), return_pairs)
+
+def batch_pair_energies(mons_a, mons_b, options, return_pairs=False):
+    '''
+    `pair_energy` of the pairs (mons_a[n], mons_b[n]) evaluated together on
+    padded arrays, so that many small dimers cost a few large array
+    operations instead of many small ones. The induction equations of each
+    dimer are iterated and tested for convergence separately.
+
+    Parameters
+    ----------
+    mons_a, mons_b : list of :class: `PreparedMonomer`
+        Monomers of the dimers, prepared with the same options and cell
+    options : :class: `~cliff.helpers.Options`
+        Options, for the induction convergence settings
+    return_pairs : :class: `bool`
+        Return atom-pairwise energies instead of totals
+
+    Returns
+    -------
+    energies : list of :class: `~numpy.ndarray`
+        `pair_energy` of every dimer
+    '''
+    batch_a = MonomerBatch(mons_a)
+    batch_b = MonomerBatch(mons_b)
+    pairs = pair_components(batch_a, batch_b, options)
+    return [_energy_rows(pairs[:,n,:na,:nb], return_pairs)
+            for n, (na, nb) in enumerate(zip(batch_a.sizes, batch_b.sizes))]
+
+def induction_pairs(mon_a, mon_b, vec, r, pair, options):
+    '''
+    Thole polarization energies (au) per atom pair and whether the
+    self-consistent equations converged
+    '''
+    n1 = mon_a.num_atoms
+    n2 = mon_b.num_atoms
+    batch = vec.shape[:-3]
+    u = r / np.power(_outer(mon_a.pol, mon_b.pol), 1/6)
+    lams = thole_lambdas(u, mon_a.smearing_coeff)
+
+    T_1 = thole_int_tensors(vec, *lams) * pair[...,None,None]
+    T_2 = thole_int_tensors(-vec, *lams) * pair[...,None,None]
+    alpha = np.repeat(np.concatenate((mon_a.pol*mon_a.mask, mon_b.pol*mon_b.mask), axis=-1), 3, axis=-1)
+    field = np.concatenate((np.einsum('...abjk,...bk->...aj', T_1, mon_b.mtps_full),
+                            np.einsum('...abjk,...ak->...bj', T_2, mon_a.mtps_full)), axis=-2)
+    field = field.reshape(batch + (-1,))
+
+    # (a,b,i,j) -> (a,i,b,j)
+    K = np.zeros(batch + (n1+n2,3,n1+n2,3))
+    K[...,:n1,:,:n1,:] = np.swapaxes(mon_a.thole_self, -3, -2)
+    K[...,:n1,:,n1:,:] = np.swapaxes(T_1[...,1:4], -3, -2)
+    K[...,n1:,:,:n1,:] = np.swapaxes(np.swapaxes(T_2[...,1:4], -4, -3), -3, -2)
+    K[...,n1:,:,n1:,:] = np.swapaxes(mon_b.thole_self, -3, -2)
+
+    nsys = 3*(n1+n2)
+    mu, converged = solve_induced_dipoles_batch(K.reshape((-1, nsys, nsys)), alpha.reshape((-1, nsys)),
+                                                (alpha*field).reshape((-1, nsys)), 3*n1,
+                                                options.indu_omega, options.indu_conv)
+    mu = mu.reshape(batch + (n1+n2,3))
+    mu_1 = mu[...,:n1,:]
+    mu_2 = mu[...,n1:,:]
+
+    pol = induced_pair_energies(vec, mon_a.mtps_full, mon_b.mtps_full, mu_1, mu_2)
+    return pol, converged.reshape(batch)
+
+def dispersion_pairs(mon_a, mon_b, r):
+    '''
+    Tang-Toennies dispersion energies (au) per atom pair, as in
+    `Dispersion.compute_tang_toennies`
+    '''
+    c6_ab = (2.0 * _outer(mon_a.c6, mon_b.c6)) / \
+            (_outer(mon_a.c6/mon_a.disp_alpha, mon_b.disp_alpha) + _outer(mon_a.disp_alpha, mon_b.c6/mon_b.disp_alpha))
+    c8_ab = c6_ab * 3 * np.sqrt(_outer(mon_a.c8_q, mon_b.c8_q))
+    c10_ab = (49.0/40.0) * np.square(c8_ab) / c6_ab
+
+    b_AB = np.sqrt(_outer(1.0/mon_a.valence_widths, 1.0/mon_b.valence_widths))
+    e6 = -1.0 * tt_damping(6, r, b_AB)*c6_ab/(r**6.0)
+    e_hi = -1.0 * (tt_damping(8, r, b_AB)*c8_ab/(r**8.0) + tt_damping(10, r, b_AB)*c10_ab/(r**10.0))
+    return e6 + e_hi * _outer(mon_a.disp, mon_b.disp)
@@ -29,6 +29,7 @@ class Repulsion:
 
         self.rep = options.exch_int_params
         
+        # atom-pairwise energies in at_exch, see `Electrostatics`
         self.decompose = True
         self.at_exch = np.zeros((0,0))
         
@@ -37,31 +38,31 @@ class Repulsion:
         self.systems.append(sys)
         return None
 
+    def overlap_matrix(self, sys_i, sys_j):
+        '''
+        Slater overlap S_ab between the valence densities of two systems.
+        Exchange is U_a U_b S_ab summed over atom pairs.
+        '''
+        coord_i = [crd*constants.a2b for crd in sys_i.coords]
+        coord_j = [crd*constants.a2b for crd in sys_j.coords]
+        r = utils.build_r(coord_i, coord_j, self.cell)
+        return utils.slater_ovp_mat(r, sys_i.valence_widths, sys_j.valence_widths)
+
     def compute_repulsion(self):
         'Compute repulsive interaction'
         # Setup list of atoms to sum over
 
-        atom_coord = []    
-        v_widths = []
-        params = []
-        for sys in self.systems:
-            atom_coord.append([crd*constants.a2b for crd in sys.coords])
-            params.append([self.rep[typ] for typ in sys.atom_types])
-            v_widths.append([v for v in sys.valence_widths])
+        params = [sys.type_params(self.rep) for sys in self.systems]
  
         nsys = len(self.systems)
         self.energy = 0.0
         for s1 in range(nsys):
             for s2 in range(s1+1, nsys):
-                r = utils.build_r(atom_coord[s1], atom_coord[s2], self.cell)
-                ovp = utils.slater_ovp_mat(r,v_widths[s1],v_widths[s2])
+                ovp = self.overlap_matrix(self.systems[s1], self.systems[s2])
                 self.energy += np.dot(params[s1], np.matmul(ovp,params[s2]))
 
                 if self.decompose:
-                    self.at_exch = np.zeros((len(atom_coord[s1]), len(atom_coord[s2])))
-                    for i in range(len(atom_coord[s1])): 
-                        for j in range(len(atom_coord[s2])): 
-                            self.at_exch[i,j] = ovp[i,j] * params[s1][i] * params[s2][j] * constants.au2kcalmol
+                    self.at_exch = ovp * np.outer(params[s1], params[s2]) * constants.au2kcalmol
 
 
         self.energy *= constants.au2kcalmol
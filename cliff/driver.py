@@ -9,23 +9,23 @@ in addition to related functions needed for predicting atomic properties.
 
 import os
 
-
-using_apnet = True 
-try:
-    import apnet
-except:
-    using_apnet = False
-
 import time
+import multiprocessing
 import numpy as np
 import glob
-import qcelemental as qcel
 
 #import cliff
 from cliff.helpers.options import Options
 from cliff.helpers.cell import Cell
 from cliff.helpers.system import System
 import cliff.helpers.utils as Utils
+import cliff.helpers.geometry as geometry
+import cliff.helpers.budget as budget
+import cliff.helpers.metrics as metrics
+import cliff.helpers.tracing as tracing
+from cliff.helpers.budget import ThreadBudget
+from cliff.helpers.property_cache import get_property_cache
+from cliff.helpers.energy_memo import get_energy_memo, parameter_hash, dimer_key
 from cliff.atomic_properties.hirshfeld import Hirshfeld
 from cliff.atomic_properties.atomic_density import AtomicDensity
 from cliff.atomic_properties.multipole import Multipole
@@ -33,26 +33,30 @@ from cliff.components.electrostatics import Electrostatics
 from cliff.components.repulsion import Repulsion
 from cliff.components.induction_calc import InductionCalc
 from cliff.components.dispersion import Dispersion
+from cliff.components.prepared import PreparedMonomer, pair_energy, batch_pair_energies, _component
 
-def set_nthread(nthread):
+def set_nthread(nthread, nproc=1):
     """
-    Sets the number of threads used by the entire CLIFF module.
-    Increasing threads can only impact any threaded numpy routines.
+    Sets the number of threads used by the entire CLIFF module: the total
+    thread budget, and the size of the BLAS and OpenMP thread pools, which
+    is changed at runtime. The threads are split between nproc worker
+    processes, and the threads of concurrent energy components.
 
     Parameters
     ----------
     nthread : :class: `int`
-        Number of threads.
-
+        Number of threads, None for all CPUs
+    nproc : :class: `int`
+        Number of worker processes sharing them
 
     Returns
     -------
-        void
+    budget : :class: `~cliff.helpers.budget.ThreadBudget`
+        The applied budget; `budget.restore()`, or using set_nthread in a
+        with statement, restores the previous one
     """
 
-    os.environ["OMP_NUM_THREADS"]    = str(nthread) 
-    os.environ["MKL_NUM_THREADS"]    = str(nthread)
-    os.environ["NUMEXPR_NUM_THREADS"]= str(nthread)
+    return ThreadBudget(nthread, nproc).apply()
 
 def mol_to_sys(mol, options):
     """
@@ -63,7 +67,8 @@ def mol_to_sys(mol, options):
     Parameters
     ----------
     mol : :class: `~qcel.models.Molecule`
-        Input QCElemental molecule.
+        Input QCElemental molecule. Systems, or lists of the two Systems
+        of a dimer as returned by `read_dimer_xyz`, are passed through.
     options : :class: `~cliff.helpers.Options`
         Options object
 
@@ -72,22 +77,29 @@ def mol_to_sys(mol, options):
     systems : :class:`cliff.System`
         Cliff System object 
     """
+    # Systems, e.g. from `read_dimer_xyz`, are already converted
+    if isinstance(mol, System):
+        return mol
+    if isinstance(mol, (list, tuple)):
+        return list(mol)
+
     # If mol is a dimer, return two sys
     
     nfrag = len(mol.fragments)
     dimer_name = mol.name
     systems = []
-    for frag in range(nfrag):
-        fmol = mol.get_fragment(frag)
-        sys = System(options)
+    with tracing.span('mol_to_sys', mol=dimer_name, natom=len(mol.symbols), nfrag=nfrag):
+        for frag in range(nfrag):
+            fmol = mol.get_fragment(frag)
+            sys = System(options)
 
-        if nfrag == 1:
-            sys.load_qcel_mol(fmol, name = dimer_name)
-        else:
-            f_name = dimer_name + "-" + str(frag)
-            sys.load_qcel_mol(fmol, name = f_name)
+            if nfrag == 1:
+                sys.load_qcel_mol(fmol, name = dimer_name)
+            else:
+                f_name = dimer_name + "-" + str(frag)
+                sys.load_qcel_mol(fmol, name = f_name)
     
-        systems.append(sys)
+            systems.append(sys)
 
     if nfrag == 1:
         return systems[0]
@@ -114,8 +126,30 @@ def load_dimer_xyz(xyz_file, units='angstrom'):
         QCElemental Molecule object. The returned Molecule object has two defined fragemens, one for
         each monomer. 
     '''
+    with metrics.timer('io_read'), tracing.span('read_xyz', file=xyz_file):
+        lines = open(xyz_file,'r').readlines()
+        mol_name = xyz_file.split("/")[-1].split(".xyz")[0]
+        return parse_dimer_xyz(lines, mol_name, units)
+
+def parse_dimer_xyz(lines, mol_name, units='angstrom'):
+    '''
+    Builds a dimer from the lines of a dimer xyz file, see `load_dimer_xyz`.
+
+    Parameters
+    ----------
+    lines : list of :class:`str`
+        Lines of the dimer xyz file
+    mol_name : :class:`str`
+        Name of the returned Molecule
+    units : :class:`str`:
+        Units of the input coordinates
 
-    lines = open(xyz_file,'r').readlines()
+    Returns
+    -------
+    dimer : :class:`~qcelemental.molecule`
+        QCElemental Molecule object with one fragment per monomer
+    '''
+    import qcelemental as qcel
 
     natom = int(lines[0].strip())
     data = lines[1].strip()
@@ -124,7 +158,6 @@ def load_dimer_xyz(xyz_file, units='angstrom'):
     na = int(data.split(',')[-1])
     nb = natom - na
 
-    mol_name = xyz_file.split("/")[-1].split(".xyz")[0]
     blockA = f"0 1\n" + "".join(coords[:na])
     blockB = f"0 1\n" + "".join(coords[na:])
     dimer = blockA + "--\n" + blockB + f"no_com\nno_reorient\nunits {units}"
@@ -160,11 +193,23 @@ def load_monomer_xyz(xyz_file, units='angstrom'):
             file.  
 
     '''
-    
 
+    with metrics.timer('io_read'), tracing.span('read_xyz', file=xyz_file):
+        lines = open(xyz_file,'r').readlines()
+        return parse_monomer_xyz(lines, xyz_file.split("/")[-1].split(".xyz")[0], units)
+
+def parse_monomer_xyz(lines, name, units='angstrom'):
+    '''
+    Builds the monomers in the lines of a single/multi monomer xyz file,
+    see `load_monomer_xyz`. The n-th monomer is named name-n.
+
+    Returns
+    -------
+        molecules : list of :class:`qcelemental.molecule` objects
+    '''
+    import qcelemental as qcel
     molecules = []    
 
-    lines = open(xyz_file,'r').readlines()
     atom_n = [int(line.split()[0]) for line in lines if (len(line.split()) == 1) and (len(line.split(',')) == 1)]
     charges = [int(line.split(',')[-1]) for line in lines if (len(line.split(',')) > 1)]
     coords = [line for line in lines if len(line.split()) == 4]
@@ -180,14 +225,101 @@ def load_monomer_xyz(xyz_file, units='angstrom'):
 
         n_prev += n
 
-        mol_name = xyz_file.split("/")[-1].split(".xyz")[0] + "-" + str(nmol)
+        mol_name = name + "-" + str(nmol)
         molecules.append(qcel.models.Molecule.from_data(mol,**{'name':mol_name}))
         nmol += 1
 
     return molecules
     
 
-def predict_atomic_properties(mol, models):
+def read_dimer_xyz(xyz_file, options, units='angstrom'):
+    '''
+    Reads a dimer xyz file straight into the Systems of its monomers,
+    the same as `mol_to_sys` of `load_dimer_xyz` without building a
+    QCElemental Molecule on the way. The result can be passed wherever
+    CLIFF takes a dimer, except to the NN (AP-Net) models.
+
+    Parameters
+    ----------
+    xyz_file : :class:`str`
+        Filename of the dimer xyz file
+    options : :class: `~cliff.helpers.Options`
+        Options object
+    units : :class:`str`:
+        Units of the input coordinates, default to Angstrom
+
+    Returns
+    -------
+    systems : list of :class:`cliff.System`
+        Systems of monomer A and B, named X-0 and X-1 for X.xyz
+    '''
+    with metrics.timer('io_read'), tracing.span('read_xyz', file=xyz_file):
+        lines = open(xyz_file,'r').readlines()
+        mol_name = xyz_file.split("/")[-1].split(".xyz")[0]
+        return dimer_systems(lines, mol_name, options, units)
+
+def dimer_systems(lines, mol_name, options, units='angstrom'):
+    '''
+    Monomer Systems from the lines of a dimer xyz file, see `read_dimer_xyz`
+    '''
+    natom = int(lines[0].strip())
+    na = int(lines[1].strip().split(',')[-1])
+    elements, coords = _xyz_atoms(lines[-natom:], units)
+
+    return [_make_system(options, mol_name + "-0", elements[:na], coords[:na]),
+            _make_system(options, mol_name + "-1", elements[na:], coords[na:])]
+
+def read_monomer_xyz(xyz_file, options, units='angstrom'):
+    '''
+    Reads a single/multi monomer xyz file straight into Systems, the same
+    as `mol_to_sys` of the Molecules of `load_monomer_xyz`.
+
+    Returns
+    -------
+    systems : list of :class:`cliff.System`
+        One System per monomer, the n-th named X-n for X.xyz
+    '''
+    with metrics.timer('io_read'), tracing.span('read_xyz', file=xyz_file):
+        lines = open(xyz_file,'r').readlines()
+        return monomer_systems(lines, xyz_file.split("/")[-1].split(".xyz")[0], options, units)
+
+def monomer_systems(lines, name, options, units='angstrom'):
+    '''
+    Monomer Systems from the lines of a monomer xyz file, see `read_monomer_xyz`
+    '''
+    atom_n = [int(line.split()[0]) for line in lines if (len(line.split()) == 1) and (len(line.split(',')) == 1)]
+    charges = [int(line.split(',')[-1]) for line in lines if (len(line.split(',')) > 1)]
+    coords = [line for line in lines if len(line.split()) == 4]
+
+    if len(charges) == 0:
+        raise Exception("Must specify total charge in xyz file (last field in comment line of xyz)")
+
+    elements, coords = _xyz_atoms(coords, units)
+    systems = []
+    n_prev = 0
+    for nmol, n in enumerate(atom_n[:len(charges)]):
+        systems.append(_make_system(options, name + "-" + str(nmol), elements[n_prev:n_prev + n], coords[n_prev:n_prev + n]))
+        n_prev += n
+
+    return systems
+
+def _xyz_atoms(lines, units='angstrom'):
+    # elements and coordinates in Angstrom of xyz atom lines
+    fields = [line.split() for line in lines]
+    elements = [f[0][0].upper() + f[0][1:].lower() for f in fields]
+    coords = np.array([f[1:4] for f in fields], dtype=float).reshape((-1, 3))
+    if units.lower() not in ['angstrom', 'ang', 'a']:
+        import qcelemental as qcel
+        coords *= qcel.constants.conversion_factor(units, "angstrom")
+    return elements, coords
+
+def _make_system(options, name, elements, coords):
+    sys = System(options)
+    sys.load_atoms(elements, coords, name)
+    return sys
+
+
+def predict_atomic_properties(mol, models, cache=None):
     """
     Predicts the atomic properties for an input System
     Returns System with Hirshfeld, atomic density, and multipole.
@@ -198,17 +330,54 @@ def predict_atomic_properties(mol, models):
         Input System
     models : list of :class:`~cliff.atomic_properties.Hirshfeld` ,`~cliff.atomic_properties.AtomicDensity`, and `~cliff.atomic_properties.Multipole`
         List of dimension (3,) in the exact order: [Hirshfeld, AtomicDensity, Multipole].
+    cache : :class: `~cliff.helpers.property_cache.PropertyCache`
+        If given, properties are taken from the cache when there and
+        stored in it otherwise
     """
+    if cache is not None and cache.load(mol):
+        return mol
 
     hirsh = models[0]
     adens = models[1]
     mtp_ml = models[2]
 
-    hirsh.predict_mol(mol, force_predict=True)
-    adens.predict_mol(mol, force_predict=True)
-    mtp_ml.predict_mol(mol, force_predict=True)
+    for model in [hirsh, adens, mtp_ml]:
+        with tracing.span('predict_mol', model=type(model).__name__, mol=mol.name, natom=mol.num_atoms):
+            model.predict_mol(mol, force_predict=True)
  
+    if cache is not None:
+        cache.save(mol)
     return mol    
+
+def predict_atomic_properties_batch(mols, models, cache=None):
+    """
+    `predict_atomic_properties` of several Systems at once. The KRR kernels
+    of all atoms of an element are evaluated together, which is cheaper
+    than one small kernel evaluation per System.
+
+    Parameters
+    ----------
+    mols : list of :class: `~cliff.helpers.System`
+        Input Systems
+    models : list of :class:`~cliff.atomic_properties.Hirshfeld` ,`~cliff.atomic_properties.AtomicDensity`, and `~cliff.atomic_properties.Multipole`
+        List of dimension (3,) in the exact order: [Hirshfeld, AtomicDensity, Multipole].
+    cache : :class: `~cliff.helpers.property_cache.PropertyCache`
+        If given, only Systems not in the cache are predicted, and stored in it
+    """
+    todo = mols
+    if cache is not None:
+        todo = [mol for mol in mols if not cache.load(mol)]
+
+    if len(todo) > 0:
+        for model in models:
+            with tracing.span('predict_mol', model=type(model).__name__, nmol=len(todo),
+                              natom=sum(mol.num_atoms for mol in todo)):
+                model.predict_mols(todo)
+
+    if cache is not None:
+        for mol in todo:
+            cache.save(mol)
+    return mols
     
 def save_atomic_properties(mol,path):
     """
@@ -249,15 +418,20 @@ def load_atomic_properties(mol,path):
         
     return mol
 
-def predict_from_dimers(dimers, ml_type='KRR', load_path=None, return_pairs=False, infile=None, options=None):
+def predict_from_dimers(dimers, ml_type='KRR', load_path=None, return_pairs=False, infile=None, options=None, nproc=1, batch_size=None):
     '''
     Compute energy components from a list of dimers.
     Uses all default options, turns off logging
 
     Parameters
     ----------
-    dimers: qcel Molecule class or list of Molecule class
+    dimers: qcel Molecule class or list of Molecule class, or of pairs of
+        Systems from `read_dimer_xyz`
     return_pairs: bool to control returning of full atom-pairwise decomposition
+    nproc: number of worker processes for property prediction and energies;
+        results are returned in input order
+    batch_size: if set, evaluate the energies of this many dimers at a time
+        on padded arrays, see `cliff.components.prepared.batch_pair_energies`
  
     '''
 
@@ -266,7 +440,6 @@ def predict_from_dimers(dimers, ml_type='KRR', load_path=None, return_pairs=Fals
     else:
         d_list = [dimers]     
 
-
     # load options (all defaults) and get the KRR models
     if options is None:
         if infile is None:
@@ -274,33 +447,158 @@ def predict_from_dimers(dimers, ml_type='KRR', load_path=None, return_pairs=Fals
         else:
             options = Options(config_file=infile)
 
-   
-    energies = []
+    models = None
+    if ml_type.upper() == "KRR" and load_path is None:
+        models = load_krr_models(options) 
+
+    return _dimer_energies(d_list, options, models, ml_type, load_path, return_pairs, nproc, batch_size)
+
+def iter_energies(dimers, ml_type='KRR', load_path=None, return_pairs=False, infile=None, options=None, nproc=1,
+                  chunk_size=256, batch_size=None, units='angstrom'):
+    '''
+    Streaming version of `predict_from_dimers`. Dimers are read, predicted
+    and evaluated chunk_size at a time, so memory stays bounded for
+    arbitrarily long inputs and results are available as they are produced.
+
+    Parameters
+    ----------
+    dimers: iterable of dimer xyz filenames, qcel Molecules or pairs of
+        Systems from `read_dimer_xyz`. With KRR models, xyz files are read
+        with `read_dimer_xyz`.
+    chunk_size: number of dimers held in memory at a time
+    units: units of the xyz files, see `load_dimer_xyz`
+
+    The other parameters are those of `predict_from_dimers`; the ML models
+    are loaded once for all chunks.
+
+    Yields
+    ------
+    (name, energies) for every dimer, in input order. The name is the file
+    name without extension (or the Molecule name), the energies are as in
+    `predict_from_dimers` and None if the dimer could not be read or evaluated.
+    '''
+    if options is None:
+        if infile is None:
+            options = Options()
+        else:
+            options = Options(config_file=infile)
+
+    models = None
+    if ml_type.upper() == "KRR" and load_path is None:
+        models = load_krr_models(options) 
+
+    chunk = []
+    for dimer in dimers:
+        chunk.append(dimer)
+        if len(chunk) == chunk_size:
+            yield from _chunk_energies(chunk, options, models, ml_type, load_path, return_pairs, nproc, batch_size, units)
+            chunk = []
+    if len(chunk) > 0:
+        yield from _chunk_energies(chunk, options, models, ml_type, load_path, return_pairs, nproc, batch_size, units)
+
+def _chunk_energies(chunk, options, models, ml_type, load_path, return_pairs, nproc, batch_size, units):
+    names = []
+    mols = []
+    for dimer in chunk:
+        if isinstance(dimer, str):
+            names.append(dimer.split('/')[-1].split('.xyz')[0])
+            try:
+                if ml_type.upper() == "NN":
+                    mols.append(load_dimer_xyz(dimer, units))
+                else:
+                    mols.append(read_dimer_xyz(dimer, options, units))
+            except:
+                mols.append(None)
+        elif isinstance(dimer, (list, tuple)):
+            # Systems of read_dimer_xyz, named X-0 and X-1
+            names.append(dimer[0].name.rsplit('-', 1)[0])
+            mols.append(dimer)
+        else:
+            names.append(dimer.name)
+            mols.append(dimer)
+
+    loaded = [n for n, mol in enumerate(mols) if mol is not None]
+    energies = [None]*len(mols)
+    if len(loaded) > 0:
+        ens = _dimer_energies([mols[n] for n in loaded], options, models, ml_type, load_path, return_pairs, nproc, batch_size)
+        for n, en in zip(loaded, ens):
+            energies[n] = en
+    return zip(names, energies)
+
+def _dimer_energies(d_list, options, models, ml_type='KRR', load_path=None, return_pairs=False, nproc=1, batch_size=None):
+    '''
+    Energy components of a list of dimers with already loaded options and
+    KRR models (None if ml_type is 'NN' or load_path is set), as used by
+    `predict_from_dimers` and `iter_energies`.
+    '''
+    kind = 'pairs' if return_pairs else 'energies'
+    return _memoized(d_list, options, ml_type, load_path, kind,
+                     lambda dimers: _evaluate_dimers(dimers, options, models, ml_type, load_path, return_pairs, nproc, batch_size))
+
+def _memoized(d_list, options, ml_type, load_path, kind, evaluate):
+    '''
+    evaluate(dimers) for the dimers of d_list that aren't in the energy memo
+    of options (see `cliff.helpers.energy_memo`), and the memoized results
+    for the others. Without a memo, evaluate(d_list).
+    '''
+    memo = get_energy_memo(options)
+    if memo is None:
+        return evaluate(d_list)
+
+    # with KRR models the evaluation takes the Systems built for the keys
+    params = parameter_hash(options)
+    dimers = list(d_list)
+    keys = [None]*len(d_list)
+    for n, dimer in enumerate(d_list):
+        try:
+            mon_a, mon_b = mol_to_sys(dimer, options)
+        except:
+            continue
+        if ml_type.upper() == "KRR":
+            dimers[n] = [mon_a, mon_b]
+        # properties loaded from files depend on the monomer names instead
+        extra = ml_type.upper()
+        if load_path is not None:
+            extra += f" {os.path.abspath(load_path)} {mon_a.name} {mon_b.name}"
+        keys[n] = dimer_key(mon_a, mon_b, params, kind, options.property_cache_decimals, extra)
+
+    results = [None]*len(d_list)
+    found = iter(memo.get([key for key in keys if key is not None]))
+    for n in [n for n, key in enumerate(keys) if key is not None]:
+        results[n] = next(found)
+
+    todo = [n for n, res in enumerate(results) if res is None]
+    if len(todo) > 0:
+        evaluated = evaluate([dimers[n] for n in todo])
+        new = []
+        for n, res in zip(todo, evaluated):
+            results[n] = res
+            if res is not None and keys[n] is not None:
+                new.append((keys[n], res))
+        memo.put(new)
+    options.logger.info(f"Reused memoized energies for {len(d_list) - len(todo)} dimers")
+    return results
+
+def _evaluate_dimers(d_list, options, models, ml_type='KRR', load_path=None, return_pairs=False, nproc=1, batch_size=None):
     mon_a_list = []
     mon_b_list = []
 
-    s = time.time()
+    s = time.perf_counter()
     if ml_type.upper() == "KRR":
-        # get atomic properties
-        if load_path is None:
-            models = load_krr_models(options) 
-
         # get the monomers
+        monomers = []
         for dimer in d_list:
             try:
-                mon_a, mon_b = mol_to_sys(dimer, options)
-                if load_path is None:
-                    mon_a = predict_atomic_properties(mon_a,models)
-                    mon_b = predict_atomic_properties(mon_b,models)
-                else:
-                    mon_a = load_atomic_properties(mon_a,load_path)  
-                    mon_b = load_atomic_properties(mon_b,load_path)  
-                mon_a_list.append(mon_a)    
-                mon_b_list.append(mon_b)    
+                monomers += mol_to_sys(dimer, options)
             except:
-                mon_a_list.append(None)    
-                mon_b_list.append(None)    
-    elif (ml_type.upper() == "NN") and using_apnet:
+                monomers += [None, None]
+
+        # get atomic properties
+        state = {'options' : options, 'models' : models, 'load_path' : load_path}
+        monomers = get_monomer_properties(monomers, state, nproc)
+        mon_a_list = monomers[0::2]
+        mon_b_list = monomers[1::2]
+    elif ml_type.upper() == "NN":
         ma_s = []
         mb_s = []
         for dimer in d_list:
@@ -310,39 +608,38 @@ def predict_from_dimers(dimers, ml_type='KRR', load_path=None, return_pairs=Fals
         model_path = os.path.dirname(os.path.realpath(__file__))
         model_path += '/models/apnet/cliff_pbe0atz.h5'
 
-        s1 = time.time()
-        ma_props = apnet.predict_cliff_properties(ma_s, model_path)
-        mb_props = apnet.predict_cliff_properties(mb_s, model_path)
-        f1 = time.time()
-        print(f"apnet time: {f1-s1} s")
+        monomers = []
+        for dimer in d_list:        
+            monomers += mol_to_sys(dimer, options)
+        mols = [m for pair in zip(ma_s, mb_s) for m in pair]
 
-        for nd, dimer in enumerate(d_list):        
-            mon_a, mon_b = mol_to_sys(dimer, options)
-
-            mon_a.set_properties(ma_props[nd])
-            mon_b.set_properties(mb_props[nd])
+        with metrics.timer('apnet') as timing:
+            monomers = apnet_monomer_properties(monomers, mols, model_path, options.logger)
+        print(f"apnet time: {timing['seconds']} s")
 
-            mon_a_list.append(mon_a)    
-            mon_b_list.append(mon_b)    
-    elif (ml_type.upper() == "NN") and not using_apnet:
-        raise Exception(f"ML type {ml_type} requested, but APNET not found!")
+        mon_a_list = monomers[0::2]
+        mon_b_list = monomers[1::2]
     else:
         raise Exception(f"ML type {ml_type} not understood!") 
 
-    f = time.time()
+    f = time.perf_counter()
+    metrics.observe('cliff_stage_seconds', f-s, stage='properties')
     print(f"Time spent predicting atomic properties: {f-s} s")
         
-    for ma, mb in zip(mon_a_list,mon_b_list):
-        try:
-            en = energy_kernel(ma, mb, options, return_pairs=return_pairs) 
-        except:
-            en = None
-
-        energies.append(en)
+    state = {'options' : options, 'mon_a' : mon_a_list, 'mon_b' : mon_b_list, 'return_pairs' : return_pairs}
+    if batch_size is None:
+        pairs = [(n, n) for n in range(len(mon_a_list))]
+        energies = map_tasks(_pair_energy, pairs, state, nproc)
+    else:
+        state['cell'] = Cell.lattice_parameters(100., 100., 100.)
+        batches = [range(n, min(n + batch_size, len(d_list))) for n in range(0, len(d_list), batch_size)]
+        energies = [en for batch in map_tasks(_batch_energy, batches, state, nproc) for en in batch]
 
+    metrics.inc('cliff_dimers_total', len(energies))
+    metrics.inc('cliff_dimer_failures_total', sum(en is None for en in energies))
     return energies
-    
-def predict_from_monomer_list(monomer_a, monomer_b,ml_type='KRR', load_path=None, return_pairs=False,infile=None, options=None):
+
+def predict_from_monomer_list(monomer_a, monomer_b,ml_type='KRR', load_path=None, return_pairs=False,infile=None, options=None, nproc=1):
     '''
     Compute energy components from two lists of monomers
     Uses default options, places mon_a in outer loop 
@@ -355,6 +652,8 @@ def predict_from_monomer_list(monomer_a, monomer_b,ml_type='KRR', load_path=None
     mon_b: list of (or single) qcel Molecules
 
     return_pairs: bool to control returning of full atom-pairwise decomposition
+    nproc: number of worker processes for property prediction and energies;
+        results are returned in input order
     '''
 
     if isinstance(monomer_a,list):
@@ -373,73 +672,268 @@ def predict_from_monomer_list(monomer_a, monomer_b,ml_type='KRR', load_path=None
         else:
             options = Options(config_file=infile)
 
+    models = None
+    if ml_type.upper() == "KRR" and load_path is None:
+        models = load_krr_models(options) 
+
+    return _monomer_list_energies(mon_a_list, mon_b_list, options, models, ml_type, load_path, return_pairs, nproc)
+
+def _monomer_list_energies(mon_a_list, mon_b_list, options, models, ml_type='KRR', load_path=None, return_pairs=False, nproc=1):
+    '''
+    Energy components of all pairs of two lists of monomers with already
+    loaded options and KRR models, as used by `predict_from_monomer_list`.
+    '''
     mon_a_sys = []
     mon_b_sys = []
 
     if ml_type.upper() == "KRR":
- 
-        if load_path is None:
-            models = load_krr_models(options) 
-
-        for A in mon_a_list:
+        monomers = []
+        for mol in mon_a_list + mon_b_list:
             try:
-                mon_a = mol_to_sys(A, options)
-                
-                if load_path is None:
-                    mon_a = predict_atomic_properties(mon_a,models)
-                else:
-                    mon_a = load_atomic_properties(mon_a,load_path)  
-                mon_a_sys.append(mon_a)
+                monomers.append(mol_to_sys(mol, options))
             except:
-                mon_a_sys.append(None)
-                
+                monomers.append(None)
 
-        for B in mon_b_list:
-            try:
-                mon_b = mol_to_sys(B, options)
-
-                if load_path is None:
-                    mon_b = predict_atomic_properties(mon_b,models)
-                else:
-                    mon_b = load_atomic_properties(mon_b,load_path)  
-                mon_b_sys.append(mon_b)
-            except:
-                mon_b_sys.append(None)
+        state = {'options' : options, 'models' : models, 'load_path' : load_path}
+        monomers = get_monomer_properties(monomers, state, nproc)
+        mon_a_sys = monomers[:len(mon_a_list)]
+        mon_b_sys = monomers[len(mon_a_list):]
 
-    elif (ml_type.upper() == "NN") and (using_apnet):
+    elif ml_type.upper() == "NN":
         model_path = os.path.dirname(os.path.realpath(__file__))
         model_path += '/models/apnet/cliff_pbe0atz.h5'
 
-        ma_props = apnet.predict_cliff_properties(mon_a_list, model_path)
-        mb_props = apnet.predict_cliff_properties(mon_b_list, model_path)
-
-        for nA, A in enumerate(mon_a_list):
-            mon_a = mol_to_sys(A, options)
-            mon_a.set_properties(ma_props[nA])
-            mon_a_sys.append(mon_a)
-            
-        for nB, B in enumerate(mon_b_list):
-            mon_b = mol_to_sys(B, options)
-            mon_b.set_properties(mb_props[nB])
-            mon_b_sys.append(mon_b)
-    elif (ml_type.upper() == "NN") and not using_apnet:
-        raise Exception(f"ML type {ml_type} requested, but APNET not found!")
+        mols = mon_a_list + mon_b_list
+        monomers = [mol_to_sys(mol, options) for mol in mols]
+        monomers = apnet_monomer_properties(monomers, mols, model_path, options.logger)
+        mon_a_sys = monomers[:len(mon_a_list)]
+        mon_b_sys = monomers[len(mon_a_list):]
     else:
         raise Exception(f"ML type {ml_type} not understood!") 
 
 
-    energies = []
-    for mon_a in mon_a_sys:
-        for mon_b in mon_b_sys:
-            try:
-                en = energy_kernel(mon_a, mon_b, options, return_pairs=return_pairs) 
-            except:
-                en = None
+    # every monomer enters len(mon_b_sys) or len(mon_a_sys) pairs, so its
+    # single-monomer arrays are computed once up front
+    state = {'options' : options, 'cell' : Cell.lattice_parameters(100., 100., 100.)}
+    prepared = map_tasks(_prepare_monomer, mon_a_sys + mon_b_sys, state, nproc)
 
-            energies.append(en)
+    state = {'options' : options, 'mon_a' : prepared[:len(mon_a_sys)], 'mon_b' : prepared[len(mon_a_sys):],
+             'return_pairs' : return_pairs}
+    pairs = [(na, nb) for na in range(len(mon_a_sys)) for nb in range(len(mon_b_sys))]
+    energies = map_tasks(_prepared_pair_energy, pairs, state, nproc)
 
     return energies
 
+# State of a worker process, see `map_tasks`
+_worker_state = None
+
+def _init_worker(state, nproc):
+    global _worker_state
+    _worker_state = state
+    # the workers share the thread budget
+    budget.set_process_count(nproc)
+    # and only report their own metrics and trace events
+    metrics.reset_metrics()
+    tracing.drain()
+
+def _run_task(args):
+    func, item = args
+    return func(_worker_state, item), metrics.registry.drain(), tracing.drain()
+
+def map_tasks(func, items, state, nproc=1):
+    """
+    Evaluates func(state, item) for every item, in nproc worker processes
+    if nproc > 1. The items are handed out in chunks and the results come
+    back in input order. With the fork start method the workers inherit
+    state (e.g. loaded ML models, predicted monomers) copy-on-write, so only
+    the items and results are pickled. Metrics and trace events recorded in
+    the workers (see `cliff.helpers.metrics` and `cliff.helpers.tracing`)
+    are added to those of the process.
+
+    Parameters
+    ----------
+    func : callable
+        Module-level function of (state, item)
+    items : list
+        Work items
+    state : :class: `dict`
+        Data shared by all work items
+    nproc : :class: `int`
+        Number of worker processes
+
+    Returns
+    -------
+    results : list
+        func(state, item) for every item, in order
+    """
+    if nproc is None or nproc <= 1 or len(items) < 2:
+        return [func(state, item) for item in items]
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+    else:
+        ctx = multiprocessing.get_context()
+
+    nproc = min(nproc, len(items))
+    chunksize = max(1, len(items) // (4*nproc))
+    pool = ctx.Pool(nproc, initializer=_init_worker, initargs=(state, nproc))
+    try:
+        results = pool.map(_run_task, [(func, item) for item in items], chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    for _, drained, events in results:
+        metrics.registry.merge(drained)
+        tracing.merge(events)
+    return [res for res, _, _ in results]
+
+def _get_properties(state, mon):
+    if state['load_path'] is None:
+        return predict_atomic_properties(mon, state['models'], get_property_cache(state['options']))
+    else:
+        return load_atomic_properties(mon, state['load_path'])  
+
+def _system_properties(state, mon):
+    try:
+        return _get_properties(state, mon)
+    except:
+        return None
+
+def _batch_properties(state, mons):
+    valid = [n for n, mon in enumerate(mons) if mon is not None]
+    ret = [None]*len(mons)
+    try:
+        predicted = predict_atomic_properties_batch([mons[n] for n in valid], state['models'],
+                                                    get_property_cache(state['options']))
+    except:
+        # predict the Systems one by one, so only the failing ones are lost
+        predicted = [_system_properties(state, mons[n]) for n in valid]
+    for n, mon in zip(valid, predicted):
+        ret[n] = mon
+    return ret
+
+# Largest number of Systems whose properties are predicted together
+_property_batch_size = 32
+
+def get_monomer_properties(monomers, state, nproc=1):
+    """
+    Predicts (or loads, if state['load_path'] is set) the atomic properties of
+    a list of Systems. When predicting, each geometry is only predicted once:
+    Systems that are rigid-body copies of an earlier one get its properties
+    with the multipoles rotated into place.
+
+    Parameters
+    ----------
+    monomers : list of :class: `~cliff.helpers.System`
+        Systems without atomic properties, entries may be None
+    state : :class: `dict`
+        'options', 'models' and 'load_path', see `map_tasks`
+    nproc : :class: `int`
+        Number of worker processes
+
+    Returns
+    -------
+    monomers : list of :class: `~cliff.helpers.System`
+        Systems with atomic properties, None where the prediction failed
+    """
+    if state['load_path'] is not None:
+        return map_tasks(_system_properties, monomers, state, nproc)
+
+    refs, rots = geometry.find_rigid_copies(monomers)
+    unique = [n for n, ref in enumerate(refs) if ref == n]
+    # unique Systems are predicted in groups, see `predict_atomic_properties_batch`
+    size = max(1, min(_property_batch_size, -(-len(unique) // max(1, nproc or 1))))
+    groups = [[monomers[n] for n in unique[i:i+size]] for i in range(0, len(unique), size)]
+    predicted = [mon for group in map_tasks(_batch_properties, groups, state, nproc) for mon in group]
+
+    ret = [None]*len(monomers)
+    for n, mon in zip(unique, predicted):
+        ret[n] = mon
+    return _fill_copies(ret, monomers, refs, rots, state['options'].logger)
+
+def apnet_monomer_properties(monomers, mols, model_path, logger=None):
+    """
+    AP-Net counterpart of `get_monomer_properties`: predicts the atomic
+    properties of the unique geometries among the Systems monomers, built
+    from the qcel Molecules mols, in one call. The number of reused
+    properties goes to logger, if given.
+    """
+    apnet = _import_apnet()
+    refs, rots = geometry.find_rigid_copies(monomers)
+    unique = [n for n, ref in enumerate(refs) if ref == n]
+    props = apnet.predict_cliff_properties([mols[n] for n in unique], model_path)
+
+    ret = [None]*len(monomers)
+    for n, prop in zip(unique, props):
+        monomers[n].set_properties(prop)
+        ret[n] = monomers[n]
+    return _fill_copies(ret, monomers, refs, rots, logger)
+
+def _import_apnet():
+    # AP-Net pulls in TensorFlow, so it's only imported when an NN model is used
+    try:
+        import apnet
+    except ImportError:
+        raise Exception("ML type NN requested, but APNET not found!")
+    return apnet
+
+def _fill_copies(ret, monomers, refs, rots, logger=None):
+    ncopy = 0
+    for n, ref in enumerate(refs):
+        if ref is None or ref == n or ret[ref] is None:
+            continue
+        ret[n] = geometry.copy_properties(ret[ref], monomers[n], rots[n])
+        ncopy += 1
+    if logger is not None:
+        logger.info(f"Reused atomic properties for {ncopy} duplicate monomers")
+    return ret
+
+def _pair_energy(state, pair):
+    try:
+        mon_a, mon_b = state['mon_a'][pair[0]], state['mon_b'][pair[1]]
+        with _dimer_span(mon_a, mon_b):
+            return energy_kernel(mon_a, mon_b, state['options'], return_pairs=state['return_pairs']) 
+    except:
+        return None
+
+def _dimer_span(mon_a, mon_b):
+    if not tracing.enabled():
+        return tracing.span('dimer')
+    return tracing.span('dimer', mon_a=mon_a.name, mon_b=mon_b.name, natom_a=mon_a.num_atoms, natom_b=mon_b.num_atoms)
+
+def _prepare_monomer(state, mon):
+    try:
+        return PreparedMonomer(state['options'], mon, state['cell'])
+    except:
+        return None
+
+def _prepared_pair_energy(state, pair):
+    try:
+        mon_a, mon_b = state['mon_a'][pair[0]], state['mon_b'][pair[1]]
+        with _dimer_span(mon_a.system, mon_b.system):
+            return pair_energy(mon_a, mon_b, state['options'], return_pairs=state['return_pairs']) 
+    except:
+        return None
+
+def _batch_energy(state, batch):
+    with tracing.span('dimer_batch', ndimer=len(batch)):
+        return _batch_pair_energies(state, batch)
+
+def _batch_pair_energies(state, batch):
+    mons = [(_prepare_monomer(state, state['mon_a'][n]), _prepare_monomer(state, state['mon_b'][n])) for n in batch]
+    valid = [n for n, (a, b) in enumerate(mons) if a is not None and b is not None]
+    ret = [None]*len(mons)
+    try:
+        energies = batch_pair_energies([mons[n][0] for n in valid], [mons[n][1] for n in valid],
+                                       state['options'], return_pairs=state['return_pairs'])
+    except:
+        # evaluate the dimers one by one, so only the failing ones are lost
+        energies = [_prepared_pair_energy({**state, 'mon_a' : [mons[n][0]], 'mon_b' : [mons[n][1]]}, (0, 0))
+                    for n in valid]
+    for n, en in zip(valid, energies):
+        ret[n] = en
+    return ret
+
 def energy_kernel(mon_a, mon_b, options, return_pairs=False):
     
     #defines cell parameters for grid computations
@@ -456,12 +950,17 @@ def energy_kernel(mon_a, mon_b, options, return_pairs=False):
     ind.add_system(mon_b)
     rep.add_system(mon_b)
     disp.add_system(mon_b)
+
+    #the atom-pairwise energies are only built when asked for
+    for comp in [mtp, ind, rep, disp]:
+        comp.decompose = return_pairs
     
-    #computes electrostatic, induction and exchange energies
-    elst_n = mtp.mtp_energy()
-    indu_n = ind.polarization_energy()
-    exch_n = rep.compute_repulsion()
-    disp_en = disp.compute_dispersion()  
+    #computes electrostatic, induction, exchange and dispersion energies,
+    #concurrently with options.component_threads threads
+    elst_n, indu_n, exch_n, disp_en = budget.run_concurrently(
+        [_component(mtp.mtp_energy, 'elst'), _component(ind.polarization_energy, 'indu'),
+         _component(rep.compute_repulsion, 'exch'), _component(disp.compute_dispersion, 'disp')],
+        options.component_threads)
     total = elst_n + indu_n + exch_n + disp_en
 
 
@@ -484,9 +983,10 @@ def load_krr_models(options):
     adens = AtomicDensity(options,None)
     mtp = Multipole(options,None)
 
-    hirsh.load_ml()
-    adens.load_ml()
-    mtp.load_ml()
+    with metrics.timer('model_load'):
+        hirsh.load_ml()
+        adens.load_ml()
+        mtp.load_ml()
 
     return [hirsh,adens,mtp]
 
@@ -507,25 +1007,27 @@ def electrostatic_energy(dimers, ml_type='KRR', load_path=None, return_pairs=Fal
             options = Options(config_file=infile)
 
    
-    energies = []
-    mon_a_list, mon_b_list = fill_monomer_lists(d_list, options, ml_type,load_path )    
+    def evaluate(dimers):
+        energies = []
+        mon_a_list, mon_b_list = fill_monomer_lists(dimers, options, ml_type,load_path )    
 
-    cell = Cell.lattice_parameters(100., 100., 100.)
+        cell = Cell.lattice_parameters(100., 100., 100.)
         
-    for ma, mb in zip(mon_a_list,mon_b_list):
-        mtp = Electrostatics(options,ma, cell)
-        mtp.add_system(mb)
-        en = mtp.mtp_energy()
-     #   try:
-     #       mtp = Electrostatics(options,ma, cell)
-     #       mtp.add_system(mb)
-     #       en = mtp.mtp_energy()
-     #   except:
-     #       en = "Error"
+        for ma, mb in zip(mon_a_list,mon_b_list):
+            mtp = Electrostatics(options,ma, cell)
+            mtp.add_system(mb)
+            en = mtp.mtp_energy()
+         #   try:
+         #       mtp = Electrostatics(options,ma, cell)
+         #       mtp.add_system(mb)
+         #       en = mtp.mtp_energy()
+         #   except:
+         #       en = "Error"
 
-        energies.append(en)
+            energies.append(en)
+        return energies
 
-    return np.asarray(energies) 
+    return np.asarray(_memoized(d_list, options, ml_type, load_path, 'elst', evaluate))
 
 def exchange_energy(dimers, ml_type='KRR', load_path=None, return_pairs=False,infile=None, options=None):
     #defines cell parameters for grid computations
@@ -544,25 +1046,27 @@ def exchange_energy(dimers, ml_type='KRR', load_path=None, return_pairs=False,in
             options = Options(config_file=infile)
 
    
-    energies = []
-    mon_a_list, mon_b_list = fill_monomer_lists(d_list, options, ml_type,load_path )    
+    def evaluate(dimers):
+        energies = []
+        mon_a_list, mon_b_list = fill_monomer_lists(dimers, options, ml_type,load_path )    
 
-    cell = Cell.lattice_parameters(100., 100., 100.)
+        cell = Cell.lattice_parameters(100., 100., 100.)
         
-    for ma, mb in zip(mon_a_list,mon_b_list):
-        rep = Repulsion(options, ma, cell)
-        rep.add_system(mb)
-        en = rep.compute_repulsion()
-     #   try:
-     #       mtp = Electrostatics(options,ma, cell)
-     #       mtp.add_system(mb)
-     #       en = mtp.mtp_energy()
-     #   except:
-     #       en = "Error"
+        for ma, mb in zip(mon_a_list,mon_b_list):
+            rep = Repulsion(options, ma, cell)
+            rep.add_system(mb)
+            en = rep.compute_repulsion()
+         #   try:
+         #       mtp = Electrostatics(options,ma, cell)
+         #       mtp.add_system(mb)
+         #       en = mtp.mtp_energy()
+         #   except:
+         #       en = "Error"
 
-        energies.append(en)
+            energies.append(en)
+        return energies
 
-    return np.asarray(energies) 
+    return np.asarray(_memoized(d_list, options, ml_type, load_path, 'exch', evaluate))
 
 def induction_energy(dimers, ml_type='KRR', load_path=None, return_pairs=False,infile=None, options=None):
     #defines cell parameters for grid computations
@@ -581,18 +1085,20 @@ def induction_energy(dimers, ml_type='KRR', load_path=None, return_pairs=False,i
             options = Options(config_file=infile)
 
    
-    energies = []
-    mon_a_list, mon_b_list = fill_monomer_lists(d_list, options, ml_type,load_path )    
+    def evaluate(dimers):
+        energies = []
+        mon_a_list, mon_b_list = fill_monomer_lists(dimers, options, ml_type,load_path )    
 
-    cell = Cell.lattice_parameters(100., 100., 100.)
+        cell = Cell.lattice_parameters(100., 100., 100.)
         
-    for ma, mb in zip(mon_a_list,mon_b_list):
-        ind = InductionCalc(options,ma, cell)
-        ind.add_system(mb)
-        en = ind.polarization_energy()
-        energies.append(en)
+        for ma, mb in zip(mon_a_list,mon_b_list):
+            ind = InductionCalc(options,ma, cell)
+            ind.add_system(mb)
+            en = ind.polarization_energy()
+            energies.append(en)
+        return energies
 
-    return np.asarray(energies) 
+    return np.asarray(_memoized(d_list, options, ml_type, load_path, 'indu', evaluate))
 
 def dispersion_energy(dimers, ml_type='KRR', load_path=None, return_pairs=False,infile=None, options=None):
     #defines cell parameters for grid computations
@@ -609,22 +1115,25 @@ def dispersion_energy(dimers, ml_type='KRR', load_path=None, return_pairs=False,
         else:
             options = Options(config_file=infile)
    
-    energies = []
-    mon_a_list, mon_b_list = fill_monomer_lists(d_list, options, ml_type,load_path )    
-    cell = Cell.lattice_parameters(100., 100., 100.)
-    for ma, mb in zip(mon_a_list,mon_b_list):
-        disp = Dispersion(options, ma, cell) 
-        disp.add_system(mb)
-        en = disp.compute_dispersion()  
-        energies.append(en)
-    return np.asarray(energies) 
+    def evaluate(dimers):
+        energies = []
+        mon_a_list, mon_b_list = fill_monomer_lists(dimers, options, ml_type,load_path )    
+        cell = Cell.lattice_parameters(100., 100., 100.)
+        for ma, mb in zip(mon_a_list,mon_b_list):
+            disp = Dispersion(options, ma, cell) 
+            disp.add_system(mb)
+            en = disp.compute_dispersion()  
+            energies.append(en)
+        return energies
+
+    return np.asarray(_memoized(d_list, options, ml_type, load_path, 'disp', evaluate))
 
 def fill_monomer_lists(d_list, options, ml_type, load_path):
 
     mon_a_list = []
     mon_b_list = []
 
-    s = time.time()
+    s = time.perf_counter()
     if ml_type.upper() == "KRR":
         # get atomic properties
         if load_path is None:
@@ -651,11 +1160,11 @@ def fill_monomer_lists(d_list, options, ml_type, load_path):
         model_path = os.path.dirname(os.path.realpath(__file__))
         model_path += '/models/apnet/cliff_pbe0atz.h5'
 
-        s1 = time.time()
-        ma_props = apnet.predict_cliff_properties(ma_s, model_path)
-        mb_props = apnet.predict_cliff_properties(mb_s, model_path)
-        f1 = time.time()
-        print(f"apnet time: {f1-s1} s")
+        apnet = _import_apnet()
+        with metrics.timer('apnet') as timing:
+            ma_props = apnet.predict_cliff_properties(ma_s, model_path)
+            mb_props = apnet.predict_cliff_properties(mb_s, model_path)
+        print(f"apnet time: {timing['seconds']} s")
 
         for nd, dimer in enumerate(d_list):        
             mon_a, mon_b = mol_to_sys(dimer, options)
@@ -668,6 +1177,7 @@ def fill_monomer_lists(d_list, options, ml_type, load_path):
     else:
         raise Exception(f"ML type {ml_type} not understood!") 
 
-    f = time.time()
+    f = time.perf_counter()
+    metrics.observe('cliff_stage_seconds', f-s, stage='properties')
     print(f"Time spent predicting atomic properties: {f-s} s")
     return mon_a_list, mon_b_list
@@ -9,14 +9,233 @@ Functions for fitting global parameters
 
 import math
 import numpy as np 
-import scipy.optimize as opt
 import json
 import operator
 import glob
 import pprint
+import multiprocessing
 
 import cliff
 from cliff.helpers.options import Options
+from cliff.helpers.cell import Cell
+import cliff.helpers.constants as constants
+from cliff.components.electrostatics import Electrostatics
+from cliff.components.repulsion import Repulsion
+from cliff.components.induction_calc import InductionCalc
+from cliff.components.dispersion import Dispersion
+
+# Ordering of the 17 per-type parameters in every parameter vector below,
+# identical to System.master_atom_types
+master_atom_types = ['Cl','F','S1','S2','HS','HC','HN','HO','C4','C3','C2','N3','N2','N1','O1','O2','Br']
+
+def type_indices(sys):
+    """
+    Index of each atom's type in `master_atom_types`
+    """
+    return sys.type_index.astype(int)
+
+def reduce_type_pairs(mat, types_a, types_b):
+    """
+    Sums an atom-pair matrix into a type-pair matrix, so that
+    sum_ab U[t_a] mat_ab U[t_b] = U^T red U for any per-type vector U.
+    """
+    ntypes = len(master_atom_types)
+    red = np.zeros((ntypes, ntypes))
+    np.add.at(red, (types_a[:,None], types_b[None,:]), mat)
+    return red
+
+def load_fit_data(pathname, options, ml_type='NN'):
+    """
+    Predicts atomic properties for all dimers in a directory once and reduces
+    every parameter-independent part of the bilinear energy terms to
+    per-dimer type-pair tensors.
+
+    Exchange and the short-range induction term are both sum_ab U_a U_b S_ab,
+    and the C8/C10 dispersion term scales with disp_coeffs[A]*disp_coeffs[B],
+    so each dimer collapses into a (17,17) matrix over `master_atom_types`.
+
+    Parameters
+    ----------
+    pathname : :class: `str`
+        Path to the dimer xyz files.
+    options : :class: `~cliff.helpers.Options`
+        Options used for everything that is not being fitted.
+    ml_type : :class: `str`
+        Model used for the atomic properties, 'NN' or 'KRR'.
+
+    Returns
+    -------
+    fit_data : :class: `dict`
+        'mon_a', 'mon_b' : lists of :class: `~cliff.helpers.System` with atomic properties
+        'ovp' : Slater overlaps, (ndimer,17,17), kcal/mol
+        'disp_c6' : C6 dispersion energies, (ndimer,), kcal/mol
+        'disp_hi' : C8/C10 dispersion energies before scaling, (ndimer,17,17), kcal/mol
+        'index' : dimers the per-dimer entries refer to, see `batch_fit_data`
+    """
+
+    dimer_xyz = sorted(glob.glob(pathname + "/*.xyz"))
+    dimers = [cliff.load_dimer_xyz(f) for f in dimer_xyz]
+    mon_a_list, mon_b_list = cliff.fill_monomer_lists(dimers, options, ml_type, None)
+
+    cell = Cell.lattice_parameters(100., 100., 100.)
+    ntypes = len(master_atom_types)
+    ndimer = len(dimers)
+
+    ovp = np.zeros((ndimer, ntypes, ntypes))
+    disp_c6 = np.zeros(ndimer)
+    disp_hi = np.zeros((ndimer, ntypes, ntypes))
+    for n, (ma, mb) in enumerate(zip(mon_a_list, mon_b_list)):
+        types_a = type_indices(ma)
+        types_b = type_indices(mb)
+
+        rep = Repulsion(options, ma, cell)
+        ovp[n] = reduce_type_pairs(rep.overlap_matrix(ma, mb), types_a, types_b)
+
+        disp = Dispersion(options, ma, cell)
+        disp.add_system(mb)
+        e6, e_hi = disp.compute_tt_pair_terms()
+        disp_c6[n] = np.sum(e6)
+        disp_hi[n] = reduce_type_pairs(e_hi, types_a, types_b)
+
+    fit_data = {
+        'options' : options,
+        'mon_a' : mon_a_list,
+        'mon_b' : mon_b_list,
+        'ovp' : ovp * constants.au2kcalmol,
+        'disp_c6' : disp_c6 * constants.au2kcalmol,
+        'disp_hi' : disp_hi * constants.au2kcalmol,
+        'pol' : {},
+        'index' : np.arange(ndimer),
+    }
+    return fit_data
+
+def bilinear_energy(params, tensors):
+    """
+    Energies U^T S_n U for every dimer n, with U = |params|, and their
+    gradient with respect to params, shape (ndimer, 17).
+    """
+    u = np.abs(params)
+    en = np.einsum('a,nab,b->n', u, tensors, u)
+    grad = np.einsum('nab,b->na', tensors, u) + np.einsum('nab,a->nb', tensors, u)
+    grad *= np.sign(params)
+    return en, grad
+
+def rmse_gradient(res, grad):
+    """
+    RMSE of the residuals res = ref - en and its gradient, given
+    grad = d en / d params with shape (ndimer, nparams).
+    """
+    rmse = np.sqrt(np.average(np.square(res)))
+    if rmse == 0.0:
+        return rmse, np.zeros(grad.shape[1])
+    return rmse, -np.dot(res, grad) / (len(res) * rmse)
+
+def param_dict(params):
+    """
+    Per-type parameter dictionary {type : |param|} over `master_atom_types`
+    """
+    return {typ : abs(p) for typ, p in zip(master_atom_types, params)}
+
+def batch_fit_data(fit_data, idx):
+    """
+    View of fit_data restricted to the dimers idx, sharing the monomers,
+    the polarization cache and the process pool with fit_data
+    """
+    batch = dict(fit_data)
+    batch['index'] = fit_data['index'][idx]
+    for key in ['ovp', 'disp_c6', 'disp_hi']:
+        batch[key] = fit_data[key][idx]
+    return batch
+
+# fit_data of a pool worker, inherited from the parent on fork
+_worker_data = None
+
+def _init_worker(fit_data):
+    global _worker_data
+    _worker_data = fit_data
+
+def _run_worker(args):
+    func, arg, idx = args
+    return func(_worker_data, arg, idx)
+
+def start_pool(fit_data, nproc):
+    """
+    Starts a process pool over which the per-dimer energies of fit_data are
+    split. With the fork start method the workers share the precomputed
+    monomers with the parent instead of receiving copies.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+    else:
+        ctx = multiprocessing.get_context()
+    shared = {key : val for key, val in fit_data.items() if key != 'pool'}
+    fit_data['pool'] = ctx.Pool(nproc, initializer=_init_worker, initargs=(shared,))
+    fit_data['nproc'] = nproc
+    return fit_data['pool']
+
+def map_dimers(fit_data, func, arg, idx):
+    """
+    Evaluates func(fit_data, arg, idx) for the dimers idx, split over the
+    process pool of fit_data if there is one. func returns a tuple of arrays
+    over idx.
+    """
+    pool = fit_data.get('pool')
+    if pool is None or len(idx) < 2:
+        return func(fit_data, arg, idx)
+    chunks = [c for c in np.array_split(idx, fit_data['nproc']) if len(c) > 0]
+    res = pool.map(_run_worker, [(func, arg, c) for c in chunks])
+    return tuple(np.concatenate(r) for r in zip(*res))
+
+def _elst_chunk(fit_data, exponents, idx):
+    options = fit_data['options']
+    options.set_damping_exponents(param_dict(exponents))
+    cell = Cell.lattice_parameters(100., 100., 100.)
+    en = np.zeros(len(idx))
+    grad = np.zeros((len(idx), len(master_atom_types)))
+    for i, n in enumerate(idx):
+        elst = Electrostatics(options, fit_data['mon_a'][n], cell)
+        elst.add_system(fit_data['mon_b'][n])
+        en[i], grad[i] = elst.mtp_energy_gradient()
+    return en, grad
+
+def _pol_chunk(fit_data, smearing_coeff, idx):
+    cell = Cell.lattice_parameters(100., 100., 100.)
+    en = np.zeros(len(idx))
+    grad = np.zeros(len(idx))
+    for i, n in enumerate(idx):
+        ind = InductionCalc(fit_data['options'], fit_data['mon_a'][n], cell)
+        ind.add_system(fit_data['mon_b'][n])
+        en[i], grad[i] = ind.polarization_energy_gradient(smearing_coeff=smearing_coeff)
+    return en, grad
+
+def electrostatic_energies(fit_data, exponents):
+    """
+    Electrostatic energies for all dimers and their derivatives with respect
+    to the damping exponent of each type, shape (ndimer, 17).
+    """
+    en, grad = map_dimers(fit_data, _elst_chunk, exponents, fit_data['index'])
+    return en, grad * np.sign(exponents)
+
+def polarization_energies(fit_data, smearing_coeff):
+    """
+    Thole polarization part of the induction energy for all dimers and its
+    derivative with respect to the smearing coefficient, memoized per dimer
+    on the smearing coefficient.
+    """
+    cache = fit_data['pol']
+    key = float(smearing_coeff)
+    if key not in cache:
+        if len(cache) > 100:
+            cache.clear()
+        ndimer = len(fit_data['mon_a'])
+        cache[key] = (np.full(ndimer, np.nan), np.full(ndimer, np.nan))
+    en, grad = cache[key]
+
+    idx = fit_data['index']
+    missing = idx[np.isnan(en[idx])]
+    if len(missing) > 0:
+        en[missing], grad[missing] = map_dimers(fit_data, _pol_chunk, key, missing)
+    return en[idx], grad[idx]
 
 def get_elst_energy(params, pathname, ref):
     elst_param_dict = {
@@ -182,6 +401,51 @@ def get_disp_energy(params, pathname, ref):
 
     return rmse
 
+def get_exch_energy_reduced(params, fit_data, ref):
+    """
+    RMSE of exchange energies and its gradient from precomputed type-pair overlaps
+    """
+    en, grad = bilinear_energy(params, fit_data['ovp'])
+    rmse, drmse = rmse_gradient(ref[:,2] - en, grad)
+
+    return rmse, drmse
+
+def get_elst_energy_reduced(params, fit_data, ref):
+    """
+    RMSE of electrostatic energies and its gradient with respect to the damping exponents
+    """
+    en, grad = electrostatic_energies(fit_data, params)
+    rmse, drmse = rmse_gradient(ref[:,1] - en, grad)
+
+    return rmse, drmse
+
+def get_indu_energy_reduced(params, fit_data, ref):
+    """
+    RMSE of induction energies and its gradient. The short-range part uses the
+    precomputed type-pair overlaps; the polarization part only depends on the
+    smearing coefficient (params[17]).
+    """
+    sr, grad_sr = bilinear_energy(params[:17], fit_data['ovp'])
+    pol, dpol = polarization_energies(fit_data, abs(params[17]))
+
+    grad = np.zeros((len(pol), 18))
+    grad[:,:17] = -grad_sr
+    grad[:,17] = dpol * np.sign(params[17])
+
+    rmse, drmse = rmse_gradient(ref[:,3] - (pol - sr), grad)
+
+    return rmse, drmse
+
+def get_disp_energy_reduced(params, fit_data, ref):
+    """
+    RMSE of dispersion energies and its gradient from precomputed type-pair C8/C10 terms
+    """
+    en, grad = bilinear_energy(params, fit_data['disp_hi'])
+    en += fit_data['disp_c6']
+    rmse, drmse = rmse_gradient(ref[:,4] - en, grad)
+
+    return rmse, drmse
+
 def get_energy(params, pathname, gamma, ref):
 
 
@@ -325,7 +589,95 @@ def get_energy(params, pathname, gamma, ref):
     print(f"Multi-target metric (gamma = {gamma}): {ret_val}")
     return ret_val
 
-def fit_global_parameters(pathname, ref_dict, initial_guess=None,gamma=0.4, method='bfgs'):
+def get_energy_reduced(params, fit_data, gamma, ref):
+    """
+    Multi-target metric of `get_energy` and its gradient with respect to all
+    69 parameters, ordered as in `get_energy`.
+    """
+    ndimer = len(ref)
+    grad = np.zeros((4, ndimer, len(params)))
+
+    elst_e, grad[0,:,:17] = electrostatic_energies(fit_data, params[:17])
+
+    exch_e, grad[1,:,17:34] = bilinear_energy(params[17:34], fit_data['ovp'])
+
+    sr, grad_sr = bilinear_energy(params[35:52], fit_data['ovp'])
+    pol, dpol = polarization_energies(fit_data, abs(params[34]))
+    indu_e = pol - sr
+    grad[2,:,34] = dpol * np.sign(params[34])
+    grad[2,:,35:52] = -grad_sr
+
+    disp_e, grad[3,:,52:] = bilinear_energy(params[52:], fit_data['disp_hi'])
+    disp_e += fit_data['disp_c6']
+
+    err = ref[:,1:5] - np.array([elst_e, exch_e, indu_e, disp_e]).T
+    total_err = ref[:,0] - np.sum(ref[:,1:5] - err, axis=1)
+    mse = np.average(np.square(err), axis=0)
+    mse_total = np.average(np.square(total_err))
+
+    # d mse / d params = -2 <err * d en / d params>
+    dmse = -2.0 * np.einsum('nc,cnp->p', err, grad) / ndimer
+    dmse_total = -2.0 * np.einsum('n,cnp->p', total_err, grad) / ndimer
+
+    ret_val = gamma * np.sum(mse) + (1.0-gamma) * mse_total
+    return ret_val, gamma * dmse + (1.0-gamma) * dmse_total
+
+def minibatch_minimize(fun, x0, fit_data, ref, args=(), batch_size=64, epochs=10, learning_rate=0.01, seed=None):
+    """
+    Adam over random subsets of the dimers. fun(params, fit_data, *args, ref)
+    returns the objective and its gradient, as the get_*_reduced functions do.
+    The mean objective over the mini-batches is printed once per epoch.
+
+    Returns
+    -------
+    params : :class: `~numpy.ndarray`
+        Parameters after the last epoch
+    """
+    rng = np.random.default_rng(seed)
+    params = np.array(x0, dtype=float)
+    m = np.zeros(len(params))
+    v = np.zeros(len(params))
+    beta1 = 0.9
+    beta2 = 0.999
+    t = 0
+    ndimer = len(ref)
+    for epoch in range(epochs):
+        perm = rng.permutation(ndimer)
+        vals = []
+        for start in range(0, ndimer, batch_size):
+            idx = perm[start:start+batch_size]
+            val, grad = fun(params, batch_fit_data(fit_data, idx), *args, ref[idx])
+            vals.append(val)
+            t += 1
+            m = beta1*m + (1.0-beta1)*grad
+            v = beta2*v + (1.0-beta2)*np.square(grad)
+            m_hat = m / (1.0 - beta1**t)
+            v_hat = v / (1.0 - beta2**t)
+            params -= learning_rate * m_hat / (np.sqrt(v_hat) + 1e-8)
+        print(f"Epoch {epoch+1}: objective {np.mean(vals)}")
+    return params
+
+def run_fit(fun, initial_guess, fit_data, ref, args=(), method='bfgs', nproc=1, batch_size=None, epochs=10, learning_rate=0.01):
+    """
+    Minimizes fun over the dimers of fit_data, optionally with nproc worker
+    processes and a mini-batch stage before the full-batch minimization.
+    """
+    import scipy.optimize as opt
+    if nproc > 1:
+        start_pool(fit_data, nproc)
+    try:
+        if batch_size is not None:
+            initial_guess = minibatch_minimize(fun, initial_guess, fit_data, ref, args,
+                                batch_size=batch_size, epochs=epochs, learning_rate=learning_rate)
+        res = opt.minimize(fun, initial_guess, method=method, jac=True, args=(fit_data,) + tuple(args) + (ref,))
+    finally:
+        pool = fit_data.pop('pool', None)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return res
+
+def fit_global_parameters(pathname, ref_dict, initial_guess=None,gamma=0.4, method='bfgs', nproc=1, batch_size=None, epochs=10, learning_rate=0.01):
 
     """
     Fits global parameters used in CLIFF
@@ -349,6 +701,15 @@ def fit_global_parameters(pathname, ref_dict, initial_guess=None,gamma=0.4, meth
         energy influences fitting.
     method: :class: `str`
         Algorithm used for minimization. See scipy.minimize documentation for all options
+    nproc : :class: `int`
+        Number of processes over which the dimers are split
+    batch_size : :class: `int`
+        If given, first optimize with Adam on random subsets of this many dimers
+        before the final full-batch minimization
+    epochs : :class: `int`
+        Number of passes over the dimers in the mini-batch stage
+    learning_rate : :class: `float`
+        Adam step size in the mini-batch stage
     
     """
 
@@ -359,7 +720,7 @@ def fit_global_parameters(pathname, ref_dict, initial_guess=None,gamma=0.4, meth
         if len(initial_guess) != 69:
             raise Exception("Initial guess has the wrong dimension")
     else:
-        initial_guess = np.ones(70)
+        initial_guess = np.ones(69)
 
     ref = []
     dimer_xyz = sorted(glob.glob(pathname + "/*.xyz"))
@@ -367,11 +728,13 @@ def fit_global_parameters(pathname, ref_dict, initial_guess=None,gamma=0.4, meth
         key = dimer.split('/')[-1].split('.xyz')[0]
         ref.append(ref_dict[key])
     ref = np.asarray(ref)
-    res = opt.minimize(get_energy, initial_guess, method=method, args=(pathname, gamma,ref))
+    fit_data = load_fit_data(pathname, Options('config.ini'), ml_type='KRR')
+    res = run_fit(get_energy_reduced, initial_guess, fit_data, ref, args=(gamma,), method=method,
+                  nproc=nproc, batch_size=batch_size, epochs=epochs, learning_rate=learning_rate)
     print(res)
     return res
 
-def fit_elst_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs'):
+def fit_elst_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs', nproc=1, batch_size=None, epochs=10, learning_rate=0.01):
     """
     Fit exponents used in electrostatics model
 
@@ -393,6 +756,15 @@ def fit_elst_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         energy influences fitting.
     method: :class: `str`
         Algorithm used for minimization. See scipy.minimize documentation for all options
+    nproc : :class: `int`
+        Number of processes over which the dimers are split
+    batch_size : :class: `int`
+        If given, first optimize with Adam on random subsets of this many dimers
+        before the final full-batch minimization
+    epochs : :class: `int`
+        Number of passes over the dimers in the mini-batch stage
+    learning_rate : :class: `float`
+        Adam step size in the mini-batch stage
     
     """
 
@@ -412,11 +784,13 @@ def fit_elst_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         key = dimer
         ref.append(ref_dict[key])
     ref = np.asarray(ref)
-    res = opt.minimize(get_elst_energy, initial_guess, method=method, args=(pathname, ref))
+    fit_data = load_fit_data(pathname, Options('config.ini'))
+    res = run_fit(get_elst_energy_reduced, initial_guess, fit_data, ref, method=method,
+                  nproc=nproc, batch_size=batch_size, epochs=epochs, learning_rate=learning_rate)
     print(res)
     return res
 
-def fit_exch_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs'):
+def fit_exch_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs', nproc=1, batch_size=None, epochs=10, learning_rate=0.01):
     """
     Fit exchange coefficients
 
@@ -438,6 +812,15 @@ def fit_exch_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         energy influences fitting.
     method: :class: `str`
         Algorithm used for minimization. See scipy.minimize documentation for all options
+    nproc : :class: `int`
+        Number of processes over which the dimers are split
+    batch_size : :class: `int`
+        If given, first optimize with Adam on random subsets of this many dimers
+        before the final full-batch minimization
+    epochs : :class: `int`
+        Number of passes over the dimers in the mini-batch stage
+    learning_rate : :class: `float`
+        Adam step size in the mini-batch stage
     
     """
 
@@ -455,11 +838,13 @@ def fit_exch_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         key = dimer
         ref.append(ref_dict[key])
     ref = np.asarray(ref)
-    res = opt.minimize(get_exch_energy, initial_guess, method=method, args=(pathname, ref))
+    fit_data = load_fit_data(pathname, Options('config.ini'))
+    res = run_fit(get_exch_energy_reduced, initial_guess, fit_data, ref, method=method,
+                  nproc=nproc, batch_size=batch_size, epochs=epochs, learning_rate=learning_rate)
     print(res)
     return res
 
-def fit_indu_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs'):
+def fit_indu_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs', nproc=1, batch_size=None, epochs=10, learning_rate=0.01):
     """
     Fit induction coefficients
 
@@ -481,6 +866,15 @@ def fit_indu_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         energy influences fitting.
     method: :class: `str`
         Algorithm used for minimization. See scipy.minimize documentation for all options
+    nproc : :class: `int`
+        Number of processes over which the dimers are split
+    batch_size : :class: `int`
+        If given, first optimize with Adam on random subsets of this many dimers
+        before the final full-batch minimization
+    epochs : :class: `int`
+        Number of passes over the dimers in the mini-batch stage
+    learning_rate : :class: `float`
+        Adam step size in the mini-batch stage
     
     """
 
@@ -498,11 +892,13 @@ def fit_indu_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         key = dimer
         ref.append(ref_dict[key])
     ref = np.asarray(ref)
-    res = opt.minimize(get_indu_energy, initial_guess, method=method, args=(pathname, ref))
+    fit_data = load_fit_data(pathname, Options('config.ini'))
+    res = run_fit(get_indu_energy_reduced, initial_guess, fit_data, ref, method=method,
+                  nproc=nproc, batch_size=batch_size, epochs=epochs, learning_rate=learning_rate)
     print(res)
     return res
 
-def fit_disp_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs'):
+def fit_disp_global_parameters(pathname, ref_dict, initial_guess=None, method='bfgs', nproc=1, batch_size=None, epochs=10, learning_rate=0.01):
     """
     Fit dispersion coefficients
 
@@ -524,6 +920,15 @@ def fit_disp_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         energy influences fitting.
     method: :class: `str`
         Algorithm used for minimization. See scipy.minimize documentation for all options
+    nproc : :class: `int`
+        Number of processes over which the dimers are split
+    batch_size : :class: `int`
+        If given, first optimize with Adam on random subsets of this many dimers
+        before the final full-batch minimization
+    epochs : :class: `int`
+        Number of passes over the dimers in the mini-batch stage
+    learning_rate : :class: `float`
+        Adam step size in the mini-batch stage
     
     """
 
@@ -541,6 +946,8 @@ def fit_disp_global_parameters(pathname, ref_dict, initial_guess=None, method='b
         key = dimer
         ref.append(ref_dict[key])
     ref = np.asarray(ref)
-    res = opt.minimize(get_disp_energy, initial_guess, method=method, args=(pathname, ref))
+    fit_data = load_fit_data(pathname, Options('config.ini'))
+    res = run_fit(get_disp_energy_reduced, initial_guess, fit_data, ref, method=method,
+                  nproc=nproc, batch_size=batch_size, epochs=epochs, learning_rate=learning_rate)
     print(res)
     return res
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Budget of threads shared by worker processes, component threads and BLAS
+#
+
+import os
+import re
+import ctypes
+import threading
+import contextlib
+
+
+# total number of threads, None for all CPUs available to the process
+_total = None
+# number of worker processes sharing the budget, set in the workers of `cliff.map_tasks`
+_nproc = 1
+
+def cpu_count():
+    '''
+    Number of CPUs the process may run on
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def get_thread_budget():
+    return cpu_count() if _total is None else _total
+
+def set_thread_budget(nthread):
+    '''
+    Sets the total number of threads CLIFF may use, None or 0 for all CPUs
+    '''
+    global _total
+    _total = None if nthread is None or nthread <= 0 else int(nthread)
+
+def set_process_count(nproc):
+    '''
+    Sets the number of processes that share the budget
+    '''
+    global _nproc
+    _nproc = max(1, nproc or 1)
+
+def split_budget(nproc=1, threads=1):
+    '''
+    Splits the thread budget among nproc processes running up to threads
+    component threads each, so that processes x threads x BLAS threads
+    stays within the budget.
+
+    Returns
+    -------
+    threads : :class: `int`
+        Component threads per process
+    blas : :class: `int`
+        BLAS threads per component thread
+    '''
+    per_proc = max(1, get_thread_budget() // max(1, nproc or 1))
+    threads = max(1, min(threads or 1, per_proc))
+    return threads, max(1, per_proc // threads)
+
+# (set, get) functions of the thread pools of the libraries NumPy and SciPy
+# may be linked to, OpenBLAS with or without the prefix and suffix of its
+# scipy-openblas and 64-bit integer builds
+_pool_functions = [(p + 'openblas_set_num_threads' + s, p + 'openblas_get_num_threads' + s)
+                   for p in ['', 'scipy_'] for s in ['', '64_']]
+_pool_functions += [('MKL_Set_Num_Threads', 'MKL_Get_Max_Threads'),
+                    ('bli_thread_set_num_threads', 'bli_thread_get_num_threads'),
+                    ('omp_set_num_threads', 'omp_get_max_threads')]
+_pool_libraries = re.compile('blas|mkl|blis|gomp|iomp|libomp')
+# library path: its (set, get) functions
+_pools = {}
+# (pid, pools) of `thread_pools`
+_pool_cache = None
+# guards the pool sizes, changed by concurrent `limit_blas` and `ThreadBudget`
+_blas_lock = threading.RLock()
+# nthread of the active `limit_blas` contexts, and the sizes from before the first
+_blas_limits = []
+_blas_unlimited = None
+
+def thread_pools(refresh=False):
+    '''
+    (set, get) functions of the BLAS and OpenMP thread pools loaded in the
+    process, through threadpoolctl if it's installed and otherwise from
+    the libraries mapped into the process (Linux only). The pools are
+    found once per process, refresh looks again for libraries loaded since.
+    '''
+    global _pool_cache
+    with _blas_lock:
+        if refresh or _pool_cache is None or _pool_cache[0] != os.getpid():
+            _pool_cache = (os.getpid(), _find_pools())
+        return _pool_cache[1]
+
+def _find_pools():
+    try:
+        from threadpoolctl import ThreadpoolController
+    except ImportError:
+        pass
+    else:
+        return [(lib.set_num_threads, lambda lib=lib: lib.num_threads)
+                for lib in ThreadpoolController().lib_controllers]
+
+    try:
+        with open('/proc/self/maps') as maps:
+            paths = {line.split()[-1] for line in maps if '.so' in line}
+    except OSError:
+        return []
+    # libraries are loaded once, as NumPy and SciPy import them
+    for path in paths - set(_pools):
+        _pools[path] = []
+        if not _pool_libraries.search(os.path.basename(path)):
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for set_name, get_name in _pool_functions:
+            if hasattr(lib, set_name) and hasattr(lib, get_name):
+                _pools[path].append((getattr(lib, set_name), getattr(lib, get_name)))
+    # the libraries linking to a pool find its functions too
+    pools = {}
+    for path in sorted(paths):
+        for pool in _pools.get(path, []):
+            pools.setdefault(ctypes.cast(pool[0], ctypes.c_void_p).value, pool)
+    return list(pools.values())
+
+def get_blas_threads():
+    '''
+    Sizes of the thread pools, see `thread_pools`
+    '''
+    return [get() for _, get in thread_pools()]
+
+def set_blas_threads(nthread):
+    '''
+    Sets the size of all thread pools (see `thread_pools`) to nthread, and
+    returns what's needed to undo it with `restore_blas_threads`
+    '''
+    with _blas_lock:
+        previous = [(set_threads, get()) for set_threads, get in thread_pools()]
+        for set_threads, _ in previous:
+            set_threads(int(nthread))
+        return previous
+
+def restore_blas_threads(previous):
+    with _blas_lock:
+        for set_threads, nthread in previous:
+            set_threads(nthread)
+
+@contextlib.contextmanager
+def limit_blas(nthread):
+    '''
+    Limits the BLAS and OpenMP thread pools to nthread threads in the
+    context. The pools are shared by the threads of the process, so
+    concurrent limits get the smallest of them, and the sizes from before
+    the first are restored when the last one ends.
+    '''
+    global _blas_unlimited
+    with _blas_lock:
+        if len(_blas_limits) == 0:
+            _blas_unlimited = [(set_threads, get()) for set_threads, get in thread_pools()]
+        _blas_limits.append(nthread)
+        set_blas_threads(min(_blas_limits))
+    try:
+        yield
+    finally:
+        with _blas_lock:
+            _blas_limits.remove(nthread)
+            if len(_blas_limits) == 0:
+                restore_blas_threads(_blas_unlimited)
+                _blas_unlimited = None
+            else:
+                set_blas_threads(min(_blas_limits))
+
+
+class ThreadBudget:
+    '''
+    Runtime control of the number of threads: sets the total budget, and
+    sizes the BLAS and OpenMP pools of the process to the share of nproc
+    worker processes (which inherit them). The pools are resized in place,
+    unlike the environment variables OMP_NUM_THREADS etc. that are only read
+    when NumPy is imported. Component threads (see `run_concurrently`) are
+    taken out of the same budget.
+
+    Applied by `apply` or on entering a with block, and undone by `restore`
+    or on leaving it:
+
+        with ThreadBudget(8, nproc=4):
+            cliff.predict_from_dimers(dimers, nproc=4)
+
+    Parameters
+    ----------
+    nthread : :class: `int`
+        Total number of threads, None for all CPUs
+    nproc : :class: `int`
+        Number of worker processes sharing them
+    '''
+
+    def __init__(self, nthread=None, nproc=1):
+        self.nthread = nthread
+        self.nproc = max(1, nproc or 1)
+        self.previous = None
+
+    def apply(self):
+        global _total
+        previous = _total
+        env = {var : os.environ.get(var) for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']}
+        set_thread_budget(self.nthread)
+        blas = max(1, get_thread_budget() // self.nproc)
+        # libraries may have been loaded since the pools were last looked for
+        thread_pools(refresh=True)
+        self.previous = (previous, set_blas_threads(blas), env)
+        # for processes started later, e.g. with the spawn start method
+        for var in env:
+            os.environ[var] = str(blas)
+        return self
+
+    def restore(self):
+        global _total
+        if self.previous is None:
+            return
+        _total, blas, env = self.previous
+        restore_blas_threads(blas)
+        for var, val in env.items():
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = val
+        self.previous = None
+
+    def __enter__(self):
+        if self.previous is None:
+            self.apply()
+        return self
+
+    def __exit__(self, *args):
+        self.restore()
+
+
+# thread pool of the process, (pid, threads, executor)
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor(threads):
+    global _executor
+    with _executor_lock:
+        # forked worker processes don't inherit the threads of the pool
+        if _executor is None or _executor[0] != os.getpid() or _executor[1] != threads:
+            import concurrent.futures
+            if _executor is not None and _executor[0] == os.getpid():
+                _executor[2].shutdown(wait=False)
+            _executor = (os.getpid(), threads, concurrent.futures.ThreadPoolExecutor(max_workers=threads))
+        return _executor[2]
+
+def run_concurrently(funcs, threads=1):
+    '''
+    Results of the calls of funcs, in order, computed in up to threads
+    threads of a pool shared by the process. The number of threads is cut
+    to the budget left by the worker processes, and BLAS gets the rest.
+    NumPy releases the GIL in the array operations, so independent energy
+    components overlap. With a single thread the calls run one by one.
+
+    Parameters
+    ----------
+    funcs : list of callables
+        Functions without arguments
+    threads : :class: `int`
+        Largest number of threads
+
+    Returns
+    -------
+    results : list
+        func() for every func; an exception of a call is raised
+    '''
+    threads, _ = split_budget(_nproc, threads)
+    if threads <= 1 or len(funcs) < 2:
+        return [func() for func in funcs]
+
+    executor = _get_executor(threads)
+    _, blas = split_budget(_nproc, min(threads, len(funcs)))
+    with limit_blas(blas):
+        futures = [executor.submit(func) for func in funcs]
+        return [future.result() for future in futures]
@@ -41,3 +41,14 @@ class Cell():
         s_12  = np.dot(self.celli, coords2) - np.dot(self.celli, coords1)
         s_12 -= np.rint(s_12)
         return np.dot(self.cellh, s_12)
+
+    def pbc_distances(self, coords1, coords2):
+        '''
+        Minimum-image vectors coords2[j] - coords1[i], shape (n1,n2,3).
+        Leading batch dimensions of coords1 (...,n1,3) and coords2 (...,n2,3)
+        are kept, giving (...,n1,n2,3).
+        '''
+        s_12  = np.dot(np.asarray(coords2), self.celli.T)[...,None,:,:] \
+              - np.dot(np.asarray(coords1), self.celli.T)[...,:,None,:]
+        s_12 -= np.rint(s_12)
+        return np.dot(s_12, self.cellh.T)
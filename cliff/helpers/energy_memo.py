@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# SQLite memo of dimer energies, keyed by geometry and parameters
+#
+
+import os
+import io
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from cliff.helpers.property_cache import model_version
+
+
+def parameter_hash(options):
+    '''
+    Hash of the options the energies depend on: the component parameters
+    and the version of the atomic property models
+    '''
+    params = [options.elst_type, options.elst_damping_exponents, options.indu_sr_params,
+              options.indu_smearing_coeff, options.indu_omega, options.indu_conv, options.exch_int_params,
+              options.disp_coeffs, options.pol_scs_cutoff, options.disp_beta, options.disp_radius,
+              options.pol_exponent, getattr(options, 'disp_method', None)]
+    key = hashlib.sha1()
+    # dicts are sorted so the hash doesn't depend on their insertion order
+    key.update(repr([sorted(p.items()) if isinstance(p, dict) else p for p in params]).encode())
+    key.update(model_version(options).encode())
+    return key.hexdigest()
+
+
+def dimer_key(mon_a, mon_b, params, kind, decimals=5, extra=""):
+    '''
+    Memo key of the kind of result (e.g. 'energies', 'pairs', 'elst') of
+    the dimer of Systems mon_a and mon_b with parameter hash params
+    '''
+    key = hashlib.sha1()
+    key.update(f"{params} {kind} {extra}".encode())
+    for mon in [mon_a, mon_b]:
+        key.update((" ".join(mon.elements) + ";").encode())
+        # + 0.0 turns -0.0 into 0.0
+        key.update((np.round(np.asarray(mon.coords, dtype=float), decimals) + 0.0).tobytes())
+    return key.hexdigest()
+
+
+class EnergyMemo:
+    '''
+    Results of dimer evaluations in an SQLite database, see `dimer_key`.
+    Safe to share between threads; several processes may use the same
+    database.
+
+    Parameters
+    ----------
+    path : :class: `str`
+        Database file, created if needed
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value BLOB)")
+
+    def get(self, keys):
+        '''
+        Memoized arrays of keys, None where there's none
+        '''
+        found = {}
+        with self.lock:
+            # in slices, as the number of parameters in a query is limited
+            for n in range(0, len(keys), 500):
+                part = keys[n:n+500]
+                query = "SELECT key, value FROM memo WHERE key IN (%s)" % ",".join("?"*len(part))
+                for key, value in self.db.execute(query, part):
+                    found[key] = np.load(io.BytesIO(value), allow_pickle=False)
+        return [found.get(key) for key in keys]
+
+    def put(self, items):
+        '''
+        Stores (key, array) items
+        '''
+        rows = []
+        for key, value in items:
+            buf = io.BytesIO()
+            np.save(buf, np.asarray(value), allow_pickle=False)
+            rows.append((key, buf.getvalue()))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO memo (key, value) VALUES (?, ?)", rows)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM memo").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+# open memos, one connection per database and process
+_memos = {}
+
+def get_energy_memo(options):
+    '''
+    Energy memo set up by options (options.energy_memo_path), or None
+    '''
+    if options.energy_memo_path == "":
+        return None
+    key = (os.path.abspath(options.energy_memo_path), os.getpid())
+    if key not in _memos:
+        _memos[key] = EnergyMemo(options.energy_memo_path)
+    return _memos[key]
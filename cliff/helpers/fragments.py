@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Fragment-level decomposition of atom-pairwise energies
+#
+
+import numpy as np
+
+
+def load_fragments(frag_file):
+    '''
+    Reads a fragment file, one fragment per line: its name followed by the
+    1-based indices of its atoms. An 'All' fragment with every listed atom
+    is added, as in the original text output.
+
+    Returns
+    -------
+    frags : :class: `dict`
+        Fragment name to 0-based atom indices, in file order
+    '''
+    frags = {}
+    all_atoms = []
+    with open(frag_file, 'r') as ffile:
+        for line in ffile:
+            line = line.split()
+            if len(line) == 0:
+                continue
+            atoms = [int(item) - 1 for item in line[1:]]
+            frags[line[0]] = atoms
+            all_atoms += atoms
+    frags['All'] = all_atoms
+    return frags
+
+def assignment_matrix(frags, natom):
+    '''
+    Sparse (natom, nfrag) matrix with F[i,f] = 1 if atom i is in fragment f
+    '''
+    import scipy.sparse as sparse
+    rows = np.concatenate([np.asarray(atoms, dtype=int) for atoms in frags.values()] + [np.zeros(0, dtype=int)])
+    cols = np.concatenate([np.full(len(atoms), f, dtype=int) for f, atoms in enumerate(frags.values())] + [np.zeros(0, dtype=int)])
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(natom, len(frags)))
+
+def fragment_energies(pairs, frags_a, frags_b):
+    '''
+    Sums atom-pairwise energies over pairs of fragments, F_A^T E F_B for
+    every component E.
+
+    Parameters
+    ----------
+    pairs : :class: `~numpy.ndarray`
+        (ncomp, natom_a, natom_b) atom-pairwise energies, e.g. from
+        `cliff.predict_from_dimers` with return_pairs=True
+    frags_a, frags_b : :class: `dict`
+        Fragment name to 0-based atom indices of each monomer, see `load_fragments`
+
+    Returns
+    -------
+    energies : :class: `~numpy.ndarray`
+        (ncomp, nfrag_a, nfrag_b) fragment-pair energies, ordered as the
+        fragment dicts
+    '''
+    pairs = np.asarray(pairs)
+    ncomp, natom_a, natom_b = pairs.shape
+    F_a = assignment_matrix(frags_a, natom_a)
+    F_b = assignment_matrix(frags_b, natom_b)
+
+    # stack the components along the columns: E_B is (natom_a, ncomp*nfrag_b)
+    E_b = np.concatenate([np.asarray(F_b.T.dot(pairs[c].T)).T for c in range(ncomp)], axis=1)
+    en = np.asarray(F_a.T.dot(E_b))
+    return en.reshape((len(frags_a), ncomp, len(frags_b))).transpose(1,0,2)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Rigid-body comparison of monomer geometries
+#
+
+import hashlib
+import numpy as np
+import cliff.helpers.utils as utils
+
+
+def geometry_hash(sys, decimals=3):
+    '''
+    Hash of the elements and rounded interatomic distances (Angstrom) of a
+    System. Invariant to translation and rotation, but not to atom ordering.
+    '''
+    coords = np.asarray(sys.coords, dtype=float)
+    dist = np.linalg.norm(coords[:,None,:] - coords[None,:,:], axis=-1)
+    # + 0.0 turns -0.0 into 0.0
+    dist = np.round(dist, decimals) + 0.0
+
+    key = hashlib.sha1()
+    key.update(" ".join(sys.elements).encode())
+    key.update(dist.tobytes())
+    return key.hexdigest()
+
+def kabsch(ref, target):
+    '''
+    Proper rotation R that best maps the centered coordinates of ref onto
+    those of target, (ref - <ref>) R^T ~ target - <target>, and the RMSD
+    of that fit.
+    '''
+    p = np.asarray(ref, dtype=float)
+    q = np.asarray(target, dtype=float)
+    p = p - p.mean(axis=0)
+    q = q - q.mean(axis=0)
+
+    u, s, vt = np.linalg.svd(np.dot(p.T, q))
+    d = np.sign(np.linalg.det(np.dot(vt.T, u.T)))
+    rot = np.dot(vt.T, np.dot(np.diag([1.0, 1.0, d]), u.T))
+
+    rmsd = np.sqrt(np.mean(np.sum(np.square(np.dot(p, rot.T) - q), axis=1)))
+    return rot, rmsd
+
+def rotate_multipoles(mtps, rot):
+    '''
+    Rotates atomic multipoles. Rows are either 13 cartesian components
+    (q, dipole, 3x3 quadrupole) or 9 components with the quadrupole in
+    spherical form (Stone convention, as produced by the KRR model).
+    '''
+    mtps = np.asarray(mtps, dtype=float)
+    rotated = np.copy(mtps)
+    rotated[:,1:4] = np.dot(mtps[:,1:4], rot.T)
+    if mtps.shape[1] == 13:
+        quad = mtps[:,4:13].reshape((-1,3,3))
+        rotated[:,4:13] = np.matmul(np.matmul(rot, quad), rot.T).reshape((-1,9))
+    elif mtps.shape[1] == 9:
+        for i in range(len(mtps)):
+            quad = utils.spher_to_cart(mtps[i,4:9], stone_convention=True)
+            rotated[i,4:9] = utils.cart_to_sphere(np.dot(rot, np.dot(quad, rot.T)))
+    else:
+        raise Exception(f"Cannot rotate multipoles with {mtps.shape[1]} components")
+    return rotated
+
+def find_rigid_copies(systems, decimals=6, tol=1e-8):
+    '''
+    Finds Systems that are rigid-body copies (translation and proper rotation,
+    same atom order) of an earlier System in the list. Only copies up to
+    numerical noise match, so a System never gets the properties of another
+    geometry and its energies don't depend on the other Systems.
+
+    Parameters
+    ----------
+    systems : list of :class: `~cliff.helpers.System`
+        Systems to compare, entries may be None
+    decimals : :class: `int`
+        Decimals of the distances (Angstrom) entering the geometry hash
+    tol : :class: `float`
+        Maximum RMSD (Angstrom) of the aligned coordinates
+
+    Returns
+    -------
+    refs : list
+        Index of the first copy of each System (itself if unique), None for None entries
+    rots : list of :class: `~numpy.ndarray`
+        Rotation from the coordinates of refs[n] to those of systems[n]
+    '''
+    refs = [None]*len(systems)
+    rots = [None]*len(systems)
+    seen = {}
+    for n, sys in enumerate(systems):
+        if sys is None:
+            continue
+        key = geometry_hash(sys, decimals)
+        for m in seen.get(key, []):
+            rot, rmsd = kabsch(systems[m].coords, sys.coords)
+            if rmsd < tol:
+                refs[n] = m
+                rots[n] = rot
+                break
+        else:
+            seen.setdefault(key, []).append(n)
+            refs[n] = n
+            rots[n] = np.eye(3)
+    return refs, rots
+
+def copy_properties(ref, sys, rot):
+    '''
+    Sets the atomic properties of sys from those of its rigid-body copy ref,
+    with the multipoles rotated into place.
+    '''
+    sys.hirshfeld_ratios = np.copy(ref.hirshfeld_ratios)
+    sys.valence_widths = np.copy(ref.valence_widths)
+    if np.allclose(rot, np.eye(3), rtol=0.0, atol=1e-10):
+        sys.multipoles = np.copy(ref.multipoles)
+    else:
+        sys.multipoles = rotate_multipoles(ref.multipoles, rot)
+    return sys
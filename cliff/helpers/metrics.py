@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# Counters and histograms of the stages of a CLIFF run
+#
+
+import time
+import threading
+import contextlib
+
+
+# default histogram buckets (upper bounds) of durations in seconds
+time_buckets = (1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+# buckets of the iteration counts and residuals of the induction equations
+iteration_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+residual_buckets = (1e-9, 1e-8, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+
+class Histogram:
+    '''
+    Distribution of observed values, counted in cumulative buckets as in
+    Prometheus: counts[i] is the number of values <= buckets[i]
+    '''
+
+    def __init__(self, buckets=time_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value, count=1):
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += count
+        self.count += count
+        self.sum += value*count
+
+    def merge(self, other):
+        for n in range(len(self.counts)):
+            self.counts[n] += other['counts'][n]
+        self.count += other['count']
+        self.sum += other['sum']
+
+    def as_dict(self):
+        return {'buckets' : list(self.buckets), 'counts' : list(self.counts), 'count' : self.count, 'sum' : self.sum}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Registry:
+    '''
+    Counters and histograms, each identified by a name and labels, e.g.
+    the histogram cliff_stage_seconds with label stage="elst". Safe to
+    use from several threads. Worker processes hand their values back to
+    the parent with `drain` and `merge`, see `cliff.map_tasks`.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Adds value to a counter
+        '''
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=time_buckets, count=1, **labels):
+        '''
+        Adds value to a histogram, created with the given buckets
+        '''
+        key = (name, _label_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value, count)
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        '''
+        Observes the time spent in the context in the histogram
+        cliff_stage_seconds{stage=stage}. Yields a dict whose 'seconds' is
+        set on leaving the context.
+        '''
+        timing = {'seconds' : 0.0}
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            timing['seconds'] = time.perf_counter() - start
+            self.observe('cliff_stage_seconds', timing['seconds'], stage=stage, **labels)
+
+    def timed(self, func, stage, **labels):
+        '''
+        func wrapped in `timer`
+        '''
+        def wrapper(*args, **kwargs):
+            with self.timer(stage, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def as_dict(self):
+        '''
+        All values, as {'counters' : {name : [{'labels' : ..., 'value' : ...}]},
+        'histograms' : {name : [{'labels' : ..., 'buckets' : ..., 'counts' : ...,
+        'count' : ..., 'sum' : ...}]}}
+        '''
+        ret = {'counters' : {}, 'histograms' : {}}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                ret['counters'].setdefault(name, []).append({'labels' : dict(labels), 'value' : value})
+            for (name, labels), hist in sorted(self.histograms.items()):
+                ret['histograms'].setdefault(name, []).append({'labels' : dict(labels), **hist.as_dict()})
+        return ret
+
+    def prometheus(self):
+        '''
+        All values in the Prometheus text exposition format
+        '''
+        def label_str(labels, extra=()):
+            items = list(labels) + list(extra)
+            if len(items) == 0:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f"# TYPE {name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{label_str(labels)} {value}")
+            names = sorted({name for name, _ in self.histograms})
+            for name in names:
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), hist in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        lines.append(f"{name}_bucket{label_str(labels, [('le', repr(float(bound)))])} {count}")
+                    lines.append(f"{name}_bucket{label_str(labels, [('le', '+Inf')])} {hist.count}")
+                    lines.append(f"{name}_sum{label_str(labels)} {hist.sum}")
+                    lines.append(f"{name}_count{label_str(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def drain(self):
+        '''
+        Takes all values out of the registry, in the form `merge` takes
+        '''
+        with self.lock:
+            ret = (self.counters, {key : hist.as_dict() for key, hist in self.histograms.items()})
+            self.counters = {}
+            self.histograms = {}
+        return ret
+
+    def merge(self, drained):
+        '''
+        Adds values taken out of another registry with `drain`
+        '''
+        counters, histograms = drained
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, hist in histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(hist['buckets'])
+                self.histograms[key].merge(hist)
+
+    def reset(self):
+        self.drain()
+
+
+# registry of the process
+registry = Registry()
+
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+
+def get_metrics():
+    '''
+    Values of the process registry as a dict, see `Registry.as_dict`
+    '''
+    return registry.as_dict()
+
+def prometheus_text():
+    '''
+    Values of the process registry in the Prometheus text format
+    '''
+    return registry.prometheus()
+
+def reset_metrics():
+    registry.reset()
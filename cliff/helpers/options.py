@@ -103,6 +103,21 @@ class Options:
         #self.pol_exponent   = 0.177346
 
 
+        ### Options for the atomic property cache
+        # directory of the cache, empty for no cache
+        self.property_cache_path = ""
+        # size limit of the cache in MB, 0 for no limit
+        self.property_cache_max_size = 0
+        # decimals of the coordinates (Angstrom) the cache keys are built from
+        self.property_cache_decimals = 5
+        # SQLite database of memoized dimer energies, empty for none
+        self.energy_memo_path = ""
+
+        ### Options for threading
+        # threads running the energy components of a dimer concurrently,
+        # within the thread budget (see cliff.helpers.budget)
+        self.component_threads = 1
+
         # load the options
         self.load_hirsh_options()
         self.load_atomic_density_options()
@@ -111,6 +126,8 @@ class Options:
         self.load_indu_options()
         self.load_exch_options()
         self.load_disp_options()
+        self.load_cache_options()
+        self.load_thread_options()
 
     def load_hirsh_options(self):
         
@@ -539,6 +556,50 @@ class Options:
     def set_disp_method(self, val):
         self.disp_method = val
 
+    ### Options for the atomic property cache
+    def load_cache_options(self):
+        try:
+            self.property_cache_path = self.Config.get("cache","path")
+        except:
+            pass
+
+        try:
+            self.property_cache_max_size = self.Config.getfloat("cache","max_size")
+        except:
+            pass
+
+        try:
+            self.property_cache_decimals = self.Config.getint("cache","decimals")
+        except:
+            pass
+
+        try:
+            self.energy_memo_path = self.Config.get("cache","energy_memo")
+        except:
+            pass
+
+    def set_property_cache_path(self, val):
+        self.property_cache_path = val
+
+    def set_property_cache_max_size(self, val):
+        self.property_cache_max_size = val
+
+    def set_property_cache_decimals(self, val):
+        self.property_cache_decimals = val
+
+    def set_energy_memo_path(self, val):
+        self.energy_memo_path = val
+
+    ### Options for threading
+    def load_thread_options(self):
+        try:
+            self.component_threads = self.Config.getint("threads","components")
+        except:
+            pass
+
+    def set_component_threads(self, val):
+        self.component_threads = val
+
     def set_name(self, name):
         self.name = name
 
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Content-addressed on-disk cache of predicted atomic properties
+#
+
+import os
+import glob
+import hashlib
+import numpy as np
+
+
+def model_version(options):
+    '''
+    Hash of everything the KRR atomic properties depend on besides the
+    geometry: the training files and the model parameters in options
+    '''
+    key = hashlib.sha1()
+    params = [options.hirsh_krr_kernel, options.hirsh_krr_sigma, options.hirsh_krr_lambda, options.hirsh_cutoff,
+              options.atomicdensity_krr_kernel, options.atomicdensity_krr_sigma, options.atomicdensity_krr_lambda,
+              options.atomicdensity_cutoff, options.multipole_kernel, options.multipole_krr_sigma,
+              options.multipole_krr_lambda, options.multipole_correct_charge, options.multipole_rcut]
+    key.update(repr(params).encode())
+    for training in [options.hirsh_training, options.atomicdensity_training, options.multipole_training]:
+        key.update(os.path.abspath(training).encode())
+        for model in sorted(glob.glob(training + '/*.pkl')):
+            stat = os.stat(model)
+            key.update(f"{os.path.basename(model)} {stat.st_size} {stat.st_mtime_ns}".encode())
+    return key.hexdigest()
+
+
+class PropertyCache:
+    '''
+    Atomic properties (Hirshfeld ratios, valence widths and multipoles) of
+    Systems, stored one file per System under a hash of its elements,
+    rounded coordinates and the model version. A geometry that differs
+    from a cached one gets its own entry instead of the wrong properties.
+    Reading an entry marks it as used; when the cache grows past max_size,
+    the least recently used entries are removed.
+
+    Parameters
+    ----------
+    path : :class: `str`
+        Cache directory, created if needed
+    version : :class: `str`
+        Model version, see `model_version`
+    max_size : :class: `float`
+        Size limit in MB, 0 for none
+    decimals : :class: `int`
+        Decimals of the coordinates (Angstrom) in the keys
+    '''
+
+    def __init__(self, path, version, max_size=0, decimals=5):
+        self.path = path
+        self.version = version
+        self.max_size = max_size * 1024**2
+        self.decimals = decimals
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(os.path.getsize(f) for f in self.entries())
+
+    def key(self, sys):
+        key = hashlib.sha1()
+        key.update(self.version.encode())
+        key.update(" ".join(sys.elements).encode())
+        # + 0.0 turns -0.0 into 0.0
+        key.update((np.round(np.asarray(sys.coords, dtype=float), self.decimals) + 0.0).tobytes())
+        return key.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key + '.npz')
+
+    def entries(self):
+        return glob.glob(os.path.join(self.path, '*', '*.npz'))
+
+    def load(self, sys):
+        '''
+        Sets the cached properties of sys, returns False if there are none
+        '''
+        entry = self.entry(self.key(sys))
+        try:
+            with np.load(entry) as props:
+                sys.hirshfeld_ratios = props['hirshfeld_ratios']
+                sys.valence_widths = props['valence_widths']
+                sys.multipoles = props['multipoles']
+            os.utime(entry)
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def save(self, sys):
+        '''
+        Stores the properties of sys
+        '''
+        entry = self.entry(self.key(sys))
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # written under a temporary name, so readers never see a partial entry
+        tmp = entry + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as efile:
+            np.savez(efile, hirshfeld_ratios=sys.hirshfeld_ratios, valence_widths=sys.valence_widths,
+                     multipoles=sys.multipoles)
+        self.size += os.path.getsize(tmp)
+        os.replace(tmp, entry)
+        if self.max_size > 0 and self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes least recently used entries until the cache is 10% below
+        its size limit
+        '''
+        entries = []
+        for entry in self.entries():
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+        entries.sort()
+
+        self.size = sum(e[1] for e in entries)
+        for _, size, entry in entries:
+            if self.size <= 0.9*self.max_size:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            self.size -= size
+
+
+# open caches, so their size is only summed once per process
+_caches = {}
+
+def get_property_cache(options):
+    '''
+    Property cache set up by options (options.property_cache_path), or None
+    '''
+    if options.property_cache_path == "":
+        return None
+    key = (os.path.abspath(options.property_cache_path), model_version(options),
+           options.property_cache_max_size, options.property_cache_decimals)
+    if key not in _caches:
+        _caches[key] = PropertyCache(options.property_cache_path, key[1],
+                                     options.property_cache_max_size, options.property_cache_decimals)
+    return _caches[key]
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Binary storage of per-dimer energies and atom-pairwise decompositions
+#
+
+import os
+import json
+import numpy as np
+
+# one record per dimer; the atom-pairwise energies of a dimer, if stored, are
+# the (5, natom_a, natom_b) float64 block at pair_offset in the pairs file
+record_dtype = np.dtype([('mon_a', 'S64'), ('mon_b', 'S64'),
+                         ('total', '<f8'), ('elst', '<f8'), ('exch', '<f8'), ('indu', '<f8'), ('disp', '<f8'),
+                         ('pair_offset', '<i8'), ('natom_a', '<i4'), ('natom_b', '<i4')])
+components = ['total', 'elst', 'exch', 'indu', 'disp']
+
+
+def result_files(name):
+    '''
+    Records, pairs and header files of the result store name
+    '''
+    return name + '-results.bin', name + '-pairs.bin', name + '-results.json'
+
+
+class ResultWriter:
+    '''
+    Appends the energies of dimers to a binary result store, readable with
+    `load_results`. Records are written in full precision as they come in,
+    so a store left by an interrupted run is readable up to the last
+    complete record.
+
+    Parameters
+    ----------
+    name : :class: `str`
+        Prefix of the store files, see `result_files`
+    append : :class: `bool`
+        Add to an existing store instead of starting a new one
+    '''
+
+    def __init__(self, name, append=False):
+        self.name = name
+        rec_file, pair_file, header_file = result_files(name)
+        mode = 'ab' if append else 'wb'
+        self.records = open(rec_file, mode)
+        self.pairs = open(pair_file, mode)
+        # drop a partial record or pair block left by an interrupted write
+        self.records.truncate(self.records.tell() - self.records.tell() % record_dtype.itemsize)
+        self.pair_offset = self.pairs.tell() // 8
+        self.pairs.truncate(8*self.pair_offset)
+        self.write_header()
+
+    def write(self, mon_a, mon_b, energies, pairs=None):
+        '''
+        Stores the [total, elst, exch, indu, disp] energies of one dimer and
+        optionally its (5, natom_a, natom_b) atom-pairwise energies. Totals
+        are taken from the pairs if energies is None. Labels of more than
+        64 bytes raise an Exception instead of being cut short.
+        '''
+        rec = np.zeros(1, dtype=record_dtype)
+        for field, label in [('mon_a', mon_a), ('mon_b', mon_b)]:
+            label = str(label).encode()
+            if len(label) > record_dtype[field].itemsize:
+                raise Exception(f"Label {label.decode()} is longer than the {record_dtype[field].itemsize} bytes of the result store")
+            rec[field] = label
+        if energies is None:
+            energies = np.sum(pairs, axis=(1,2))
+        for comp, en in zip(components, energies):
+            rec[comp] = en
+
+        rec['pair_offset'] = -1
+        if pairs is not None:
+            pairs = np.ascontiguousarray(pairs, dtype='<f8')
+            rec['pair_offset'] = self.pair_offset
+            rec['natom_a'] = pairs.shape[1]
+            rec['natom_b'] = pairs.shape[2]
+            self.pairs.write(pairs.tobytes())
+            self.pair_offset += pairs.size
+            self.pairs.flush()
+
+        self.records.write(rec.tobytes())
+        self.records.flush()
+
+    def truncate(self, nrec):
+        '''
+        Keeps the first nrec records of the store and their atom-pairwise
+        energies, dropping the rest
+        '''
+        rec_file, _, _ = result_files(self.name)
+        self.records.flush()
+        kept = np.fromfile(rec_file, dtype=record_dtype, count=nrec)
+        stored = kept[kept['pair_offset'] >= 0]
+        ends = stored['pair_offset'] + 5 * stored['natom_a'].astype('<i8') * stored['natom_b']
+        self.pair_offset = int(np.max(ends)) if len(ends) > 0 else 0
+        self.records.truncate(len(kept) * record_dtype.itemsize)
+        self.pairs.truncate(8*self.pair_offset)
+
+    def write_header(self):
+        _, _, header_file = result_files(self.name)
+        with open(header_file, 'w') as hfile:
+            json.dump({'descr' : np.lib.format.dtype_to_descr(record_dtype), 'components' : components}, hfile)
+
+    def close(self):
+        self.records.close()
+        self.pairs.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Results:
+    '''
+    Memory-mapped view of a result store written by `ResultWriter`
+
+    Attributes
+    ----------
+    records : :class: `~numpy.memmap`
+        Structured per-dimer records, see `record_dtype`
+    '''
+
+    def __init__(self, name):
+        rec_file, pair_file, header_file = result_files(name)
+        with open(header_file, 'r') as hfile:
+            header = json.load(hfile)
+        dtype = np.lib.format.descr_to_dtype([tuple(field) for field in header['descr']])
+
+        nrec = os.path.getsize(rec_file) // dtype.itemsize
+        self.records = np.memmap(rec_file, dtype=dtype, mode='r', shape=(nrec,)) if nrec > 0 else np.zeros(0, dtype=dtype)
+        npair = os.path.getsize(pair_file) // 8
+        self.pair_data = np.memmap(pair_file, dtype='<f8', mode='r', shape=(npair,)) if npair > 0 else np.zeros(0)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def energies(self):
+        '''(ndimer, 5) array of [total, elst, exch, indu, disp]'''
+        return np.stack([self.records[comp] for comp in components], axis=1)
+
+    @property
+    def labels(self):
+        return [(a.decode(), b.decode()) for a, b in zip(self.records['mon_a'], self.records['mon_b'])]
+
+    def pairs(self, n):
+        '''
+        (5, natom_a, natom_b) atom-pairwise energies of dimer n, a view into
+        the pairs file, or None if they weren't stored
+        '''
+        rec = self.records[n]
+        if rec['pair_offset'] < 0:
+            return None
+        size = 5 * int(rec['natom_a']) * int(rec['natom_b'])
+        start = int(rec['pair_offset'])
+        return self.pair_data[start:start+size].reshape((5, int(rec['natom_a']), int(rec['natom_b'])))
+
+
+def load_results(name):
+    '''
+    Opens the result store name for reading, see `Results`
+    '''
+    return Results(name)
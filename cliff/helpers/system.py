@@ -1,25 +1,41 @@
 #!/usr/bin/env python
 
-import qcelemental as qcel
 import numpy as np
 import cliff.helpers.utils as utils
 import logging
 import cliff.helpers.constants as constants
+import cliff.helpers.metrics as metrics
 import os
 import copy
 import re
 import configparser
-import qml
+
+
+def _gather(table, names, index, kind):
+    # per-atom values of a {name : value} table, picked by the atoms' indices into names
+    values = np.array([table.get(n, np.nan) for n in names], dtype=float)[index]
+    if np.any(index < 0) or np.any(np.isnan(values)):
+        missing = {names[i] if i >= 0 else '?' for i, v in zip(index, values) if i < 0 or np.isnan(v)}
+        raise Exception("    No parameters for %s %s!" % (kind, ", ".join(sorted(missing))))
+    return values
 
 
 class System:
     'Common system class for molecular system'
 
+    master_elements   = ['C','N','O','H','S','Cl','F','Br']
+    master_atom_types = ['Cl','F','S1','S2','HS','HC','HN','HO','C4','C3','C2','N3','N2','N1','O1','O2','Br']
+    _element_numbers = dict(zip(master_elements, range(len(master_elements))))
+    _type_numbers = dict(zip(master_atom_types, range(len(master_atom_types))))
+
+    # no per-instance __dict__, as monomers may be held by the million
+    __slots__ = ['name', 'xyz', 'coords', 'num_atoms', 'elements', 'Z', 'element_index', 'atom_types', 'type_index',
+                 'atom_reorder', 'slatm', 'hirshfeld_ratios', 'valence_widths', 'chg_core', 'multipoles',
+                 'multipoles_grads', 'mtp_expansion', 'basis', 'principal_axes', 'pairwise_vec', 'pairwise_norm',
+                 'rot_mat', 'bonded_atoms', 'mtp_to_disk', 'mtp_save_path']
+
     def __init__(self, options, xyz=None, log=False):
         
-        self.master_elements   = ['C','N','O','H','S','Cl','F','Br']
-        self.master_atom_types = ['Cl','F','S1','S2','HS','HC','HN','HO','C4','C3','C2','N3','N2','N1','O1','O2','Br']
-
         self.name = ""
 
         self.xyz = [xyz]
@@ -27,8 +43,9 @@ class System:
         self.coords = None
         # Number of atoms in the molecule
         self.num_atoms = 0
-        # Chemical elements
+        # Chemical elements, their indices in master_elements and atomic numbers
         self.elements = None
+        self.element_index = None
         self.Z = None
         self.atom_reorder = None
         # slatm
@@ -51,8 +68,9 @@ class System:
         self.pairwise_vec = []
         self.pairwise_norm = []
         self.rot_mat = []
-        # Atom types
+        # Atom types and their indices in master_atom_types
         self.atom_types = None
+        self.type_index = None
         # List of bonds to each atom
         self.bonded_atoms = None
         if xyz is not None:
@@ -72,6 +90,7 @@ class System:
         s.num_atoms = self.num_atoms + sys.num_atoms
         s.coords = np.append(s.coords,sys.coords).reshape((s.num_atoms,3))
         s.atom_types = self.atom_types + sys.atom_types
+        s.index_atoms()
         s.xyz = [self.xyz[0],sys.xyz[0]]
         return s
 
@@ -116,11 +135,17 @@ class System:
         return None
 
     def load_qcel_mol(self,mol,name):
+        import qcelemental as qcel
+        self.load_atoms(mol.symbols, mol.geometry*qcel.constants.conversion_factor("bohr", "angstrom"), name)
+
+    def load_atoms(self, elements, coords, name):
+        '''
+        Sets up the system from its elements and (natom, 3) coordinates in Angstrom
+        '''
         self.name = name 
-        self.num_atoms = len(mol.symbols)
-        self.coords = mol.geometry*qcel.constants.conversion_factor("bohr", "angstrom")
-        self.elements = mol.symbols
-        self.Z = np.array([constants.atomic_number[ele] for ele in self.elements]) 
+        self.num_atoms = len(elements)
+        self.coords = np.asarray(coords, dtype=float).reshape((self.num_atoms, 3))
+        self.elements = elements
         self.identify_atom_types() 
 
     def set_properties(self, props):
@@ -153,7 +178,9 @@ class System:
         #mol.generate_slatm(mbtypes, rcut=cutoff,local=True)
         #self.slatm = mol.representation
 
-        self.slatm = qml.representations.generate_slatm(self.coords,self.Z,mbtypes,rcut=cutoff,local=True)
+        import qml.representations
+        with metrics.timer('slatm'):
+            self.slatm = qml.representations.generate_slatm(self.coords,self.Z,mbtypes,rcut=cutoff,local=True)
         
         return None
 
@@ -272,4 +299,27 @@ class System:
                 raise Exception("    Atom type %s detected, but is not parameterized!" % at_type) 
 
             self.atom_types.append(at_type)
+        self.index_atoms()
         return None
+
+    def index_atoms(self):
+        '''
+        Indexes the elements and atom types of the atoms in master_elements
+        and master_atom_types (-1 if not there), for `element_params` and
+        `type_params`, and sets the atomic numbers
+        '''
+        self.element_index = np.array([self._element_numbers.get(ele.capitalize(), -1) for ele in self.elements], dtype=np.int8)
+        self.type_index = np.array([self._type_numbers.get(typ, -1) for typ in self.atom_types], dtype=np.int8)
+        self.Z = np.array([constants.atomic_number[ele] for ele in self.elements])
+
+    def element_params(self, table):
+        '''
+        Per-atom values of a table keyed by element, e.g. constants.csix_free
+        '''
+        return _gather(table, self.master_elements, self.element_index, "element")
+
+    def type_params(self, table):
+        '''
+        Per-atom values of a table keyed by atom type, e.g. options.exch_int_params
+        '''
+        return _gather(table, self.master_atom_types, self.type_index, "atom type")
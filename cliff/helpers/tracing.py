@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Spans of the evaluation of individual dimers, in the Chrome trace format
+#
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+# whether spans are recorded; everything below is a no-op while False
+_enabled = False
+_events = []
+_lock = threading.Lock()
+
+
+class _NoSpan:
+    '''
+    Stand-in for a span while tracing is disabled
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_no_span = _NoSpan()
+
+
+class Span:
+    '''
+    Timed section of the evaluation, with attributes such as atom counts or
+    iteration numbers. Recorded as a complete ('X') trace event on exit.
+    '''
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.attrs['error'] = repr(exc)
+        self.record(self.start, end)
+        return False
+
+    def record(self, start, end):
+        event = {'name' : self.name, 'ph' : 'X', 'ts' : start*1e6, 'dur' : (end - start)*1e6,
+                 'pid' : os.getpid(), 'tid' : threading.get_ident(), 'args' : self.attrs}
+        with _lock:
+            _events.append(event)
+
+    def set(self, **attrs):
+        '''
+        Adds attributes to the span
+        '''
+        self.attrs.update(attrs)
+
+
+def span(name, **attrs):
+    '''
+    Context manager recording a span, if tracing is enabled
+
+        with tracing.span('induction', natom=12) as sp:
+            ...
+            sp.set(iterations=n)
+    '''
+    if not _enabled:
+        return _no_span
+    return Span(name, attrs)
+
+def traced(func, name, **attrs):
+    '''
+    func wrapped in a `span`
+    '''
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with Span(name, dict(attrs)):
+            return func(*args, **kwargs)
+    return wrapper
+
+def add_span(name, start, end=None, **attrs):
+    '''
+    Records a span timed by the caller, from start to end (now if None),
+    both from time.perf_counter()
+    '''
+    if not _enabled:
+        return
+    if end is None:
+        end = time.perf_counter()
+    Span(name, attrs).record(start, end)
+
+def enabled():
+    return _enabled
+
+def enable_tracing():
+    global _enabled
+    _enabled = True
+
+def disable_tracing():
+    global _enabled
+    _enabled = False
+
+def drain():
+    '''
+    Takes the recorded events out of the process, for `merge`
+    '''
+    global _events
+    with _lock:
+        events, _events = _events, []
+    return events
+
+def merge(events):
+    '''
+    Adds events recorded in another process, see `drain`
+    '''
+    with _lock:
+        _events.extend(events)
+
+def get_events():
+    with _lock:
+        return list(_events)
+
+def write_trace(path):
+    '''
+    Writes the recorded events as a Chrome trace-event JSON file, which
+    can be opened in chrome://tracing or Perfetto
+    '''
+    with open(path, 'w') as tfile:
+        json.dump({'traceEvents' : get_events(), 'displayTimeUnit' : 'ms'}, tfile, default=_jsonable)
+
+def _jsonable(value):
+    # numpy scalars in the attributes
+    try:
+        return value.item()
+    except AttributeError:
+        return str(value)
+
+@contextlib.contextmanager
+def trace(path=None):
+    '''
+    Records spans in the context, and writes them to path (if given) on
+    leaving it
+
+        with tracing.trace('slow.json'):
+            cliff.predict_from_dimers(dimers)
+    '''
+    was_enabled = _enabled
+    enable_tracing()
+    try:
+        yield
+    finally:
+        if not was_enabled:
+            disable_tracing()
+        if path is not None:
+            write_trace(path)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Multi-frame xyz files (e.g. MD trajectories) as one coordinate array
+#
+
+import os
+import numpy as np
+from cliff.helpers.system import System
+import cliff.helpers.metrics as metrics
+
+
+def index_files(xyz_file):
+    '''
+    Index, coordinates and symbols files kept next to xyz_file
+    '''
+    return xyz_file + '.cliff-index.npz', xyz_file + '.cliff-coords.npy', xyz_file + '.cliff-symbols.npy'
+
+
+class XYZTrajectory:
+    '''
+    Frames of a multi-frame xyz file. The file is parsed once: the
+    coordinates of all frames go to one (natom_total, 3) array, frame n
+    being the rows offsets[n]:offsets[n+1]. The arrays are saved next to
+    the xyz file (see `index_files`) and memory-mapped, so reopening a
+    trajectory costs no parsing and frames are read from disk as they are
+    used. The index is rebuilt if the xyz file changes.
+
+    Each frame is in the usual xyz format: the number of atoms, a comment
+    line and one line per atom. For dimer frames, the last comma-separated
+    field of the comment is the number of atoms in monomer A, as in dimer
+    xyz files.
+
+    Parameters
+    ----------
+    xyz_file : :class: `str`
+        Multi-frame xyz file
+    units : :class: `str`
+        Units of the coordinates. Anything but Angstrom is converted once
+        into memory instead of being memory-mapped.
+    mmap : :class: `bool`
+        Save the index and memory-map it; if False it is only kept in memory
+
+    Attributes
+    ----------
+    coords : :class: `~numpy.ndarray`
+        (natom_total, 3) coordinates of all frames in Angstrom
+    symbols : :class: `~numpy.ndarray`
+        (natom_total,) element symbols of all frames
+    offsets : :class: `~numpy.ndarray`
+        (nframe+1,) first atom of every frame
+    comments : list of :class: `str`
+        Comment line of every frame
+    '''
+
+    def __init__(self, xyz_file, units='angstrom', mmap=True):
+        self.xyz_file = xyz_file
+        self.name = xyz_file.split("/")[-1].split(".xyz")[0]
+
+        if mmap:
+            if not self.load_index():
+                self.build_index(save=True)
+                self.load_index()
+        else:
+            self.build_index(save=False)
+
+        if units.lower() not in ['angstrom', 'ang', 'a']:
+            import qcelemental as qcel
+            self.coords = self.coords * qcel.constants.conversion_factor(units, "angstrom")
+
+    def build_index(self, save=True):
+        '''
+        Parses the xyz file: a first pass finds the frames, a second one
+        fills the coordinate and symbol arrays
+        '''
+        with metrics.timer('io_index'):
+            self._build_index(save)
+
+    def _build_index(self, save):
+        natoms = []
+        comments = []
+        with open(self.xyz_file, 'r') as xfile:
+            for line in xfile:
+                if len(line.strip()) == 0:
+                    continue
+                natom = int(line)
+                natoms.append(natom)
+                comments.append(xfile.readline().strip())
+                for _ in range(natom):
+                    xfile.readline()
+        offsets = np.concatenate(([0], np.cumsum(natoms, dtype=np.int64)))
+
+        _, coord_file, symbol_file = index_files(self.xyz_file)
+        ntotal = int(offsets[-1])
+        if save:
+            coords = np.lib.format.open_memmap(coord_file, mode='w+', dtype=np.float64, shape=(ntotal, 3))
+            symbols = np.lib.format.open_memmap(symbol_file, mode='w+', dtype='<U2', shape=(ntotal,))
+        else:
+            coords = np.zeros((ntotal, 3))
+            symbols = np.zeros(ntotal, dtype='<U2')
+
+        with open(self.xyz_file, 'r') as xfile:
+            for n, natom in enumerate(natoms):
+                line = xfile.readline()
+                while len(line.strip()) == 0:
+                    line = xfile.readline()
+                xfile.readline()
+                fields = [xfile.readline().split() for _ in range(natom)]
+                start = offsets[n]
+                coords[start:start+natom] = np.array([f[1:4] for f in fields], dtype=float).reshape((natom, 3))
+                symbols[start:start+natom] = [f[0][0].upper() + f[0][1:].lower() for f in fields]
+
+        if save:
+            coords.flush()
+            symbols.flush()
+            del coords, symbols
+            stat = os.stat(self.xyz_file)
+            index_file, _, _ = index_files(self.xyz_file)
+            # written last, so an interrupted build is not mistaken for a valid index
+            with open(index_file, 'wb') as ifile:
+                np.savez(ifile, offsets=offsets, comments=np.array(comments, dtype=str),
+                         source=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64))
+        else:
+            self.coords = coords
+            self.symbols = symbols
+            self.offsets = offsets
+            self.comments = comments
+
+    def load_index(self):
+        '''
+        Memory-maps a saved index, returns False if there's none for the
+        current xyz file
+        '''
+        index_file, coord_file, symbol_file = index_files(self.xyz_file)
+        if not all(os.path.isfile(f) for f in index_files(self.xyz_file)):
+            return False
+        stat = os.stat(self.xyz_file)
+        with np.load(index_file) as index:
+            if list(index['source']) != [stat.st_size, stat.st_mtime_ns]:
+                return False
+            self.offsets = index['offsets']
+            self.comments = [str(c) for c in index['comments']]
+        self.coords = np.load(coord_file, mmap_mode='r')
+        self.symbols = np.load(symbol_file, mmap_mode='r')
+        return True
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def frame_coords(self, n):
+        '''
+        (natom, 3) coordinates of frame n, a view into `coords`
+        '''
+        return self.coords[self.offsets[n]:self.offsets[n+1]]
+
+    def frame_elements(self, n):
+        return [str(ele) for ele in self.symbols[self.offsets[n]:self.offsets[n+1]]]
+
+    def system(self, n, options, atoms=None, name=None):
+        '''
+        System of frame n, or of the atoms slice of it. Named X-n for
+        trajectory X.xyz unless a name is given.
+        '''
+        if atoms is None:
+            atoms = slice(None)
+        if name is None:
+            name = self.name + "-" + str(n)
+        sys = System(options)
+        sys.load_atoms(self.frame_elements(n)[atoms], self.frame_coords(n)[atoms], name)
+        return sys
+
+    def dimer(self, n, options, natom_a=None):
+        '''
+        Monomer Systems of dimer frame n, named X-n-0 and X-n-1, as
+        `cliff.read_dimer_xyz` returns them. natom_a defaults to the last
+        field of the frame's comment.
+        '''
+        if natom_a is None:
+            natom_a = int(self.comments[n].split(',')[-1])
+        name = self.name + "-" + str(n)
+        return [self.system(n, options, slice(None, natom_a), name + "-0"),
+                self.system(n, options, slice(natom_a, None), name + "-1")]
+
+    def iter_dimers(self, options, natom_a=None, frames=None):
+        '''
+        `dimer` of every frame (or of the given frames), to be passed to
+        e.g. `cliff.iter_energies`
+        '''
+        if frames is None:
+            frames = range(len(self))
+        for n in frames:
+            yield self.dimer(n, options, natom_a)
+
+    def iter_systems(self, options, frames=None):
+        '''
+        `system` of every frame (or of the given frames), e.g. the monomers
+        of `cliff.predict_from_monomer_list`
+        '''
+        if frames is None:
+            frames = range(len(self))
+        for n in frames:
+            yield self.system(n, options)
+
+
+def load_trajectory(xyz_file, units='angstrom', mmap=True):
+    '''
+    Opens a multi-frame xyz file, see `XYZTrajectory`
+    '''
+    return XYZTrajectory(xyz_file, units, mmap)
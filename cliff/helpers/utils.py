@@ -9,6 +9,7 @@ import copy
 import glob
 import os
 import cliff.helpers.constants as constants
+import cliff.helpers.metrics as metrics
 import cliff.helpers.cell as Cell
 
 
@@ -251,17 +252,14 @@ def slater_mbis(cell, coord_i, N_i, v_i, U_i, coord_j, N_j, v_j, U_j):
 #    return ((1./3)*Bij*Bij*rij*rij + Bij*rij + 1) * np.exp(-Bij*rij) 
 
 def build_r(c1, c2, cell):
-    out = np.zeros((len(c1), len(c2)))
-    for i,a in enumerate(c1):
-        for j,b in enumerate(c2):
-            out[i][j] = np.linalg.norm(cell.pbc_distance(a,b))
-    return out
+    # minimum-image distances between all atoms of c1 and c2
+    return np.linalg.norm(cell.pbc_distances(np.reshape(c1, (-1,3)), np.reshape(c2, (-1,3))), axis=-1)
 
 def slater_ovp_mat(r,v1,v2):
 
-    # simpler method:
-    out = np.ones((len(v1),len(v2)))
-    B = np.sqrt(1.0 / np.outer(v1,v2))
+    # simpler method, broadcasting over leading batch dimensions of v1 and v2:
+    B = np.sqrt(1.0 / (np.asarray(v1)[...,:,None] * np.asarray(v2)[...,None,:]))
+    out = np.ones(B.shape)
     out += (1/3.)*B*B*r*r
     out += B*r
     out *= np.exp(-B*r)
@@ -272,6 +270,45 @@ def slater_ovp_mat(r,v1,v2):
  #           out[i][j] = slater_mbis_funcform(r[i][j],p1[i],v1[i],p2[j],v2[j])
     return out
 
+def krr_predict_atoms(descrs, elements, descr_train, alpha_train, metric, kernel, out):
+    '''
+    Atomic KRR predictions for several molecules at once. The atoms of all
+    molecules are grouped by element, so that each element's kernel matrix
+    is evaluated once for the whole group.
+
+    Parameters
+    ----------
+    descrs : list of :class: `~numpy.ndarray`
+        (natom, ndescr) atomic descriptors of each molecule
+    elements : list of list of :class: `str`
+        Elements of the atoms of each molecule
+    descr_train, alpha_train : :class: `dict`
+        Training descriptors and KRR coefficients per element (alpha None
+        for elements without a model)
+    metric : :class: `str`
+        Distance metric, see `scipy.spatial.distance.cdist`
+    kernel : callable
+        Kernel values from an array of distances
+    out : list of :class: `~numpy.ndarray`
+        Arrays of each molecule, of first dimension natom, the predictions
+        are written into. Atoms of elements without a model are untouched.
+    '''
+    from scipy.spatial.distance import cdist
+    for ele, alpha in alpha_train.items():
+        if alpha is None:
+            continue
+        atoms = [(n, [i for i, e in enumerate(eles) if e == ele]) for n, eles in enumerate(elements)]
+        atoms = [(n, idx) for n, idx in atoms if len(idx) > 0]
+        if len(atoms) == 0:
+            continue
+        descr = np.concatenate([np.asarray(descrs[n])[idx] for n, idx in atoms])
+        with metrics.timer('krr_kernel'):
+            pred = np.dot(kernel(cdist(descr, descr_train[ele], metric)), alpha)
+        start = 0
+        for n, idx in atoms:
+            out[n][idx] = pred[start:start+len(idx)]
+            start += len(idx)
+
 def slater_mbis_funcform(rij, N_i, v_i, N_j, v_j):
     v_i2, v_j2 = v_i**2, v_j**2
     if abs(v_i-v_j) > 1e-4: # Original IPML uses 1e-3
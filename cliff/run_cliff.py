@@ -28,6 +28,11 @@ from cliff.helpers.options import Options
 from cliff.helpers.cell import Cell
 from cliff.helpers.system import System
 import cliff.helpers.utils as Utils
+import cliff.helpers.results as results
+import cliff.helpers.fragments as fragments
+import cliff.helpers.budget as budget
+import cliff.helpers.metrics as metrics
+import cliff.helpers.tracing as tracing
 from cliff.atomic_properties.hirshfeld import Hirshfeld
 from cliff.atomic_properties.atomic_density import AtomicDensity
 from cliff.atomic_properties.multipole import Multipole
@@ -43,13 +48,14 @@ def init_args():
     parser.add_argument('-a','--monA', type=str, help='Monomer A xyz file')
     parser.add_argument('-b','--monB', type=str, help='Monomer B xyz file')
     parser.add_argument('-n','--name', type=str, help='Output job name')
-    parser.add_argument('-p','--nproc', type=int, help='Number of threads for numpy')
+    parser.add_argument('-p','--nproc', type=int, help='Number of worker processes')
+    parser.add_argument('-t','--threads', type=int, help='Total number of threads, shared by the worker processes (default: all CPUs)')
     parser.add_argument('-fr','--frag',type=bool, nargs="?", default=False, help='Do fragmentation analysis')
-<<<<<<< HEAD
-    parser.add_argument('--batch-id', type=int, help='batch id')
-=======
     parser.add_argument('--batch-id',type=int, help='current batch id')
->>>>>>> 75de41cc3e1047656f6515935a9126fb8af916a6
+    parser.add_argument('--restart', action='store_true', help='Skip dimers already completed by a previous run of the same job')
+    parser.add_argument('--output-format', type=str, default='csv', choices=['csv', 'binary'], help='Format of the results file')
+    parser.add_argument('--metrics', type=str, help='Write the timings and counters of the run to this file, in the Prometheus text format')
+    parser.add_argument('--trace', type=str, help='Trace the evaluation of every dimer and write the spans to this file, in the Chrome trace format')
 
     return parser.parse_args()
 
@@ -75,20 +81,19 @@ def load_models(logger, options, ref=None):
     hirsh = Hirshfeld(options, ref) 
     adens = AtomicDensity(options, ref)
 
-    tls = time.time()
-    #load KRR model for Hirshfeld as specified in the config.ini file
-    hirsh.load_ml() 
-    adens.load_ml()
+    with metrics.timer('model_load') as timing:
+        #load KRR model for Hirshfeld as specified in the config.ini file
+        hirsh.load_ml() 
+        adens.load_ml()
 
-    #load multipoles with aSLATM representation
-    mtp = Multipole(options,ref) 
-    #mtp.load_ml()
-    tlf = time.time()
-    logger.info("    ~Time spent loading ML models: {} s".format(tlf-tls))
+        #load multipoles with aSLATM representation
+        mtp = Multipole(options,ref) 
+        #mtp.load_ml()
+    logger.info("    ~Time spent loading ML models: {} s".format(timing['seconds']))
 
     # Predict the references, save to disk
     if ref is not None:
-        ts = time.time()
+        ts = time.perf_counter()
         
         pref = "/"
         for d in os.path.abspath(ref).split("/")[:-1]:
@@ -119,7 +124,8 @@ def load_models(logger, options, ref=None):
             mtp.predict_mol(sys, force_predict = True)
             sys.save_mtp()
 
-        tf = time.time()
+        tf = time.perf_counter()
+        metrics.observe('cliff_stage_seconds', tf-ts, stage='properties')
         logger.info("    ~Time spent predicting atomic properties of reference: {} s".format(tf-ts))
 
     return [hirsh, adens, mtp]
@@ -143,16 +149,15 @@ def get_energy(logger, filenames, models, options, name, timer=None, frag=None):
         xyzs.append(xyz)
     
     logger.info("")
-    tms = time.time()
-    for mol,xyz in zip(mols,xyzs):
-        logger.info("    Predicting atomic properties for {}".format(xyz))
-        #predicts monomer multipole moments for each monomer
-        mtp_ml.predict_mol(mol)
-        #predicts Hirshfeld ratios using KRR
-        hirsh.predict_mol(mol)
-        adens.predict_mol(mol)
-    tmf = time.time()    
-    logger.info("    ~Time spent predicting atomic properties {} s".format(tmf-tms))
+    with metrics.timer('properties') as timing:
+        for mol,xyz in zip(mols,xyzs):
+            logger.info("    Predicting atomic properties for {}".format(xyz))
+            #predicts monomer multipole moments for each monomer
+            mtp_ml.predict_mol(mol)
+            #predicts Hirshfeld ratios using KRR
+            hirsh.predict_mol(mol)
+            adens.predict_mol(mol)
+    logger.info("    ~Time spent predicting atomic properties {} s".format(timing['seconds']))
 
     #initializes relevant classes with monomer A
     mtp = Electrostatics(options,mols[0], cell)
@@ -167,27 +172,23 @@ def get_energy(logger, filenames, models, options, name, timer=None, frag=None):
         rep.add_system(mol)
         disp.add_system(mol)
     #computes electrostatic, induction and exchange energies
-    t1 = time.time()
-    elst = mtp.mtp_energy()
-    elst_time = time.time() - t1
+    with metrics.timer('elst') as elst_time:
+        elst = mtp.mtp_energy()
 
-    t2 = time.time()
-    indu = ind.polarization_energy(options)
-    ind_time = time.time() - t2
+    with metrics.timer('indu') as ind_time:
+        indu = ind.polarization_energy(options)
 
-    t3 = time.time()
-    exch = rep.compute_repulsion()
-    rep_time = time.time() - t3
+    with metrics.timer('exch') as rep_time:
+        exch = rep.compute_repulsion()
     
     #use Hirshfeld ratios in the computation of dispersion energy
-    t4 = time.time()
-    disp_en = disp.compute_dispersion(hirsh)  
-    disp_time = time.time() - t4
+    with metrics.timer('disp') as disp_time:
+        disp_en = disp.compute_dispersion(hirsh)  
 
-    timer['elst'] =  elst_time
-    timer['exch'] =  rep_time
-    timer['ind']  =  ind_time
-    timer['disp'] =  disp_time
+    timer['elst'] =  elst_time['seconds']
+    timer['exch'] =  rep_time['seconds']
+    timer['ind']  =  ind_time['seconds']
+    timer['disp'] =  disp_time['seconds']
 
     # Save energy partitions
     #print(mtp.at_elst, np.sum(mtp.at_elst))
@@ -220,91 +221,142 @@ def get_energy(logger, filenames, models, options, name, timer=None, frag=None):
 
     return ret
 
-def update_files(name, ret):
-    # get name
-    labels = ret[0]
-    energies = ret[1]
-    
-    # Append to csv
-    try:
-        cout = open(name + '.csv','a+')
-    except:
-        cout = open(name + '.csv','w')
+def update_files(name, ret, output_format='csv'):
+    # Append to csv, or the binary result store
+    with open_output(name, output_format) as out:
+        for lab, en in zip(ret[0], ret[1]):
+            write_result(out, lab, en)
+
+def open_output(name, output_format='csv', append=True):
+    '''
+    Opens the results of job name for writing: name.csv, or the binary
+    store of `cliff.helpers.results` if output_format is 'binary'
+    '''
+    if output_format == 'binary':
+        return results.ResultWriter(name, append=append)
+    elif output_format == 'csv':
+        if not append and os.path.isfile(name + '.csv'):
+            os.remove(name + '.csv')
+        return open_csv(name)
+    else:
+        raise Exception(f"Output format {output_format} not understood!")
+
+def write_result(out, lab, en, pairs=None):
+    with metrics.timer('io_write'):
+        if isinstance(out, results.ResultWriter):
+            out.write(lab[0], lab[1], en, pairs)
+        else:
+            write_row(out, lab, en)
+            out.flush()
+
+def open_csv(name):
+    '''
+    Opens name.csv for appending, writing the header if it's new
+    '''
+    new = not os.path.isfile(name + '.csv')
+    cout = open(name + '.csv','a')
+    if new:
         cout.write("# Monomer A, Monomer B, Electrostatics, Exchange, Induction, Dispersion, Total (kcal/mol)")
+    return cout
 
-    for lab, en in zip(labels,energies):
-        mona = lab[0]
-        monb = lab[1]
-        total = np.sum(en)
-        cout.write("\n%s,%s,%9.5f,%9.5f,%9.5f,%9.5f,%9.5f" % (mona,monb,en[0],en[1],en[2],en[3],total))
+def write_row(cout, lab, en):
+    '''
+    Writes the [total, elst, exch, indu, disp] energies of one dimer
+    '''
+    cout.write("\n%s,%s,%9.5f,%9.5f,%9.5f,%9.5f,%9.5f" % (lab[0],lab[1],en[1],en[2],en[3],en[4],en[0]))
 
-    cout.close()
+def load_journal(name):
+    '''
+    Reads the progress journal name.journal of a dimer run: one JSON line
+    {"key": dimer name, "energies": [...] or null} per finished dimer.
+    Returns a dict of key to energies, skipping a truncated last line.
+    '''
+    done = {}
+    if not os.path.isfile(name + '.journal'):
+        return done
+    with open(name + '.journal','r') as jfile:
+        for line in jfile:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # partial line from a run that was killed while writing
+                continue
+            en = entry['energies']
+            done[entry['key']] = None if en is None else np.asarray(en)
+    return done
+
+def journal_line(key, en):
+    return json.dumps({'key' : key, 'energies' : None if en is None else [float(e) for e in en]}) + "\n"
+
+def rewrite_journal(name, done):
+    '''
+    Replaces name.journal with the entries of done, dropping any partial line
+    '''
+    with open(name + '.journal.tmp','w') as jfile:
+        for key, en in done.items():
+            jfile.write(journal_line(key, en))
+        jfile.flush()
+        os.fsync(jfile.fileno())
+    os.replace(name + '.journal.tmp', name + '.journal')
+
+def write_journal(jfile, key, en):
+    '''
+    Records a finished dimer, on disk before returning
+    '''
+    jfile.write(journal_line(key, en))
+    jfile.flush()
+    os.fsync(jfile.fileno())
+
+def restore_results(name, done):
+    '''
+    Truncates the binary result store of a restarted job to the dimers in
+    its journal, done of `load_journal`, keeping their atom-pairwise
+    energies. Returns the journal entries without the dimers whose results
+    didn't make it to the store, so they are computed again.
+    '''
+    rec_file, _, header_file = results.result_files(name)
+    stored = []
+    if os.path.isfile(rec_file) and os.path.isfile(header_file):
+        stored = [mon_a[:-len('-A')] for mon_a, _ in results.load_results(name).labels]
+
+    # results are written in journal order, after their journal entry
+    nrec = 0
+    for key in stored:
+        if key not in done or done[key] is None:
+            break
+        nrec += 1
+    with results.ResultWriter(name, append=True) as out:
+        out.truncate(nrec)
+
+    kept = set(stored[:nrec])
+    return {key : en for key, en in done.items() if en is None or key in kept}
 
 def generate_frag_output(files, name, elst, exch, indu, disp):
     # get the files that define the fragments
+    pref_a = files[0].split('.xyz')[0]  
+    pref_b = files[1].split('.xyz')[0]  
+
+    write_frag_output(pref_a + '-frag.dat', pref_b + '-frag.dat', name, np.array([elst, exch, indu, disp]))
 
-    fa = files[0]
-    fb = files[1]
-
-    pref_a = fa.split('.xyz')[0]  
-    pref_b = fb.split('.xyz')[0]  
-
-    fa = pref_a + '-frag.dat'
-    fb = pref_b + '-frag.dat'
-
-    pref_a = pref_a.split('/')[-1]
-    pref_b = pref_b.split('/')[-1]
-
-    fa_frags = {}
-    fb_frags = {}
-
-    # load the fragments
-    with open(fa, 'r') as fa_file:
-        all_a = []
-        for line in fa_file:
-            line = line.split()
-            atms = []
-            for item in line[1:]:
-                atms.append(item)
-                all_a.append(item)
-            fa_frags[line[0]] = atms
-        fa_frags['All'] = all_a
-
-    with open(fb, 'r') as fb_file:
-        all_b = []
-        for line in fb_file:
-            line = line.split()
-            atms = []
-            for item in line[1:]:
-                atms.append(int(item))
-                all_b.append(item)
-            fb_frags[line[0]] = atms
-        fb_frags['All'] = all_b
+def write_frag_output(fa, fb, name, pairs, append=False):
+    '''
+    Writes the fragment-pair energies of one dimer to name_frag.txt, for the
+    fragments in the files fa and fb and the (4, natom_a, natom_b)
+    [elst, exch, indu, disp] atom-pairwise energies pairs
+    '''
+    pref_a = fa.split('/')[-1].split('-frag.dat')[0]
+    pref_b = fb.split('/')[-1].split('-frag.dat')[0]
+
+    fa_frags = fragments.load_fragments(fa)
+    fb_frags = fragments.load_fragments(fb)
+    en = fragments.fragment_energies(pairs, fa_frags, fb_frags)
     
-    with open(name + "_frag.txt",'w') as ffile:
+    with open(name + "_frag.txt",'a' if append else 'w') as ffile:
         ffile.write("# %s, %s, electrostatic, exchange-repulsion, induction, dispersion, total \n" %(pref_a,pref_b))
-        for fa, atoms_a in fa_frags.items():
-            for fb, atoms_b in fb_frags.items():
-                elst_e = 0.0 
-                exch_e = 0.0
-                indu_e = 0.0
-                disp_e = 0.0
-                total_e = 0.0           
-                for na in atoms_a:
-                    for nb in atoms_b:
-                        elst_a = elst[int(na)-1,int(nb)-1]  
-                        exch_a = exch[int(na)-1,int(nb)-1]  
-                        indu_a = indu[int(na)-1,int(nb)-1]  
-                        disp_a = disp[int(na)-1,int(nb)-1]  
-
-                        elst_e += elst_a
-                        exch_e += exch_a
-                        indu_e += indu_a
-                        disp_e += disp_a
-
-                        total_e += elst_a + exch_a + indu_a + disp_a
-
-                ffile.write("%s %s %12.8f %12.8f %12.8f %12.8f %12.8f \n" % (fa,fb,elst_e, exch_e, indu_e, disp_e, total_e) ) 
+        for ia, fa in enumerate(fa_frags):
+            for ib, fb in enumerate(fb_frags):
+                e = en[:,ia,ib]
+                ffile.write("%s %s %12.8f %12.8f %12.8f %12.8f %12.8f \n" % (fa,fb,e[0],e[1],e[2],e[3],np.sum(e)) ) 
             
     
 
@@ -338,18 +390,18 @@ def print_ret(logger, ret):
     '''
     Print out results from return dict
     '''
+    print_ret_header(logger)
+    for lab, en in zip(ret[0], ret[1]):
+        print_ret_row(logger, lab, en)
+
+def print_ret_header(logger):
     logger.info("")
     logger.info("    Output summary (kcal/mol)")
     logger.info("           MonomerA     |      MonomerB      |  Electrostatics |   Exchange   |   Induction   |   Dispersion  |   Total ")
     logger.info("    ----------------------------------------------------------------------------------------------------------------------") 
 
-    labels = ret[0]
-    energies = ret[1]
-    for lab, en in zip(labels,energies):
-        mona = lab[0]
-        monb = lab[1]
-        total = np.sum(en)
-        logger.info("    %-20s %-20s%18.5f %14.5f %15.5f %15.5f %11.5f" % (mona,monb,en[0],en[1],en[2],en[3], total))
+def print_ret_row(logger, lab, en):
+    logger.info("    %-20s %-20s%18.5f %14.5f %15.5f %15.5f %11.5f" % (lab[0],lab[1],en[1],en[2],en[3],en[4],en[0]))
 
 def print_timings(logger, timer):
     logger.info("")
@@ -359,7 +411,8 @@ def print_timings(logger, timer):
     logger.info("    ~Induction     :  %10.3f s" % timer['ind'])
     logger.info("    ~Dispersion    :  %10.3f s" % timer['disp'])
 
-def main(inpt=None, dimer=None, monA=None, monB=None, nproc=None, name=None, frag=None, batch_id=None, units='angstrom'):
+def main(inpt=None, dimer=None, monA=None, monB=None, nproc=None, name=None, frag=None, batch_id=None, units='angstrom', restart=False,
+         output_format='csv', nthread=None, metrics_file=None, trace_file=None):
     start = time.time()
     logger = logging.getLogger(__name__)
     if not os.path.exists('logs'):
@@ -387,10 +440,14 @@ def main(inpt=None, dimer=None, monA=None, monB=None, nproc=None, name=None, fra
     else:
         logger.info("    Loading options from {}".format(infile))
 
-    if nproc is not None:
-        logger.info("    Using {} threads".format(nproc))
-    else:
-        logger.info("    Using {} threads".format(mp.cpu_count()))
+    if nproc is None:
+        nproc = 1
+    logger.info("    Using {} processes".format(nproc))
+    if trace_file is not None:
+        tracing.enable_tracing()
+    # each worker process gets its share of the threads for BLAS
+    thread_budget = cliff.set_nthread(nthread, nproc)
+    logger.info("    Using {} threads".format(budget.get_thread_budget()))
 
     if dimer is not None:
         files = []
@@ -398,34 +455,93 @@ def main(inpt=None, dimer=None, monA=None, monB=None, nproc=None, name=None, fra
             files = sorted(glob.glob(dimer + '/*.xyz'))
         elif dimer.split('.')[-1] == 'xyz':
             files.append(dimer)
-        dimer_mols = []
-        dimer_names = []
-        for mol in files:
-            try:
-                dimer_mols.append(cliff.load_dimer_xyz(mol, units))
-                dimer_names.append((mol.split('/')[-1].split('.xyz')[0]+'-A',mol.split('/')[-1].split('.xyz')[0]+'-B')) 
-            except:
-                logger.info(f"   Cannot load {mol}")
+        # Each finished dimer goes to the journal before the results. On restart,
+        # the results are rebuilt from the journal and finished dimers are skipped
+        done = {}
+        if restart:
+            done = load_journal(name)
+            if output_format == 'binary':
+                done = restore_results(name, done)
+            logger.info("    Restarting, {} dimers already done".format(len(done)))
+        rewrite_journal(name, done)
+        if frag and not restart and os.path.isfile(name + '_frag.txt'):
+            os.remove(name + '_frag.txt')
+        paths = {f.split('/')[-1].split('.xyz')[0] : f.split('.xyz')[0] for f in files}
 
-        en = cliff.predict_from_dimers(dimer_mols, options=options)
-
-        ret = (dimer_names,en)
+        labels = []
+        energies = []
+        print_ret_header(logger)
+        # on restart the csv is rebuilt from the journal, the binary store already holds the finished dimers
+        append = not restart or output_format == 'binary'
+        with open_output(name, output_format, append=append) as out, open(name + '.journal','a') as jfile:
+            for mol, en in done.items():
+                if en is not None:
+                    lab = (mol + '-A', mol + '-B')
+                    labels.append(lab)
+                    energies.append(en)
+                    if restart and output_format == 'csv':
+                        write_result(out, lab, en)
+
+            todo = [f for f in files if f.split('/')[-1].split('.xyz')[0] not in done]
+            # results are logged and written as each chunk of dimers is done
+            for mol, en in cliff.iter_energies(todo, options=options, nproc=nproc, units=units, return_pairs=frag):
+                pairs = None
+                if frag and en is not None:
+                    pairs = en
+                    en = np.sum(pairs, axis=(1,2))
+                write_journal(jfile, mol, en)
+                if en is None:
+                    logger.info(f"   Cannot compute {mol}")
+                    continue
+                lab = (mol + '-A', mol + '-B')
+                labels.append(lab)
+                energies.append(en)
+                print_ret_row(logger, lab, en)
+                write_result(out, lab, en, pairs)
+                if frag:
+                    # fragments of X.xyz are defined in X-A-frag.dat and X-B-frag.dat
+                    fa = paths[mol] + '-A-frag.dat'
+                    fb = paths[mol] + '-B-frag.dat'
+                    if os.path.isfile(fa) and os.path.isfile(fb):
+                        write_frag_output(fa, fb, name, pairs[1:], append=True)
+                    else:
+                        logger.info(f"   No fragment files for {mol}")
+
+        ret = (labels,energies)
     elif (monA is not None) and (monB is not None):
-        molA = cliff.load_monomer_xyz(monA, units)
-        molB = cliff.load_monomer_xyz(monB, units)
-        en = cliff.predict_from_monomer_list(molA,molB, options=options)
+        molA = cliff.read_monomer_xyz(monA, options, units)
+        molB = cliff.read_monomer_xyz(monB, options, units)
+        en = cliff.predict_from_monomer_list(molA,molB, options=options, nproc=nproc, return_pairs=frag)
         # make some labels
         labels = []
         for n in range(len(molA)):
             for m in range(len(molB)):
                 labels.append((n,m))
+
+        if frag:
+            # fragments are defined in monA-frag.dat and monB-frag.dat
+            fa = monA.split('.xyz')[0] + '-frag.dat'
+            fb = monB.split('.xyz')[0] + '-frag.dat'
+            written = False
+            for pairs in en:
+                if pairs is not None:
+                    write_frag_output(fa, fb, name, pairs[1:], append=written)
+                    written = True
+            en = [None if pairs is None else np.sum(pairs, axis=(1,2)) for pairs in en]
         ret = (labels,en)
 
-    print_ret(logger, ret)
-    
-    update_files(name, ret)
+        print_ret(logger, ret)
+        update_files(name, ret, output_format)
+
+    thread_budget.restore()
     end = time.time()
     logger.info("    ~CLIFF ran in {} s".format(end-start))
+    if metrics_file is not None:
+        with open(metrics_file, 'w') as mfile:
+            mfile.write(metrics.prometheus_text())
+    if trace_file is not None:
+        tracing.write_trace(trace_file)
+        tracing.disable_tracing()
 
     return ret
 
@@ -435,12 +551,11 @@ if __name__ == "__main__":
     if args.name is not None:
         name = args.name
 
-    if args.nproc is not None:
-        set_nthread(args.nproc)
-    
     frag = False
     if args.frag != False:
         frag = True
 
-    main(args.input, args.dimer, args.monA, args.monB, args.nproc, name, frag, batch_id=args.batch_id)
+    main(args.input, args.dimer, args.monA, args.monB, args.nproc, name, frag, batch_id=args.batch_id, restart=args.restart,
+         output_format=args.output_format, nthread=args.threads, metrics_file=args.metrics,
+         trace_file=args.trace)
 
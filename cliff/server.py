@@ -0,0 +1,361 @@
+#! /usr/bin/env python
+
+"""
+CLIFF evaluation server
+
+Keeps the options and ML models of CLIFF loaded in a long-running process
+and evaluates dimers and monomer lists sent to it over a Unix socket or a
+localhost TCP port, so that many small jobs don't each pay for loading the
+models.
+
+    python -m cliff.server -i config.ini --socket /tmp/cliff.sock
+
+The protocol is JSON lines: a client sends one request object per line and
+gets one response object per line back, on a connection that may be kept
+open for any number of requests. Requests are
+
+    {"op": "dimers", "dimers": [{"name": ..., "xyz": ...}, ...], "return_pairs": false}
+    {"op": "monomers", "mon_a": {"name": ..., "xyz": ...}, "mon_b": {...}, "return_pairs": false}
+    {"op": "ping"}
+    {"op": "metrics"}
+    {"op": "shutdown"}
+
+where "xyz" is the contents of a dimer or monomer xyz file as read by
+`cliff.load_dimer_xyz` and `cliff.load_monomer_xyz`. An optional "units"
+field gives the units of the coordinates. Evaluations answer with
+{"labels": [[mon_a, mon_b], ...], "energies": [...]}, one
+[total, elst, exch, indu, disp] row in kcal/mol per dimer (null if the
+dimer failed) and, if return_pairs was set, the (5, natom_a, natom_b)
+atom-pairwise energies under "pairs". Failed requests get {"error": message}.
+"metrics" answers with the timings and counters of the server (see
+`cliff.helpers.metrics`) as a dict under "metrics" and in the Prometheus
+text format under "prometheus".
+
+Requests aren't authenticated: anyone who can connect can run evaluations
+and shut the server down. A Unix socket is guarded by its file
+permissions, and TCP servers only listen on loopback addresses unless
+--allow-remote is given, which should only be used on trusted networks.
+
+See `Client` and `cliff/client.py` for the client side.
+"""
+
+import os
+import json
+import socket
+import socketserver
+import threading
+import argparse
+import ipaddress
+import numpy as np
+
+from cliff.helpers.options import Options
+import cliff.helpers.metrics as metrics
+from cliff.driver import load_krr_models, parse_dimer_xyz, parse_monomer_xyz, dimer_systems, monomer_systems
+from cliff.driver import _dimer_energies, _monomer_list_energies
+
+
+class Evaluator:
+    '''
+    Options and models resident in the server, and the evaluation of
+    requests with them. Requests are evaluated one at a time.
+
+    Parameters
+    ----------
+    options : :class: `~cliff.helpers.Options`
+        Options used for every request
+    ml_type : :class: `str`
+        'KRR' or 'NN'
+    load_path : :class: `str`
+        Load atomic properties from this directory instead of predicting them
+    nproc : :class: `int`
+        Number of worker processes per request
+    batch_size : :class: `int`
+        Batch size of the dimer energies, see `cliff.predict_from_dimers`
+    '''
+
+    def __init__(self, options, ml_type='KRR', load_path=None, nproc=1, batch_size=None):
+        self.options = options
+        self.ml_type = ml_type
+        self.load_path = load_path
+        self.nproc = nproc
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+        self.models = None
+        if ml_type.upper() == "KRR" and load_path is None:
+            self.models = load_krr_models(options)
+
+    def handle(self, request):
+        '''
+        Response to a decoded request, see the module documentation
+        '''
+        op = request.get('op')
+        if op == 'ping' or op == 'shutdown':
+            return {'status' : 'ok'}
+        elif op == 'dimers':
+            return self.dimers(request['dimers'], request.get('return_pairs', False), request.get('units', 'angstrom'))
+        elif op == 'metrics':
+            return {'metrics' : metrics.get_metrics(), 'prometheus' : metrics.prometheus_text()}
+        elif op == 'monomers':
+            return self.monomers(request['mon_a'], request['mon_b'], request.get('return_pairs', False),
+                                 request.get('units', 'angstrom'))
+        else:
+            raise Exception(f"Request {op} not understood!")
+
+    def read(self, xyz, name, units='angstrom', dimer=False):
+        '''
+        Dimer or monomers of the contents of an xyz file: Systems for the
+        KRR models, qcel Molecules for the NN models
+        '''
+        lines = xyz.splitlines(True)
+        if self.ml_type.upper() == "NN":
+            return parse_dimer_xyz(lines, name, units) if dimer else parse_monomer_xyz(lines, name, units)
+        return dimer_systems(lines, name, self.options, units) if dimer else monomer_systems(lines, name, self.options, units)
+
+    def dimers(self, dimers, return_pairs=False, units='angstrom'):
+        labels = []
+        mols = []
+        for dimer in dimers:
+            labels.append([dimer['name'] + '-A', dimer['name'] + '-B'])
+            try:
+                mols.append(self.read(dimer['xyz'], dimer['name'], units, dimer=True))
+            except:
+                mols.append(None)
+
+        loaded = [n for n, mol in enumerate(mols) if mol is not None]
+        energies = [None]*len(mols)
+        if len(loaded) > 0:
+            with self.lock:
+                ens = _dimer_energies([mols[n] for n in loaded], self.options, self.models, self.ml_type,
+                                      self.load_path, return_pairs, self.nproc, self.batch_size)
+            for n, en in zip(loaded, ens):
+                energies[n] = en
+        return _response(labels, energies, return_pairs)
+
+    def monomers(self, mon_a, mon_b, return_pairs=False, units='angstrom'):
+        mols_a = self.read(mon_a['xyz'], mon_a['name'], units)
+        mols_b = self.read(mon_b['xyz'], mon_b['name'], units)
+        with self.lock:
+            energies = _monomer_list_energies(mols_a, mols_b, self.options, self.models, self.ml_type,
+                                              self.load_path, return_pairs, self.nproc)
+        labels = [[ma.name, mb.name] for ma in mols_a for mb in mols_b]
+        return _response(labels, energies, return_pairs)
+
+
+def _response(labels, energies, return_pairs):
+    ret = {'labels' : labels}
+    if return_pairs:
+        ret['pairs'] = [None if en is None else en.tolist() for en in energies]
+        energies = [None if en is None else np.sum(en, axis=(1,2)) for en in energies]
+    ret['energies'] = [None if en is None else [float(e) for e in en] for en in energies]
+    return ret
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                request = json.loads(line.decode())
+                response = self.server.evaluator.handle(request)
+            except Exception as e:
+                request = {}
+                response = {'error' : str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+            if request.get('op') == 'shutdown':
+                # shutdown() waits for serve_forever, so it can't run in this thread
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def is_loopback(host):
+    '''
+    Whether every address of host is a loopback address
+    '''
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return len(infos) > 0 and all(ipaddress.ip_address(info[4][0].split('%')[0]).is_loopback for info in infos)
+
+def check_address(address, allow_remote=False):
+    '''
+    Requests aren't authenticated, so a TCP address with a host other than
+    a loopback address raises an Exception unless allow_remote is set
+    '''
+    if not isinstance(address, str) and not allow_remote and not is_loopback(address[0]):
+        raise Exception(f"Host {address[0]} isn't a loopback address, and the server has no authentication. "
+                        "Allow remote connections (--allow-remote) to listen on it anyway.")
+
+def make_server(address, evaluator, allow_remote=False):
+    '''
+    Server answering requests with evaluator on address: the path of a Unix
+    socket, or a (host, port) tuple. Run it with serve_forever(). See
+    `check_address` for allow_remote.
+    '''
+    check_address(address, allow_remote)
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(tuple(address), _Handler)
+    server.evaluator = evaluator
+    return server
+
+
+def serve(address, options=None, infile=None, ml_type='KRR', load_path=None, nproc=1, batch_size=None, allow_remote=False):
+    '''
+    Loads the options and models and answers requests on address until a
+    shutdown request, see `make_server`.
+    '''
+    if options is None:
+        if infile is None:
+            options = Options()
+        else:
+            options = Options(config_file=infile)
+
+    # before loading the models
+    check_address(address, allow_remote)
+    evaluator = Evaluator(options, ml_type, load_path, nproc, batch_size)
+    server = make_server(address, evaluator, allow_remote)
+    print(f"CLIFF server listening on {address}", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+
+
+class Client:
+    '''
+    Connection to a CLIFF server
+
+    Parameters
+    ----------
+    address : :class: `str` or :class: `tuple`
+        Path of the Unix socket, or (host, port) of the server
+    '''
+
+    def __init__(self, address):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.create_connection(tuple(address))
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, request):
+        '''
+        Sends one request and returns the decoded response
+        '''
+        self.sock.sendall((json.dumps(request) + '\n').encode())
+        line = self.rfile.readline()
+        if len(line) == 0:
+            raise Exception("CLIFF server closed the connection")
+        response = json.loads(line.decode())
+        if 'error' in response:
+            raise Exception(f"CLIFF server error: {response['error']}")
+        return response
+
+    def dimers(self, xyz_files, return_pairs=False, units='angstrom'):
+        '''
+        Energies of dimer xyz files, as (labels, energies) with energies
+        like those of `cliff.predict_from_dimers`
+        '''
+        dimers = []
+        for xyz_file in xyz_files:
+            with open(xyz_file, 'r') as xfile:
+                dimers.append({'name' : xyz_file.split('/')[-1].split('.xyz')[0], 'xyz' : xfile.read()})
+        response = self.request({'op' : 'dimers', 'dimers' : dimers, 'return_pairs' : return_pairs, 'units' : units})
+        return _decode(response, return_pairs)
+
+    def monomers(self, monA, monB, return_pairs=False, units='angstrom'):
+        '''
+        Energies of all pairs of the monomers in two monomer xyz files, as
+        (labels, energies) with energies like those of
+        `cliff.predict_from_monomer_list`
+        '''
+        mons = []
+        for xyz_file in (monA, monB):
+            with open(xyz_file, 'r') as xfile:
+                mons.append({'name' : xyz_file.split('/')[-1].split('.xyz')[0], 'xyz' : xfile.read()})
+        response = self.request({'op' : 'monomers', 'mon_a' : mons[0], 'mon_b' : mons[1],
+                                 'return_pairs' : return_pairs, 'units' : units})
+        return _decode(response, return_pairs)
+
+    def ping(self):
+        return self.request({'op' : 'ping'})
+
+    def metrics(self):
+        return self.request({'op' : 'metrics'})
+
+    def shutdown(self):
+        return self.request({'op' : 'shutdown'})
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _decode(response, return_pairs):
+    labels = [tuple(lab) for lab in response['labels']]
+    key = 'pairs' if return_pairs else 'energies'
+    energies = [None if en is None else np.array(en) for en in response[key]]
+    return labels, energies
+
+
+def get_address(socket_path=None, host='127.0.0.1', port=None):
+    '''
+    Server address from the command line options of the server and client
+    '''
+    if socket_path is not None:
+        return socket_path
+    if port is None:
+        raise Exception("Specify either a socket path or a port")
+    return (host, port)
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description="CLIFF evaluation server")
+    parser.add_argument('-i','--input', type=str, help='Location of input configuration file')
+    parser.add_argument('-s','--socket', type=str, help='Path of the Unix socket to listen on')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on with --port')
+    parser.add_argument('--port', type=int, help='TCP port to listen on')
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='Listen on a --host other than a loopback address. Requests are not authenticated')
+    parser.add_argument('-p','--nproc', type=int, default=1, help='Number of worker processes per request')
+    parser.add_argument('--batch-size', type=int, help='Number of dimers evaluated together on padded arrays')
+    parser.add_argument('--load-path', type=str, help='Load atomic properties from this directory instead of predicting them')
+    parser.add_argument('--ml-type', type=str, default='KRR', help='KRR or NN')
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = init_args()
+    address = get_address(args.socket, args.host, args.port)
+    infile = args.input
+    if infile is None and os.path.exists('config.ini'):
+        infile = 'config.ini'
+    serve(address, infile=infile, ml_type=args.ml_type, load_path=args.load_path, nproc=args.nproc, batch_size=args.batch_size,
+          allow_remote=args.allow_remote)
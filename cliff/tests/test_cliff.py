@@ -138,3 +138,155 @@ def test_cliff_mon_runscript():
         assert abs(ref_e[2] - en[3]) < 1e-5 
         assert abs(ref_e[3] - en[4]) < 1e-5 
 
+
+def test_batch_kernel():
+
+    from cliff.helpers.options import Options
+    from cliff.helpers.cell import Cell
+    from cliff.components.prepared import PreparedMonomer, pair_energy, batch_pair_energies
+
+    options = Options(testpath + '/config.ini')
+    cell = Cell.lattice_parameters(100., 100., 100.)
+    rng = np.random.default_rng(5)
+
+    dimers = []
+    for dimer_xyz in sorted(glob.glob(testpath + "/dimer_data/*.xyz")):
+        mons = cliff.mol_to_sys(cliff.load_dimer_xyz(dimer_xyz), options)
+        # synthetic atomic properties
+        for mon in mons:
+            mon.hirshfeld_ratios = rng.uniform(0.7, 1.0, mon.num_atoms)
+            mon.valence_widths = rng.uniform(0.35, 0.6, mon.num_atoms)
+            mon.multipoles = rng.normal(0.0, 0.2, (mon.num_atoms, 9))
+        dimers.append(mons)
+
+    refs = [cliff.energy_kernel(mon_a, mon_b, options) for mon_a, mon_b in dimers]
+    prepared = [(PreparedMonomer(options, mon_a, cell), PreparedMonomer(options, mon_b, cell)) for mon_a, mon_b in dimers]
+    single = [pair_energy(mon_a, mon_b, options) for mon_a, mon_b in prepared]
+    batch = batch_pair_energies([p[0] for p in prepared], [p[1] for p in prepared], options)
+
+    assert np.allclose(single, refs, rtol=0.0, atol=1e-8)
+    assert np.allclose(batch, refs, rtol=0.0, atol=1e-8)
+
+    # the atom-pairwise energies, only built on request, add up to the totals
+    pairs = [cliff.energy_kernel(mon_a, mon_b, options, return_pairs=True) for mon_a, mon_b in dimers]
+    assert np.allclose([np.sum(p, axis=(1,2)) for p in pairs], refs, rtol=0.0, atol=1e-8)
+    single_pairs = [pair_energy(mon_a, mon_b, options, return_pairs=True) for mon_a, mon_b in prepared]
+    assert all(np.allclose(p, q, rtol=0.0, atol=1e-8) for p, q in zip(pairs, single_pairs))
+
+    # the same with the components running in concurrent threads
+    from cliff.helpers import budget
+    total = budget.get_thread_budget()
+    pools = budget.get_blas_threads()
+    # found once per process
+    assert budget.thread_pools() is budget.thread_pools()
+    options.set_component_threads(4)
+    with cliff.set_nthread(4):
+        assert budget.get_thread_budget() == 4
+        threaded = [cliff.energy_kernel(mon_a, mon_b, options) for mon_a, mon_b in dimers]
+        threaded_batch = batch_pair_energies([p[0] for p in prepared], [p[1] for p in prepared], options)
+    assert budget.get_thread_budget() == total
+    assert budget.get_blas_threads() == pools
+    assert np.array_equal(threaded, refs)
+    assert np.array_equal(threaded_batch, batch)
+
+def test_krr_batch_prediction():
+    from cliff.helpers.utils import krr_predict_atoms
+
+    rng = np.random.default_rng(2)
+    descr_train = {'H' : rng.normal(size=(6,4)), 'C' : rng.normal(size=(5,4)), 'N' : []}
+    alpha_train = {'H' : rng.normal(size=(6,13)), 'C' : rng.normal(size=(5,13)), 'N' : None}
+    elements = [['C','H','H','N'], ['H'], ['C','C']]
+    descrs = [rng.normal(size=(len(eles),4)) for eles in elements]
+    kernel = lambda d: np.exp(-d)
+
+    # all molecules together, and one at a time
+    out = [np.zeros((len(eles),13)) for eles in elements]
+    krr_predict_atoms(descrs, elements, descr_train, alpha_train, 'cityblock', kernel, out)
+    for n in range(len(elements)):
+        ref = np.zeros((len(elements[n]),13))
+        krr_predict_atoms([descrs[n]], [elements[n]], descr_train, alpha_train, 'cityblock', kernel, [ref])
+        assert np.allclose(out[n], ref)
+    assert np.all(out[0][3] == 0)
+
+def test_benchmark():
+    from cliff import benchmark
+    from cliff.helpers.options import Options
+
+    options = Options(testpath + '/config.ini')
+    # the generated monomers are typed like real molecules
+    for kind in ['water', 'alkane']:
+        mon_a, mon_b = benchmark.scaling_dimers(options, kind, 4)[0]
+        assert set(mon_a.atom_types) == ({'O2', 'HO'} if kind == 'water' else {'C4', 'HC'})
+        assert mon_a.num_atoms == mon_b.num_atoms == (12 if kind == 'water' else 14)
+
+    results = benchmark.run_benchmarks(options, sizes=[2], repeat=1)
+    assert set(results['energies']) == {'dimer_data', 'water-2', 'alkane-2'}
+    assert all(np.all(np.isfinite(en)) for en in results['energies'].values())
+    for stage in ['io_read', 'elst', 'exch', 'indu', 'disp', 'energy', 'batch']:
+        assert results['benchmarks']['dimer_data/' + stage]['seconds'] > 0.0
+
+    rows, failures = benchmark.compare(results, results)
+    assert len(rows) == len(results['benchmarks']) and len(failures) == 0
+    # a baseline four times as fast flags the stages that take long enough
+    fast = {**results, 'benchmarks' : {name : {'seconds' : entry['seconds']/4} for name, entry in results['benchmarks'].items()}}
+    rows, failures = benchmark.compare(fast, results, min_seconds=0.0)
+    assert len(failures) == 0
+    rows, failures = benchmark.compare(results, fast, min_seconds=0.0)
+    assert all(row['regression'] for row in rows) and len(failures) == len(rows)
+    rows, failures = benchmark.compare(results, {**fast, 'tolerances' : {'*' : 4.0}}, min_seconds=0.0)
+    assert len(failures) == 0
+
+def test_system_arrays():
+    import pickle
+    import cliff.helpers.constants as constants
+    from cliff.helpers.options import Options
+
+    options = Options()
+    mon_a, mon_b = cliff.read_dimer_xyz(testpath + "/dimer_data/NBC-13.xyz", options)
+    assert not hasattr(mon_a, '__dict__')
+    for mon in [mon_a, mon_b, pickle.loads(pickle.dumps(mon_a)), mon_a + mon_b]:
+        assert [mon.master_atom_types[i] for i in mon.type_index] == list(mon.atom_types)
+        assert [mon.master_elements[i] for i in mon.element_index] == list(mon.elements)
+        assert np.array_equal(mon.type_params(options.exch_int_params), [options.exch_int_params[t] for t in mon.atom_types])
+        assert np.array_equal(mon.element_params(constants.csix_free), [constants.csix_free[e] for e in mon.elements])
+
+def test_async_predictor():
+    import asyncio
+
+    calls = []
+    def evaluate(requests):
+        calls.append([req[0] for req in requests])
+        return [req[0] * 2 for req in requests]
+
+    async def batched(predictor):
+        # max_batch requests go together without waiting for max_delay
+        ret = await asyncio.wait_for(asyncio.gather(*[predictor.predict(n) for n in range(3)]), 5.0)
+        assert ret == [0, 2, 4]
+        # fewer are evaluated after max_delay
+        ret = await asyncio.wait_for(asyncio.gather(*[predictor.predict(n) for n in range(3, 5)]), 5.0)
+        assert ret == [6, 8]
+
+    async def cancelled(predictor):
+        tasks = [asyncio.ensure_future(predictor.predict(n)) for n in range(5, 7)]
+        await asyncio.sleep(0)
+        tasks[0].cancel()
+        assert await asyncio.wait_for(tasks[1], 5.0) == 12
+
+    async def abandoned(predictor):
+        # the loop ends before the batch of this request is started
+        asyncio.ensure_future(predictor.predict(7))
+        await asyncio.sleep(0)
+
+    predictor = cliff.AsyncPredictor(max_batch=3, max_delay=0.05)
+    predictor.evaluate = evaluate
+    try:
+        asyncio.run(batched(predictor))
+        assert calls == [[0, 1, 2], [3, 4]]
+        asyncio.run(cancelled(predictor))
+        assert calls[-1] == [6]
+        # a new loop doesn't wait on the requests of the old one
+        asyncio.run(abandoned(predictor))
+        asyncio.run(asyncio.wait_for(predictor.predict(8), 5.0))
+        assert calls[-1] == [8]
+    finally:
+        predictor.close()
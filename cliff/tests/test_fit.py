@@ -0,0 +1,106 @@
+"""
+Unit tests for the global-parameter fitting objectives.
+"""
+
+# Import package, test suite, and other packages as needed
+import cliff
+import pytest
+import numpy as np
+import cliff.fit as fit
+
+
+def test_type_pair_reduction():
+
+    rng = np.random.default_rng(7)
+    ntypes = len(fit.master_atom_types)
+    types_a = rng.integers(0, ntypes, 9)
+    types_b = rng.integers(0, ntypes, 5)
+    ovp = rng.uniform(size=(9,5))
+    params = rng.uniform(-2.0, 2.0, ntypes)
+
+    red = fit.reduce_type_pairs(ovp, types_a, types_b)
+    en, grad = fit.bilinear_energy(params, red[None,:,:])
+
+    u = np.abs(params)
+    ref = np.dot(u[types_a], np.dot(ovp, u[types_b]))
+    assert abs(en[0] - ref) < 1e-10
+
+    h = 1e-6
+    for n in range(ntypes):
+        step = np.zeros(ntypes)
+        step[n] = h
+        fd = (fit.bilinear_energy(params + step, red[None])[0] - fit.bilinear_energy(params - step, red[None])[0]) / (2*h)
+        assert abs(fd[0] - grad[0,n]) < 1e-6
+
+def test_component_gradients():
+
+    import os
+    import glob
+    import cliff.tests as t
+    from cliff.helpers.options import Options
+    from cliff.helpers.cell import Cell
+    from cliff.components.electrostatics import Electrostatics
+    from cliff.components.induction_calc import InductionCalc
+
+    testpath = os.path.abspath(t.__file__).split('__init__')[0]
+    dimer_xyz = sorted(glob.glob(testpath + "/dimer_data/*.xyz"))[0]
+    options = Options(testpath + '/config.ini')
+    options.set_induction_conv(1e-12)
+    mon_a, mon_b = cliff.mol_to_sys(cliff.load_dimer_xyz(dimer_xyz), options)
+
+    # synthetic atomic properties
+    rng = np.random.default_rng(3)
+    for mon in (mon_a, mon_b):
+        mon.hirshfeld_ratios = rng.uniform(0.7, 1.0, mon.num_atoms)
+        mon.valence_widths = rng.uniform(0.35, 0.6, mon.num_atoms)
+        mon.multipoles = rng.normal(0.0, 0.2, (mon.num_atoms, 9))
+    cell = Cell.lattice_parameters(100., 100., 100.)
+
+    def elst_energy(exponents):
+        options.set_damping_exponents(fit.param_dict(exponents))
+        elst = Electrostatics(options, mon_a, cell)
+        elst.add_system(mon_b)
+        return elst
+
+    exponents = rng.uniform(1.5, 4.0, len(fit.master_atom_types))
+    en, grad = elst_energy(exponents).mtp_energy_gradient()
+    assert abs(en - elst_energy(exponents).mtp_energy()) < 1e-8
+
+    h = 1e-5
+    for n in range(len(exponents)):
+        step = np.zeros(len(exponents))
+        step[n] = h
+        fd = (elst_energy(exponents + step).mtp_energy() - elst_energy(exponents - step).mtp_energy()) / (2*h)
+        assert abs(fd - grad[n]) < 1e-5
+
+    def indu_energy(smearing_coeff):
+        ind = InductionCalc(options, mon_a, cell)
+        ind.add_system(mon_b)
+        ind.polarization_energy(smearing_coeff=smearing_coeff)
+        return ind.energy_polarization
+
+    ind = InductionCalc(options, mon_a, cell)
+    ind.add_system(mon_b)
+    en, grad = ind.polarization_energy_gradient(smearing_coeff=0.4)
+    assert abs(en - indu_energy(0.4)) < 1e-8
+
+    h = 1e-4
+    fd = (indu_energy(0.4 + h) - indu_energy(0.4 - h)) / (2*h)
+    assert abs(fd - grad) < 1e-6
+
+def test_minibatch_fit():
+
+    rng = np.random.default_rng(11)
+    ntypes = len(fit.master_atom_types)
+    ndimer = 40
+    ovp = rng.uniform(size=(ndimer, ntypes, ntypes))
+    fit_data = {'ovp' : ovp, 'disp_c6' : np.zeros(ndimer), 'disp_hi' : ovp, 'index' : np.arange(ndimer)}
+
+    target = rng.uniform(0.5, 1.5, ntypes)
+    ref = np.zeros((ndimer, 5))
+    ref[:,2] = fit.bilinear_energy(target, ovp)[0]
+
+    start = np.ones(ntypes)
+    params = fit.minibatch_minimize(fit.get_exch_energy_reduced, start, fit_data, ref,
+                batch_size=8, epochs=20, learning_rate=0.01, seed=0)
+    assert fit.get_exch_energy_reduced(params, fit_data, ref)[0] < 0.5 * fit.get_exch_energy_reduced(start, fit_data, ref)[0]
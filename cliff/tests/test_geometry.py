@@ -0,0 +1,74 @@
+"""
+Unit tests for rigid-body matching of monomer geometries.
+"""
+
+# Import package, test suite, and other packages as needed
+import cliff
+import pytest
+import os
+import glob
+import copy
+import numpy as np
+from cliff.helpers.options import Options
+from cliff.helpers import geometry
+
+import cliff.tests as t
+testpath = os.path.abspath(t.__file__).split('__init__')[0]
+
+
+def test_rigid_copies():
+
+    options = Options(testpath + '/config.ini')
+    dimer_xyz = sorted(glob.glob(testpath + "/dimer_data/*.xyz"))[0]
+    mon_a, mon_b = cliff.mol_to_sys(cliff.load_dimer_xyz(dimer_xyz), options)
+
+    # random proper rotation
+    rng = np.random.default_rng(5)
+    rot, r = np.linalg.qr(rng.normal(size=(3,3)))
+    rot *= np.sign(np.linalg.det(rot))
+
+    mon_c = copy.deepcopy(mon_a)
+    mon_c.coords = np.dot(mon_a.coords, rot.T) + np.array([1.0, -2.0, 0.5])
+
+    refs, rots = geometry.find_rigid_copies([mon_a, mon_b, None, mon_c])
+    assert refs == [0, 1, None, 0]
+    assert np.allclose(rots[3], rot)
+
+    mtps = rng.normal(size=(mon_a.num_atoms, 13))
+    back = geometry.rotate_multipoles(geometry.rotate_multipoles(mtps, rot), rot.T)
+    assert np.allclose(back, mtps)
+
+    mtps = rng.normal(size=(mon_a.num_atoms, 9))
+    back = geometry.rotate_multipoles(geometry.rotate_multipoles(mtps, rot), rot.T)
+    assert np.allclose(back, mtps)
+
+class SyntheticModel:
+    # atomic properties that depend on the geometry, in place of the KRR models
+    def predict_mols(self, systems):
+        for mon in systems:
+            coords = np.asarray(mon.coords) - np.mean(mon.coords, axis=0)
+            dist = np.linalg.norm(coords, axis=1)
+            mon.hirshfeld_ratios = 0.7 + 0.05*dist
+            mon.valence_widths = 0.4 + 0.02*dist
+            mon.multipoles = np.zeros((mon.num_atoms, 9))
+            mon.multipoles[:,0] = 0.1*(dist - np.mean(dist))
+            mon.multipoles[:,1:4] = 0.05*coords
+
+def test_near_copies():
+    from cliff.driver import get_monomer_properties
+
+    options = Options()
+    state = {'options' : options, 'models' : [SyntheticModel()], 'load_path' : None}
+    mon_a, mon_b = cliff.read_dimer_xyz(testpath + "/dimer_data/NBC-4.xyz", options)
+
+    # one atom moved by 5e-5 Angstrom is another geometry
+    near_a = copy.deepcopy(mon_a)
+    near_a.coords = np.copy(mon_a.coords)
+    near_a.coords[0,0] += 5e-5
+    assert geometry.find_rigid_copies([near_a, mon_a])[0] == [0, 1]
+
+    alone = get_monomer_properties([copy.deepcopy(mon_a), copy.deepcopy(mon_b)], state)
+    batch = get_monomer_properties([near_a, copy.deepcopy(mon_a), copy.deepcopy(mon_b)], state)
+    ref = cliff.energy_kernel(alone[0], alone[1], options)
+    en = cliff.energy_kernel(batch[1], batch[2], options)
+    assert np.array_equal(en, ref)
@@ -9,6 +9,7 @@ import sys
 import os
 from cliff.helpers.options import Options
 import numpy as np
+import glob
 
 
 import cliff.tests as t
@@ -60,3 +61,341 @@ def test_cliff_io():
         assert abs(ref[2] - en[3]) < 1e-5        
         assert abs(ref[3] - en[4]) < 1e-5        
 
+
+def test_result_store(tmp_path):
+    from cliff.helpers.results import ResultWriter, load_results
+
+    rng = np.random.default_rng(1)
+    pairs = rng.normal(size=(5,3,4))
+    energies = rng.normal(size=5)
+
+    name = str(tmp_path / 'job')
+    with ResultWriter(name) as out:
+        out.write('A', 'B', None, pairs)
+    with ResultWriter(name, append=True) as out:
+        out.write('C', 'D', energies)
+        with pytest.raises(Exception):
+            out.write('E'*65, 'F', energies)
+
+    res = load_results(name)
+    assert res.labels == [('A', 'B'), ('C', 'D')]
+    assert np.array_equal(res.energies[0], np.sum(pairs, axis=(1,2)))
+    assert np.array_equal(res.energies[1], energies)
+    assert np.array_equal(res.pairs(0), pairs)
+    assert res.pairs(1) is None
+
+
+def test_server(tmp_path):
+    import threading
+    from cliff.server import Evaluator, make_server, Client
+
+    # no atomic properties in tmp_path, so every dimer fails without loading any models
+    evaluator = Evaluator(Options(), load_path=str(tmp_path) + '/')
+    address = str(tmp_path / 'cliff.sock')
+    server = make_server(address, evaluator)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    try:
+        with Client(address) as client:
+            assert client.ping() == {'status' : 'ok'}
+            labels, energies = client.dimers([testpath + '/dimer_data/S66-1.xyz'])
+            assert labels == [('S66-1-A', 'S66-1-B')]
+            assert energies == [None]
+            with pytest.raises(Exception):
+                client.request({'op' : 'unknown'})
+            client.shutdown()
+    finally:
+        thread.join(timeout=10)
+        server.server_close()
+
+    # requests aren't authenticated, so only loopback hosts without allow_remote
+    with pytest.raises(Exception):
+        make_server(('0.0.0.0', 0), evaluator)
+    server = make_server(('localhost', 0), evaluator)
+    server.server_close()
+
+
+def test_trajectory(tmp_path):
+    from cliff.helpers.trajectory import load_trajectory
+
+    files = sorted(glob.glob(testpath + '/dimer_data/*.xyz'))
+    traj_file = str(tmp_path / 'traj.xyz')
+    with open(traj_file, 'w') as tfile:
+        for f in files:
+            tfile.write(open(f).read().rstrip('\n') + '\n')
+
+    options = Options()
+    for mmap in [True, True, False]:
+        # the second pass reads the saved index
+        traj = load_trajectory(traj_file, mmap=mmap)
+        assert len(traj) == len(files)
+        for n, f in enumerate(files):
+            ref = cliff.read_dimer_xyz(f, options)
+            dimer = traj.dimer(n, options)
+            for mon, mon_ref in zip(dimer, ref):
+                assert np.array_equal(mon.coords, mon_ref.coords)
+                assert mon.elements == mon_ref.elements
+
+
+def test_property_cache(tmp_path):
+    from cliff.helpers.property_cache import PropertyCache
+
+    options = Options()
+    mon_a, mon_b = cliff.read_dimer_xyz(testpath + '/dimer_data/S66-1.xyz', options)
+    for mon in [mon_a, mon_b]:
+        mon.hirshfeld_ratios = np.full(mon.num_atoms, 0.8)
+        mon.valence_widths = np.full(mon.num_atoms, 0.5)
+        mon.multipoles = np.ones((mon.num_atoms, 9))
+
+    cache = PropertyCache(str(tmp_path / 'cache'), 'v1')
+    cache.save(mon_a)
+    new_a, new_b = cliff.read_dimer_xyz(testpath + '/dimer_data/S66-1.xyz', options)
+    assert cache.load(new_a)
+    assert np.array_equal(new_a.multipoles, mon_a.multipoles)
+    # another geometry, or another model version, is a miss
+    assert not cache.load(new_b)
+    assert not PropertyCache(str(tmp_path / 'cache'), 'v2').load(new_a)
+
+    # with room for one entry, the least recently used one goes
+    small = PropertyCache(str(tmp_path / 'small'), 'v1', max_size=1.5*cache.size/1024**2)
+    small.save(mon_a)
+    os.utime(small.entry(small.key(mon_a)), (0, 0))
+    small.save(mon_b)
+    assert len(small.entries()) == 1
+    assert small.load(new_b)
+
+def test_energy_memo(tmp_path):
+    from cliff.helpers.energy_memo import EnergyMemo, dimer_key, parameter_hash
+
+    options = Options()
+    mon_a, mon_b = cliff.read_dimer_xyz(testpath + '/dimer_data/S66-1.xyz', options)
+    params = parameter_hash(options)
+    key = dimer_key(mon_a, mon_b, params, 'energies')
+    # any change of geometry, parameters or kind of result is another key
+    assert key != dimer_key(mon_b, mon_a, params, 'energies')
+    assert key != dimer_key(mon_a, mon_b, params, 'pairs')
+
+    memo = EnergyMemo(str(tmp_path / 'memo.db'))
+    memo.put([(key, np.arange(5.0))])
+    found, missing = memo.get([key, 'other'])
+    assert np.array_equal(found, np.arange(5.0))
+    assert missing is None
+    assert len(EnergyMemo(str(tmp_path / 'memo.db'))) == 1
+
+    # a change of a parameter of the master atom types misses
+    options.set_disp_coeffs({**options.disp_coeffs, 'HC': 1.1*options.disp_coeffs['HC']})
+    new_key = dimer_key(mon_a, mon_b, parameter_hash(options), 'energies')
+    assert new_key != key
+    assert memo.get([new_key]) == [None]
+
+def test_metrics():
+    from cliff.helpers.metrics import Registry
+
+    registry = Registry()
+    with registry.timer('elst') as timing:
+        pass
+    registry.observe('cliff_stage_seconds', 2.0, stage='elst')
+    registry.inc('cliff_dimers_total', 3)
+    metrics = registry.as_dict()
+    hist = metrics['histograms']['cliff_stage_seconds'][0]
+    assert hist['labels'] == {'stage' : 'elst'}
+    assert hist['count'] == 2 and hist['sum'] == timing['seconds'] + 2.0
+    assert metrics['counters']['cliff_dimers_total'][0]['value'] == 3
+
+    # values of another process add up
+    other = Registry()
+    other.inc('cliff_dimers_total', 2)
+    registry.merge(other.drain())
+    assert other.as_dict() == {'counters' : {}, 'histograms' : {}}
+    text = registry.prometheus()
+    assert 'cliff_dimers_total 5\n' in text
+    assert 'cliff_stage_seconds_bucket{stage="elst",le="+Inf"} 2\n' in text
+
+def test_tracing(tmp_path):
+    import json
+    from cliff.helpers import tracing
+
+    tracing.drain()
+    with tracing.span('dimer', natom=3):
+        pass
+    assert tracing.get_events() == []
+
+    with tracing.trace(str(tmp_path / 'trace.json')):
+        with tracing.span('dimer', natom=3) as span:
+            span.set(iterations=5)
+    assert not tracing.enabled()
+    events = json.load(open(tmp_path / 'trace.json'))['traceEvents']
+    assert len(events) == 1
+    assert events[0]['name'] == 'dimer' and events[0]['ph'] == 'X'
+    assert events[0]['args'] == {'natom' : 3, 'iterations' : 5}
+    tracing.drain()
+
+def _property_files(path, options):
+    # synthetic atomic properties of the dimer_data monomers, for load_path
+    from cliff.benchmark import synthetic_properties
+
+    for n, f in enumerate(sorted(glob.glob(testpath + '/dimer_data/*.xyz'))):
+        for m, mon in enumerate(cliff.read_dimer_xyz(f, options)):
+            synthetic_properties(mon, seed=2*n + m)
+            np.save(f"{path}/{mon.name}-h.npy", mon.hirshfeld_ratios)
+            np.save(f"{path}/{mon.name}-vw.npy", mon.valence_widths)
+            np.save(f"{path}/{mon.name}-mtp.npy", mon.multipoles)
+    return str(path)
+
+def test_iter_energies(tmp_path):
+    options = Options()
+    load_path = _property_files(tmp_path, options)
+
+    files = sorted(glob.glob(testpath + '/dimer_data/*.xyz'))
+    dimers = [cliff.read_dimer_xyz(f, options) for f in files]
+    refs = cliff.predict_from_dimers(dimers, load_path=load_path, options=options)
+    assert all(en is not None for en in refs)
+
+    # an unreadable file in the middle, and chunks smaller than the input
+    stream = files[:2] + [str(tmp_path / 'missing.xyz')] + files[2:]
+    results = list(cliff.iter_energies(stream, load_path=load_path, options=options, chunk_size=2))
+    names = [f.split('/')[-1].split('.xyz')[0] for f in stream]
+    assert [name for name, _ in results] == names
+    assert results[2][1] is None
+    energies = [en for _, en in results[:2] + results[3:]]
+    assert np.allclose(energies, refs, rtol=0.0, atol=1e-10)
+
+class Killed(Exception):
+    pass
+
+def _run_dimers(monkeypatch, load_path, name, kill_after=None, **kwargs):
+    # run_cliff on dimer_data with the properties of load_path, killed
+    # after kill_after dimers are done
+    import cliff.run_cliff as rc
+
+    iter_energies = cliff.driver.iter_energies
+    def energies(*args, **kw):
+        for n, res in enumerate(iter_energies(*args, load_path=load_path, **kw)):
+            if n == kill_after:
+                raise Killed()
+            yield res
+    monkeypatch.setattr(cliff, 'iter_energies', energies)
+    with cliff.set_nthread(None):
+        return rc.main(dimer=testpath + '/dimer_data/', name=name, **kwargs)
+
+def _truncate(filename, nbyte):
+    with open(filename, 'r+b') as f:
+        f.truncate(nbyte)
+
+def test_restart(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / 'props')
+    load_path = _property_files(tmp_path / 'props', Options())
+    monkeypatch.chdir(tmp_path)
+
+    ref = _run_dimers(monkeypatch, load_path, 'clean')
+    assert len(ref[0]) == 4
+    with pytest.raises(Killed):
+        _run_dimers(monkeypatch, load_path, 'job', kill_after=3)
+    # killed while writing: the last journal line and csv row are partial
+    journal = open('job.journal').read()
+    assert len(journal.splitlines()) == 3
+    _truncate('job.journal', len(journal) - len(journal.splitlines()[-1])//2 - 1)
+    _truncate('job.csv', os.path.getsize('job.csv') - 20)
+
+    ret = _run_dimers(monkeypatch, load_path, 'job', restart=True)
+    assert open('job.csv').read() == open('clean.csv').read()
+    assert ret[0] == ref[0]
+    assert np.allclose(ret[1], ref[1], rtol=0.0, atol=1e-10)
+    assert len(open('job.journal').readlines()) == 4
+
+    # a run without restart adds to the results of the earlier ones
+    _run_dimers(monkeypatch, load_path, 'job')
+    rows = open('job.csv').read()
+    assert rows.startswith(open('clean.csv').read())
+    assert len(rows.splitlines()) == 1 + 2*len(ref[0])
+
+def test_restart_binary(tmp_path, monkeypatch):
+    from cliff.helpers.results import load_results, record_dtype
+
+    os.makedirs(tmp_path / 'props')
+    load_path = _property_files(tmp_path / 'props', Options())
+    monkeypatch.chdir(tmp_path)
+
+    _run_dimers(monkeypatch, load_path, 'clean', frag=True, output_format='binary')
+    with pytest.raises(Killed):
+        _run_dimers(monkeypatch, load_path, 'job', kill_after=3, frag=True, output_format='binary')
+    # the last dimer got to the journal, but only half of its record to the store
+    _truncate('job-results.bin', os.path.getsize('job-results.bin') - record_dtype.itemsize//2)
+
+    _run_dimers(monkeypatch, load_path, 'job', restart=True, frag=True, output_format='binary')
+    res, ref = load_results('job'), load_results('clean')
+    assert len(ref) == 4
+    assert res.labels == ref.labels
+    assert np.allclose(res.energies, ref.energies, rtol=0.0, atol=1e-10)
+    for n in range(len(ref)):
+        assert np.allclose(res.pairs(n), ref.pairs(n), rtol=0.0, atol=1e-10)
+    assert os.path.getsize('job-pairs.bin') == os.path.getsize('clean-pairs.bin')
+
+def test_fragment_energies(tmp_path):
+    from cliff.helpers.fragments import load_fragments, fragment_energies
+
+    mon_a, mon_b = cliff.read_dimer_xyz(testpath + '/dimer_data/S66-10.xyz', Options())
+    assert (mon_a.num_atoms, mon_b.num_atoms) == (7, 7)
+    with open(tmp_path / 'A-frag.dat', 'w') as ffile:
+        ffile.write("NH2 1 2 3\nCH3 4 5 6 7\n")
+    with open(tmp_path / 'B-frag.dat', 'w') as ffile:
+        ffile.write("N 1\n\nH 2 3\nC 4\n")
+    frags_a = load_fragments(str(tmp_path / 'A-frag.dat'))
+    frags_b = load_fragments(str(tmp_path / 'B-frag.dat'))
+    assert list(frags_b) == ['N', 'H', 'C', 'All']
+
+    pairs = np.random.default_rng(3).normal(size=(4, mon_a.num_atoms, mon_b.num_atoms))
+    en = fragment_energies(pairs, frags_a, frags_b)
+    assert en.shape == (4, 3, 4)
+    # the atom-pair loops of the original text output
+    for ia, atoms_a in enumerate(frags_a.values()):
+        for ib, atoms_b in enumerate(frags_b.values()):
+            ref = np.zeros(4)
+            for a in atoms_a:
+                for b in atoms_b:
+                    ref += pairs[:,a,b]
+            assert np.allclose(en[:,ia,ib], ref, rtol=0.0, atol=1e-12)
+
+def _same_systems(systems, refs):
+    assert len(systems) == len(refs)
+    for mon, ref in zip(systems, refs):
+        assert mon.name == ref.name
+        assert list(mon.elements) == list(ref.elements)
+        assert list(mon.atom_types) == list(ref.atom_types)
+        # QCElemental rounds the coordinates to 1e-8 bohr
+        assert np.allclose(mon.coords, ref.coords, rtol=0.0, atol=1e-7)
+
+def test_read_xyz(tmp_path):
+    options = Options()
+    # the Systems read directly are those of the QCElemental Molecules
+    for f in sorted(glob.glob(testpath + '/dimer_data/*.xyz')):
+        _same_systems(cliff.read_dimer_xyz(f, options), cliff.mol_to_sys(cliff.load_dimer_xyz(f), options))
+    for f in sorted(glob.glob(testpath + '/monomer_data/*.xyz')):
+        refs = [cliff.mol_to_sys(mol, options) for mol in cliff.load_monomer_xyz(f)]
+        _same_systems(cliff.read_monomer_xyz(f, options), refs)
+
+    # coordinates in bohr
+    lines = open(testpath + '/dimer_data/S66-10.xyz').readlines()
+    bohr = lines[:2] + [f"{line.split()[0]} " + " ".join(str(float(x)/0.52917721067) for x in line.split()[1:]) + "\n"
+                        for line in lines[2:]]
+    with open(tmp_path / 'S66-10.xyz', 'w') as xfile:
+        xfile.write("".join(bohr))
+    systems = cliff.read_dimer_xyz(str(tmp_path / 'S66-10.xyz'), options, units='bohr')
+    _same_systems(systems, cliff.mol_to_sys(cliff.load_dimer_xyz(str(tmp_path / 'S66-10.xyz'), units='bohr'), options))
+    _same_systems(systems, cliff.read_dimer_xyz(testpath + '/dimer_data/S66-10.xyz', options))
+
+    # several monomers, with more fields in the comment lines before the charge
+    with open(tmp_path / 'mons.xyz', 'w') as xfile:
+        xfile.write("3\nwater, -76.4, 0\nO 0.0 0.0 0.0\nH 0.758602 0.0 0.504284\nH 0.260455 0.0 -0.872893\n\n"
+                    "5\nammonium,1\nN 3.0 0.0 0.0\nH 3.6 0.6 0.6\nH 2.4 -0.6 0.6\nH 3.6 -0.6 -0.6\nH 2.4 0.6 -0.6\n")
+    systems = cliff.read_monomer_xyz(str(tmp_path / 'mons.xyz'), options)
+    mols = cliff.load_monomer_xyz(str(tmp_path / 'mons.xyz'))
+    assert [mol.molecular_charge for mol in mols] == [0, 1]
+    assert [mon.num_atoms for mon in systems] == [3, 5]
+    _same_systems(systems, [cliff.mol_to_sys(mol, options) for mol in mols])
+
+    with open(tmp_path / 'nocharge.xyz', 'w') as xfile:
+        xfile.write("1\nwater\nO 0.0 0.0 0.0\n")
+    with pytest.raises(Exception):
+        cliff.read_monomer_xyz(str(tmp_path / 'nocharge.xyz'), options)
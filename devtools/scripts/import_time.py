@@ -0,0 +1,65 @@
+"""
+Measures the startup cost of CLIFF: the wall time of `import cliff` and of
+`run_cliff.py --help` in fresh interpreters, and which heavy optional
+dependencies the import pulls in.
+
+    python devtools/scripts/import_time.py -n 10
+"""
+import argparse
+import os
+import subprocess as sp
+import sys
+import time
+
+import_probe = """
+import sys
+import cliff
+heavy = ['qml', 'scipy', 'scipy.optimize', 'scipy.spatial', 'qcelemental', 'apnet', 'tensorflow']
+print(' '.join(m for m in heavy if m in sys.modules))
+"""
+
+
+def wall_times(cmd, nrun):
+    times = []
+    for _ in range(nrun):
+        start = time.perf_counter()
+        sp.run(cmd, check=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of CLIFF")
+    parser.add_argument('-n', '--nrun', type=int, default=5, help='Number of fresh interpreters per command')
+    parser.add_argument('--importtime', action='store_true', help='Also print the slowest modules from python -X importtime')
+    args = parser.parse_args()
+
+    run_cliff = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'cliff', 'run_cliff.py')
+    commands = {'python -c pass' : [sys.executable, '-c', 'pass'],
+                'import cliff' : [sys.executable, '-c', 'import cliff'],
+                'run_cliff.py --help' : [sys.executable, run_cliff, '--help']}
+
+    print("%-22s %10s %10s" % ("command", "median s", "min s"))
+    for label, cmd in commands.items():
+        times = wall_times(cmd, args.nrun)
+        print("%-22s %10.3f %10.3f" % (label, times[len(times)//2], times[0]))
+
+    loaded = sp.run([sys.executable, '-c', import_probe], check=True, stdout=sp.PIPE, universal_newlines=True).stdout.split()
+    print("heavy modules loaded by import cliff: %s" % (', '.join(loaded) if loaded else 'none'))
+
+    if args.importtime:
+        # -X importtime writes "import time: self [us] | cumulative | package" to stderr
+        err = sp.run([sys.executable, '-X', 'importtime', '-c', 'import cliff'], check=True,
+                     stdout=sp.DEVNULL, stderr=sp.PIPE, universal_newlines=True).stderr
+        rows = []
+        for line in err.splitlines()[1:]:
+            fields = line.split('|')
+            if len(fields) == 3:
+                rows.append((int(fields[1].split()[0]), fields[2].rstrip()))
+        print("slowest imports (cumulative us):")
+        for cumulative, module in sorted(rows, reverse=True)[:15]:
+            print("%10d %s" % (cumulative, module))
+
+
+if __name__ == '__main__':
+    main()